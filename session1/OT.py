@@ -11,10 +11,18 @@ Exercice Session : Secure 2-party computation
 Oblivious Transfer
 """
 
+import collections
+import threading
+
 from Crypto.Random import random
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+import Crypto.Util.number
+
+import gmpy
 
-from elgamal import elgamal_param_gen
-from aes import AES_key
+from elgamal import elgamal_param_gen, elgamal_group_gen, ElgamalCiphertext, GROUPS
+from aes import AES_key, AES_KEY_LEN_BYTES, AES_BLOCK_LEN_BYTES
 
 
 class Sender:
@@ -49,8 +57,12 @@ class Sender:
 
         enc_1 = pk.encrypt(1)
 
-        e_0 = ((enc_1 - c) * self.m_0.as_int()) + (r_0 * c)
-        e_1 = (c * self.m_1.as_int()) + (r_1 * (enc_1 - c))
+        # e_0 = ((enc_1 - c) * m_0) + (r_0 * c)
+        # e_1 = (c * m_1) + (r_1 * (enc_1 - c))
+        m_0 = self.m_0.as_int()
+        m_1 = self.m_1.as_int()
+        e_0 = ElgamalCiphertext.linear_combination([enc_1, c], [m_0, r_0 - m_0])
+        e_1 = ElgamalCiphertext.linear_combination([c, enc_1], [m_1 - r_1, r_1])
 
         # </To be done by students>
 
@@ -63,10 +75,17 @@ class Receiver:
     Attributes:
     * pk: Public key
     * sk: Secret key
+
+    :param G: group parameters (or group name) to reuse with a fresh secret
+        key, None to generate fresh group parameters
+    :param pool: elgamal.KeyPool to take the keypair from
     """
 
-    def __init__(self):
-        self.pk, self.sk = elgamal_param_gen()
+    def __init__(self, G=None, pool=None):
+        if pool is not None:
+            self.pk, self.sk = pool.get()
+        else:
+            self.pk, self.sk = elgamal_param_gen(G=G)
 
     def challenge(self, b):
         """Generate an OT challenge
@@ -104,6 +123,536 @@ class Receiver:
         return key
 
 
+# Group of the hashed Diffie-Hellman OT (no discrete log is needed, hence a
+# large group can be used).
+DH_GROUP = "safe1024"
+
+
+def _dh_group(G):
+    if G is None:
+        G = DH_GROUP
+    if not isinstance(G, tuple):
+        G = GROUPS[G]
+    return G
+
+
+def _dh_pad(i, A, K):
+    """Key derived from the Diffie-Hellman shared element K for message i.
+
+    :rtype: int of AES_KEY_LEN_BYTES bytes
+    """
+    h = SHA256.new(("%d,%d,%d" % (i, A, K)).encode("ascii"))
+    return Crypto.Util.number.bytes_to_long(h.digest()[:AES_KEY_LEN_BYTES])
+
+
+def _dh_base(G):
+    """Element C = H(G)^2 of the group, whose discrete log is unknown."""
+    g, p, q = G
+    h = SHA256.new(("OT,%d,%d,%d" % (g, p, q)).encode("ascii"))
+    return pow(Crypto.Util.number.bytes_to_long(h.digest()), 2, p)
+
+
+class DHSender:
+    """Oblivious transfer sender for full 128-bit AES keys (hashed
+    Diffie-Hellman, Bellare-Micali)
+
+    Same interface as Sender, but the messages are masked with keys hashed
+    from Diffie-Hellman shared elements instead of being encrypted in the
+    exponent, hence they can have any value and the receiver does not need
+    any discrete log.
+
+    :param msg_0: Message 0
+    :param msg_1: Message 1
+    :type msg_0: AES_key
+    :type msg_1: AES_key
+    """
+
+    def __init__(self, msg_0, msg_1):
+        assert isinstance(msg_0, AES_key)
+        assert isinstance(msg_1, AES_key)
+        self.m_0 = msg_0
+        self.m_1 = msg_1
+
+    def response(self, c, pk):
+        """Response to a challenge sent by the receiver
+
+        :param c: challenge PK_0
+        :param pk: group parameters of the receiver
+        :return: responses e_0, e_1, with e_i = (A, m_i xor H(i, A, PK_i^a))
+        :rtype: ((int, int), (int, int))
+        :raises ValueError: if c is not an element of the group
+        """
+        g, p, q = pk
+        # PK_0 must be in the subgroup of order q
+        if not (0 < c < p and pow(c, q, p) == 1):
+            raise ValueError("invalid OT challenge")
+        PK_0 = c
+        PK_1 = _dh_base(pk) * gmpy.invert(PK_0, p) % p
+        a = random.randint(1, int(q - 1))
+        A = pow(g, a, p)
+        y_0 = self.m_0.as_int() ^ _dh_pad(0, A, pow(PK_0, a, p))
+        y_1 = self.m_1.as_int() ^ _dh_pad(1, A, pow(PK_1, a, p))
+        return (A, y_0), (A, y_1)
+
+
+class DHReceiver:
+    """Oblivious transfer receiver for full 128-bit AES keys, see DHSender.
+
+    The receiver knows the discrete log k of PK_b = g^k, but not the one of
+    PK_(1-b) = C / PK_b, hence it can only recover m_b.
+
+    Attributes:
+    * pk: group parameters (g, p, q)
+
+    :param G: group parameters or group name (default: DH_GROUP)
+    """
+
+    def __init__(self, G=None):
+        self.pk = _dh_group(G)
+        self.k = None
+
+    def challenge(self, b):
+        """Generate an OT challenge
+
+        :param b: Message to receive (0 or 1)
+        :return: PK_0
+        :rtype: int
+        """
+        assert b in (0, 1)
+        g, p, q = self.pk
+        self.k = random.randint(1, int(q - 1))
+        PK_b = pow(g, self.k, p)
+        if b == 0:
+            return PK_b
+        return _dh_base(self.pk) * gmpy.invert(PK_b, p) % p
+
+    def decrypt_response(self, e_0, e_1, b):
+        """Decrypt response received from Sender
+
+        :rtype: AES_key
+        """
+        A, y = (e_0, e_1)[b]
+        K = pow(A, self.k, self.pk[1])
+        return AES_key.from_int(y ^ _dh_pad(b, A, K))
+
+
+# OT modes: sender and receiver classes, and number of leading zero bits of
+# the keys it can transfer (El Gamal OT transfers keys in the exponent, hence
+# 20-bit keys).
+SENDERS = {"elgamal": Sender, "dh": DHSender}
+RECEIVERS = {"elgamal": Receiver, "dh": DHReceiver}
+KEY_ZERO_BITS = {"elgamal": 108, "dh": 0}
+# Receiver class of each sender class
+RECEIVER_CLASSES = dict((SENDERS[mode], RECEIVERS[mode]) for mode in SENDERS)
+
+
+# Security parameter of the OT extension: number of base OTs.
+OT_EXT_KAPPA = 128
+
+
+def _prg(seed, nbits):
+    """Expand an AES key into nbits pseudo-random bits (AES in counter mode).
+
+    :type seed: AES_key
+    :rtype: int
+    """
+    nblocks = -(-nbits // (8 * AES_BLOCK_LEN_BYTES))
+    counter = b"".join(
+        Crypto.Util.number.long_to_bytes(i, AES_BLOCK_LEN_BYTES) for i in range(nblocks)
+    )
+    stream = AES.new(seed.as_bytes(), AES.MODE_ECB).encrypt(counter)
+    return Crypto.Util.number.bytes_to_long(stream) >> (8 * len(stream) - nbits)
+
+
+def _row_hash(j, row):
+    """Correlation-robust hash of row j of the extension matrix.
+
+    :rtype: int of AES_KEY_LEN_BYTES bytes
+    """
+    h = SHA256.new(
+        Crypto.Util.number.long_to_bytes(j, 8)
+        + Crypto.Util.number.long_to_bytes(row, OT_EXT_KAPPA // 8)
+    )
+    return Crypto.Util.number.bytes_to_long(h.digest()[:AES_KEY_LEN_BYTES])
+
+
+def _transpose(columns, nrows):
+    """Transpose a bit matrix given as a list of columns (bit j of
+    columns[i] is entry (j, i)) into the list of its nrows rows (bit i of
+    rows[j] is entry (j, i))."""
+    cols = [format(c, "0%db" % nrows)[::-1] for c in columns]
+    return [int("".join(bits)[::-1], 2) for bits in zip(*cols)]
+
+
+class ExtensionSender:
+    """OT extension sender (IKNP) for many pairs of AES keys
+
+    Only OT_EXT_KAPPA public-key OTs (base OTs, where the roles are swapped)
+    are run, then any number of OTs are derived with a PRG and a hash.
+
+    Protocol::
+
+        ExtensionSender                       ExtensionReceiver
+        cs = base_challenges()       ---->
+                                     <----    es = base_responses(cs)
+        base_finish(es)
+                                     <----    u = extend()
+        ys = send_many(u)            ---->
+                                              keys = receive_many(ys)
+
+    :param pairs: messages to transfer
+    :type pairs: list of (AES_key, AES_key)
+    """
+
+    def __init__(self, pairs):
+        for k0, k1 in pairs:
+            assert isinstance(k0, AES_key)
+            assert isinstance(k1, AES_key)
+        self.pairs = list(pairs)
+        self.s = random.getrandbits(OT_EXT_KAPPA)
+        self.seeds = None
+        self.base_receivers = [DHReceiver() for _ in range(OT_EXT_KAPPA)]
+
+    def base_challenges(self):
+        """Challenges of the base OTs, in which the sender chooses bit i of s.
+
+        :rtype: list of (int, group parameters)
+        """
+        return [
+            (rec.challenge((self.s >> i) & 1), rec.pk)
+            for i, rec in enumerate(self.base_receivers)
+        ]
+
+    def base_finish(self, responses):
+        """Recover the seeds k_i^(s_i) from the base OT responses."""
+        self.seeds = [
+            rec.decrypt_response(e_0, e_1, (self.s >> i) & 1)
+            for i, (rec, (e_0, e_1)) in enumerate(zip(self.base_receivers, responses))
+        ]
+
+    def send_many(self, u):
+        """Encrypt the pairs of messages.
+
+        :param u: columns sent by ExtensionReceiver.extend
+        :return: the pairs of encrypted messages
+        :rtype: list of (int, int)
+        """
+        m = len(self.pairs)
+        assert self.seeds is not None and len(u) == OT_EXT_KAPPA
+        # q^i = G(k_i^(s_i)) xor s_i * u^i = t^i xor s_i * r
+        columns = []
+        for i, (seed, u_i) in enumerate(zip(self.seeds, u)):
+            col = _prg(seed, m)
+            if (self.s >> i) & 1:
+                col ^= u_i
+            columns.append(col)
+        # row j: q_j = t_j xor r_j * s
+        rows = _transpose(columns, m)
+        res = []
+        for j, ((k0, k1), q_j) in enumerate(zip(self.pairs, rows)):
+            y0 = k0.as_int() ^ _row_hash(j, q_j)
+            y1 = k1.as_int() ^ _row_hash(j, q_j ^ self.s)
+            res.append((y0, y1))
+        return res
+
+
+class ExtensionReceiver:
+    """OT extension receiver (IKNP), see ExtensionSender.
+
+    :param choices: messages to receive (0 or 1 each)
+    :type choices: list of int
+    """
+
+    def __init__(self, choices):
+        self.choices = list(choices)
+        for b in self.choices:
+            assert b in (0, 1)
+        self.r = 0
+        for j, b in enumerate(self.choices):
+            self.r |= b << j
+        self.seed_pairs = [
+            (AES_key.gen_random(0), AES_key.gen_random(0)) for _ in range(OT_EXT_KAPPA)
+        ]
+        self.rows = None
+
+    def base_responses(self, challenges):
+        """Answer the base OTs, offering the pairs of seeds."""
+        return [
+            DHSender(k0, k1).response(c, pk)
+            for (k0, k1), (c, pk) in zip(self.seed_pairs, challenges)
+        ]
+
+    def extend(self):
+        """Columns u^i = G(k_i^0) xor G(k_i^1) xor r.
+
+        :rtype: list of int
+        """
+        m = len(self.choices)
+        columns = []
+        u = []
+        for k0, k1 in self.seed_pairs:
+            t_i = _prg(k0, m)
+            columns.append(t_i)
+            u.append(t_i ^ _prg(k1, m) ^ self.r)
+        self.rows = _transpose(columns, m)
+        return u
+
+    def receive_many(self, ys):
+        """Decrypt the chosen messages.
+
+        :param ys: pairs of encrypted messages from ExtensionSender.send_many
+        :rtype: list of AES_key
+        """
+        assert self.rows is not None and len(ys) == len(self.choices)
+        return [
+            AES_key.from_int(y[b] ^ _row_hash(j, t_j))
+            for j, (y, b, t_j) in enumerate(zip(ys, self.choices, self.rows))
+        ]
+
+
+class RandomOT:
+    """Precomputed random OT
+
+    The sender holds two random keys r_0 and r_1, the receiver a random bit c
+    and r_c. Beaver derandomization turns it into an OT of chosen messages
+    with chosen bit b using only XORs::
+
+        Receiver                              Sender
+        e = challenge(b)             ---->
+                                     <----    y_0, y_1 = derandomize(e)
+        m_b = decrypt_response(y_0, y_1, b)
+
+    """
+
+    def __init__(self, r_0, r_1, c, r_c):
+        self.r_0 = r_0
+        self.r_1 = r_1
+        self.c = c
+        self.r_c = r_c
+
+    def challenge(self, b):
+        """Receiver: e = b xor c."""
+        assert b in (0, 1)
+        return b ^ self.c
+
+    def derandomize(self, sender, e):
+        """Sender: mask the messages of sender with r_e and r_(1-e).
+
+        :type sender: Sender
+        :rtype: (int, int)
+        """
+        r = (self.r_0, self.r_1)
+        return (
+            sender.m_0.as_int() ^ r[e].as_int(),
+            sender.m_1.as_int() ^ r[1 - e].as_int(),
+        )
+
+    def decrypt_response(self, y_0, y_1, b):
+        """Receiver: m_b = y_b xor r_c.
+
+        :rtype: AES_key
+        """
+        return AES_key.from_int((y_0, y_1)[b] ^ self.r_c.as_int())
+
+
+class RandomOTPool:
+    """Pool of precomputed random OTs
+
+    When a take leaves fewer than refill_threshold random OTs, the pool is
+    refilled up to size, in the background if background is True. When the
+    pool is empty, take generates a random OT on the spot (a miss).
+
+    Metrics: hits, misses, refills (number of refills) and generated (number
+    of random OTs generated).
+
+    :param size: number of random OTs to keep ready
+    :param refill_threshold: refill when fewer random OTs are ready
+    :param background: refill in a background thread
+    :param extension: generate with OT extension (see transfer_many)
+    """
+
+    def __init__(self, size=1024, refill_threshold=None, background=False, extension=None):
+        self.size = size
+        if refill_threshold is None:
+            refill_threshold = size // 4
+        self.refill_threshold = refill_threshold
+        self.extension = extension
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.generated = 0
+        self._ready = collections.deque()
+        # _lock protects _ready and the metrics, _refill_lock serializes the
+        # refills (a refill in take and one in the background thread would
+        # both fill the missing random OTs)
+        self._lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+        self._thread = None
+        if background:
+            self._wake = threading.Event()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._refill_loop)
+            self._thread.daemon = True
+            self._thread.start()
+            self._wake.set()
+        else:
+            self.refill()
+
+    def generate(self, n):
+        """Generate n random OTs.
+
+        :rtype: list of RandomOT
+        """
+        pairs = [(AES_key.gen_random(0), AES_key.gen_random(0)) for _ in range(n)]
+        choices = [random.getrandbits(1) for _ in range(n)]
+        keys = transfer_many([DHSender(*pair) for pair in pairs], choices, self.extension)
+        with self._lock:
+            self.generated += n
+        return [
+            RandomOT(r_0, r_1, c, r_c)
+            for (r_0, r_1), c, r_c in zip(pairs, choices, keys)
+        ]
+
+    def refill(self):
+        """Fill the pool up to size."""
+        with self._refill_lock:
+            with self._lock:
+                n = self.size - len(self._ready)
+            if n > 0:
+                rots = self.generate(n)
+                with self._lock:
+                    self._ready.extend(rots)
+                    self.refills += 1
+
+    def _refill_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(0.1)
+            if self._wake.is_set():
+                self._wake.clear()
+                self.refill()
+
+    def take(self):
+        """Take a random OT from the pool.
+
+        :rtype: RandomOT
+        """
+        with self._lock:
+            rot = self._ready.popleft() if self._ready else None
+            left = len(self._ready)
+            if rot is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if rot is None:
+            rot = self.generate(1)[0]
+        if left < self.refill_threshold:
+            if self._thread is not None:
+                self._wake.set()
+            else:
+                self.refill()
+        return rot
+
+    def __len__(self):
+        return len(self._ready)
+
+    def stop(self):
+        """Stop the background refills."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+
+
+def transfer_many(senders, choices, extension=None, pool=None):
+    """Run the OTs between senders and a receiver with the given choices in
+    this process.
+
+    :param senders: OT senders (all of the same class)
+    :type senders: list of Sender or list of DHSender
+    :param choices: message to receive from each sender (0 or 1)
+    :param extension: use OT extension (default: when there are more OTs than
+        base OTs)
+    :param pool: RandomOTPool to take precomputed random OTs from, in which
+        case only the derandomization is done online
+    :rtype: list of AES_key
+    """
+    senders = list(senders)
+    choices = list(choices)
+    if pool is not None:
+        keys = []
+        for sender, b in zip(senders, choices):
+            rot = pool.take()
+            y_0, y_1 = rot.derandomize(sender, rot.challenge(b))
+            keys.append(rot.decrypt_response(y_0, y_1, b))
+        return keys
+    if extension is None:
+        extension = len(senders) > OT_EXT_KAPPA
+    if not extension:
+        receiver_class = RECEIVER_CLASSES[type(senders[0])] if senders else Receiver
+        # One group for all the OTs, with a fresh secret key for each one.
+        G = elgamal_group_gen() if receiver_class is Receiver else None
+        keys = []
+        for sender, b in zip(senders, choices):
+            Bob = receiver_class(G)
+            e0, e1 = sender.response(Bob.challenge(b), Bob.pk)
+            keys.append(Bob.decrypt_response(e0, e1, b))
+        return keys
+    Alice = ExtensionSender([(sender.m_0, sender.m_1) for sender in senders])
+    Bob = ExtensionReceiver(choices)
+    Alice.base_finish(Bob.base_responses(Alice.base_challenges()))
+    return Bob.receive_many(Alice.send_many(Bob.extend()))
+
+
+def test_OT_extension():
+    pairs = [(AES_key.gen_random(0), AES_key.gen_random(0)) for _ in range(300)]
+    choices = [random.getrandbits(1) for _ in pairs]
+    keys = transfer_many([Sender(k0, k1) for k0, k1 in pairs], choices, True)
+    assert keys == [pair[b] for pair, b in zip(pairs, choices)]
+    assert _transpose([0b01, 0b11, 0b10], 2) == [0b011, 0b110]
+
+
+def test_random_OT_pool():
+    pool = RandomOTPool(size=8, refill_threshold=2)
+    assert len(pool) == 8 and pool.refills == 1
+    pairs = [(AES_key.gen_random(0), AES_key.gen_random(0)) for _ in range(10)]
+    choices = [random.getrandbits(1) for _ in pairs]
+    keys = transfer_many([DHSender(k0, k1) for k0, k1 in pairs], choices, pool=pool)
+    assert keys == [pair[b] for pair, b in zip(pairs, choices)]
+    assert pool.hits == 10 and pool.misses == 0 and pool.refills == 2
+
+    # concurrent takes and background refills never overfill the pool
+    pool = RandomOTPool(size=8, refill_threshold=4, background=True)
+    threads = [
+        threading.Thread(target=lambda: [pool.take() for _ in range(10)]) for _ in range(3)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    pool.stop()
+    assert len(pool) <= 8 and pool.hits + pool.misses == 30
+
+
+def test_DH_OT():
+    for b in (0, 1):
+        k0 = AES_key.gen_random(0)
+        k1 = AES_key.gen_random(0)
+        Bob = DHReceiver()
+        e0, e1 = DHSender(k0, k1).response(Bob.challenge(b), Bob.pk)
+        assert Bob.decrypt_response(e0, e1, b) == (k0, k1)[b]
+    # challenges outside the subgroup of order q are rejected
+    g, p, q = Bob.pk
+    for c in (0, p - 1, p):
+        try:
+            DHSender(k0, k1).response(c, Bob.pk)
+            assert False
+        except ValueError:
+            pass
+    pairs = [(AES_key.gen_random(0), AES_key.gen_random(0)) for _ in range(5)]
+    choices = [random.getrandbits(1) for _ in pairs]
+    keys = transfer_many([DHSender(k0, k1) for k0, k1 in pairs], choices)
+    assert keys == [pair[b] for pair, b in zip(pairs, choices)]
+
+
 def test_OT():
     b = random.getrandbits(1)
     Bob = Receiver()
@@ -124,3 +673,6 @@ def test_OT():
 
 if __name__ == "__main__":
     test_OT()
+    test_DH_OT()
+    test_OT_extension()
+    test_random_OT_pool()
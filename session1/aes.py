@@ -12,6 +12,9 @@ import Crypto.Util.number
 
 AES_KEY_LEN_BYTES = 16
 AES_BLOCK_LEN_BYTES = 16
+BLOCK_MASK = 2 ** (8 * AES_BLOCK_LEN_BYTES) - 1
+# Public key of the fixed-key permutation (any constant works).
+FIXED_AES_KEY = bytes(bytearray(range(AES_KEY_LEN_BYTES)))
 
 class AES_key:
     """AES Key with multiple representations
@@ -41,9 +44,7 @@ class AES_key:
         # @students: We use (by default) keys with 108 leading zeros, which
         # gives an effective key length of 20 bits.
         # Is it secure ? Could we increase it (e.g. to 128) bits
-        rep_bin = [0] * nbr_zero
-        rep_bin += [rd.randrange(2) for i in range(8 * AES_KEY_LEN_BYTES - nbr_zero)]
-        return cls.from_bin(rep_bin)
+        return cls.from_int(rd.getrandbits(8 * AES_KEY_LEN_BYTES - nbr_zero))
 
     @classmethod
     def from_int(cls, rep_int):
@@ -160,6 +161,72 @@ class AES_key:
         return self.key == other.key
 
 
+def _gf_double(x):
+    """Multiplication by 2 in GF(2^128) (x^128 + x^7 + x^2 + x + 1)."""
+    x <<= 1
+    if x >> 128:
+        x = (x & BLOCK_MASK) ^ 0x87
+    return x
+
+
+class FixedKeyHash:
+    """Tweakable hash built on a single fixed-key AES permutation pi
+
+    H(k, T) = pi(2k ^ T) ^ 2k ^ T, for 128-bit integers k and T (2k being the
+    doubling in GF(2^128)), and H(a, b, T) = pi(K) ^ K with K = 2a ^ 4b ^ T
+    for a hash of two keys (JustGarble). The key schedule is computed once,
+    and many blocks are processed by each call to AES.
+
+    :param key: key of the permutation, public
+    """
+
+    def __init__(self, key=FIXED_AES_KEY):
+        self.cipher = AES.new(key, AES.MODE_ECB)
+
+    def _permute_many(self, xs):
+        """pi(x) ^ x for all x in xs, with a single call to AES."""
+        out = self.cipher.encrypt(
+            b"".join(Crypto.Util.number.long_to_bytes(x, AES_BLOCK_LEN_BYTES) for x in xs)
+        )
+        n = AES_BLOCK_LEN_BYTES
+        return [
+            Crypto.Util.number.bytes_to_long(out[n * i : n * (i + 1)]) ^ x
+            for i, x in enumerate(xs)
+        ]
+
+    def hash_many(self, keys, tweaks):
+        """H(keys[i], tweaks[i]) for all i, with a single call to AES.
+
+        :type keys: list of int
+        :type tweaks: list of int
+        :rtype: list of int
+        """
+        return self._permute_many([_gf_double(k) ^ t for k, t in zip(keys, tweaks)])
+
+    def hash2_many(self, keys0, keys1, tweaks):
+        """H(keys0[i], keys1[i], tweaks[i]) for all i, with a single call to
+        AES.
+
+        :type keys0: list of int
+        :type keys1: list of int
+        :type tweaks: list of int
+        :rtype: list of int
+        """
+        return self._permute_many(
+            [
+                _gf_double(a) ^ _gf_double(_gf_double(b)) ^ t
+                for a, b, t in zip(keys0, keys1, tweaks)
+            ]
+        )
+
+    def hash(self, k, tweak):
+        """H(k, tweak)
+
+        :rtype: int
+        """
+        return self.hash_many([k], [tweak])[0]
+
+
 def test():
     k1 = AES_key.gen_random(0)
     k1_int = k1.as_int()
@@ -174,6 +241,16 @@ def test():
     assert k1 == AES_key.from_bytes(k1_bytes)
     m = rd.randrange(2 ** 128)
     assert Crypto.Util.number.long_to_bytes(m) == k1.decrypt(k1.encrypt(m))
+    H = FixedKeyHash()
+    k = k1.as_int()
+    hs = H.hash_many([k, k, k ^ 1], [0, 1, 0])
+    assert hs[0] == H.hash(k, 0) and len(set(hs)) == 3
+    # the hash of two keys is not the XOR of hashes of one key
+    a, b = k, rd.getrandbits(128)
+    h2 = H.hash2_many([a, a, a ^ 1, a ^ 1], [b, b ^ 1, b, b ^ 1], [0] * 4)
+    assert h2[0] ^ h2[1] ^ h2[2] ^ h2[3] != 0 and len(set(h2)) == 4
+    assert H.hash2_many([k], [0], [1]) == H.hash_many([k], [1])
+    assert _gf_double(2 ** 127) == 0x87 and _gf_double(3) == 6
 
 
 if __name__ == "__main__":
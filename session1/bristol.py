@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+LELEC2770 : Privacy Enhancing Technologies
+
+Bristol Fashion circuit files
+
+Reader and writer for the "Bristol Fashion" format used by the standard MPC
+circuits (AES-128, SHA-256, adders, comparators...)::
+
+    <number of gates> <number of wires>
+    <number of input values> <bits of value 1> <bits of value 2> ...
+    <number of output values> <bits of value 1> ...
+
+    2 1 <in0> <in1> <out> XOR|AND
+    1 1 <in> <out> INV|EQW
+    1 1 <0|1> <out> EQ
+    2k k <in0...> <in1...> <out...> MAND
+
+The input values occupy the first wires and the output values the last ones.
+In the corresponding Circuit, gate ids are the wire numbers.
+
+- INV a is NAND(a, a);
+- EQW (wire copy) is an alias of its input, or AND(a, a) for an output;
+- EQ (constant) is XOR(i, i) or NOR(XOR(i, i), XOR(i, i)) for an input i,
+  the extra wire of the latter being numbered -1.
+
+Garbled circuits additionally require that output wires do not feed other
+gates, which is the case of the usual Bristol files.
+"""
+
+from __future__ import print_function
+
+import six
+
+from logic_circuit import Gate, Circuit, INPUT_GATE
+
+ZERO_WIRE = -1
+
+
+def read_bristol(f):
+    """Read a Bristol Fashion circuit from a text file object, line by line.
+
+    :returns: the circuit, the input wires of each input value and the
+        output wires of each output value
+    :rtype: (Circuit, list of lists of ids, list of lists of ids)
+    :raises ValueError: if the file is malformed
+    """
+    lines = iter(f)
+
+    def header():
+        for line in lines:
+            fields = line.split()
+            if fields:
+                return [int(x) for x in fields]
+        raise ValueError("truncated Bristol header")
+
+    try:
+        ngates, nwires = header()
+        in_bits = header()[1:]
+        out_bits = header()[1:]
+    except ValueError:
+        raise ValueError("malformed Bristol header")
+
+    n_inputs = sum(in_bits)
+    n_outputs = sum(out_bits)
+    input_groups = []
+    start = 0
+    for bits in in_bits:
+        input_groups.append(list(range(start, start + bits)))
+        start += bits
+    output_groups = []
+    start = nwires - n_outputs
+    for bits in out_bits:
+        output_groups.append(list(range(start, start + bits)))
+        start += bits
+    outputs = set(range(nwires - n_outputs, nwires))
+
+    g = dict((i, INPUT_GATE) for i in range(n_inputs))
+    order = list(range(n_inputs))
+    # wire -> id of the gate computing it (only for EQW aliases)
+    alias = {}
+
+    def wire(w):
+        w = int(w)
+        w = alias.get(w, w)
+        if w not in g:
+            raise ValueError("wire %d used before being set" % w)
+        return w
+
+    def add(g_id, gate):
+        if g_id in g or g_id in alias:
+            raise ValueError("wire %d set twice" % g_id)
+        g[g_id] = gate
+        order.append(g_id)
+
+    count = 0
+    # XOR and AND gates are handled inline: they are almost all the gates.
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        count += 1
+        op = fields[-1]
+        if op == "XOR" or op == "AND":
+            a = int(fields[2])
+            b = int(fields[3])
+            out = int(fields[4])
+            if alias:
+                a = alias.get(a, a)
+                b = alias.get(b, b)
+            if a not in g or b not in g:
+                wire(fields[2]), wire(fields[3])
+            if out in g or out in alias:
+                raise ValueError("wire %d set twice" % out)
+            g[out] = Gate(op, a, b)
+            order.append(out)
+        elif op == "INV":
+            a = wire(fields[2])
+            add(int(fields[3]), Gate("NAND", a, a))
+        elif op == "EQW":
+            a = wire(fields[2])
+            out = int(fields[3])
+            if out in outputs:
+                add(out, Gate("AND", a, a))
+            elif out in g or out in alias:
+                raise ValueError("wire %d set twice" % out)
+            else:
+                alias[out] = a
+        elif op == "EQ":
+            if not n_inputs:
+                raise ValueError("constant in a circuit without inputs")
+            out = int(fields[3])
+            if fields[2] == "0":
+                add(out, Gate("XOR", 0, 0))
+            else:
+                if ZERO_WIRE not in g:
+                    add(ZERO_WIRE, Gate("XOR", 0, 0))
+                add(out, Gate("NOR", ZERO_WIRE, ZERO_WIRE))
+        elif op == "MAND":
+            k = int(fields[1])
+            ws = fields[2:-1]
+            ins = [wire(w) for w in ws[: 2 * k]]
+            for i in range(k):
+                add(int(ws[2 * k + i]), Gate("AND", ins[i], ins[k + i]))
+        else:
+            raise ValueError("unknown Bristol gate %r" % op)
+    if count != ngates:
+        raise ValueError("expected %d gates, found %d" % (ngates, count))
+    for out in outputs:
+        if out not in g:
+            raise ValueError("output wire %d is not set" % out)
+    return Circuit(g, outputs, order), input_groups, output_groups
+
+
+def load_bristol(path):
+    """Read the Bristol Fashion circuit at path, see :func:`read_bristol`."""
+    with open(path) as f:
+        return read_bristol(f)
+
+
+def write_bristol(f, circuit, input_groups=None, output_groups=None):
+    """Write circuit to a text file object in Bristol Fashion.
+
+    NAND, OR and NOR gates are written with INV, AND and XOR gates, hence
+    the file may have more gates than the circuit.
+
+    :param input_groups: ids of the input gates of each input value,
+        defaults to a single value with all the inputs in topological order
+    :param output_groups: ids of the output gates of each output value,
+        defaults to a single value with all the outputs in topological order
+    """
+    order = circuit.ordered_gates()
+    g = circuit.g
+    if input_groups is None:
+        input_groups = [[g_id for g_id in order if g[g_id].kind == "INPUT"]]
+    if output_groups is None:
+        output_groups = [[g_id for g_id in order if g_id in circuit.output_gates]]
+    inputs = [g_id for group in input_groups for g_id in group]
+    outputs = [g_id for group in output_groups for g_id in group]
+    assert len(inputs) == sum(1 for gate in six.itervalues(g) if gate.kind == "INPUT")
+    assert set(outputs) == set(circuit.output_gates)
+
+    # gates of the file, with wires as gate ids or (g_id, i) temporaries
+    gates = []
+    for g_id in order:
+        gate = g[g_id]
+        a, b, kind = gate.in0_id, gate.in1_id, gate.kind
+        if kind == "AND" or kind == "XOR":
+            gates.append((kind, a, b, g_id))
+        elif kind == "NAND" and a == b:
+            gates.append(("INV", a, None, g_id))
+        elif kind == "NAND":
+            gates.append(("AND", a, b, (g_id, 0)))
+            gates.append(("INV", (g_id, 0), None, g_id))
+        elif kind == "OR" or kind == "NOR":
+            # a | b == (a ^ b) ^ (a & b)
+            gates.append(("XOR", a, b, (g_id, 0)))
+            gates.append(("AND", a, b, (g_id, 1)))
+            if kind == "OR":
+                gates.append(("XOR", (g_id, 0), (g_id, 1), g_id))
+            else:
+                gates.append(("XOR", (g_id, 0), (g_id, 1), (g_id, 2)))
+                gates.append(("INV", (g_id, 2), None, g_id))
+
+    number = dict((g_id, i) for i, g_id in enumerate(inputs))
+    output_set = set(outputs)
+    for gate in gates:
+        if gate[3] not in output_set:
+            number[gate[3]] = len(number)
+    for g_id in outputs:
+        number[g_id] = len(number)
+
+    f.write("%d %d\n" % (len(gates), len(number)))
+    f.write(" ".join(str(x) for x in [len(input_groups)] + [len(x) for x in input_groups]))
+    f.write("\n")
+    f.write(" ".join(str(x) for x in [len(output_groups)] + [len(x) for x in output_groups]))
+    f.write("\n\n")
+    for kind, a, b, out in gates:
+        if b is None:
+            f.write("1 1 %d %d %s\n" % (number[a], number[out], kind))
+        else:
+            f.write("2 1 %d %d %d %s\n" % (number[a], number[b], number[out], kind))
+
+
+def save_bristol(path, circuit, input_groups=None, output_groups=None):
+    """Write circuit at path, see :func:`write_bristol`."""
+    with open(path, "w") as f:
+        write_bristol(f, circuit, input_groups, output_groups)
+
+
+def test_bristol():
+    import io
+    import random
+
+    # 2-bit adder, with every gate kind of the format
+    text = """7 12
+2 2 2
+1 3
+
+2 1 0 2 5 XOR
+2 1 0 2 6 AND
+2 1 1 3 7 XOR
+1 1 5 9 EQW
+2 1 7 6 10 XOR
+4 2 1 7 3 6 4 8 MAND
+2 1 4 8 11 XOR
+"""
+    circ, ins, outs = read_bristol(io.StringIO(text))
+    assert ins == [[0, 1], [2, 3]] and outs == [[9, 10, 11]]
+    for x in range(4):
+        for y in range(4):
+            inputs = {0: x & 1, 1: x >> 1, 2: y & 1, 3: y >> 1}
+            state = circ.evaluate(inputs).state
+            assert state[9] + 2 * state[10] + 4 * state[11] == x + y
+
+    from prs import prs_circuit
+
+    f = io.StringIO()
+    write_bristol(f, prs_circuit, [["A", "B"], ["C", "D"]], [["E", "F"]])
+    f.seek(0)
+    circ, ins, outs = read_bristol(f)
+    input_ids, table = prs_circuit.truth_table(["A", "B", "C", "D"])
+    _, table2 = circ.truth_table(ins[0] + ins[1])
+    assert [table[o] for o in ("E", "F")] == [table2[o] for o in outs[0]]
+
+    g = dict((i, INPUT_GATE) for i in range(6))
+    for i in range(6, 100):
+        g[i] = Gate(random.choice(Gate.KINDS[1:]), random.randrange(i), random.randrange(i))
+    g[100] = Gate("NAND", 99, 99)
+    for i in range(101, 104):
+        g[i] = Gate(random.choice(Gate.KINDS[1:]), random.randrange(i), random.randrange(i))
+    circ = Circuit(g, {100, 101, 102, 103})
+    f = io.StringIO()
+    write_bristol(f, circ, output_groups=[[100, 101], [102, 103]])
+    f.seek(0)
+    circ2, ins, outs = read_bristol(f)
+    _, table = circ.truth_table(list(range(6)))
+    _, table2 = circ2.truth_table(ins[0])
+    assert [table[o] for o in (100, 101, 102, 103)] == [table2[o] for o in outs[0] + outs[1]]
+
+    for line in ("1 1 0 9 EQ", "1 1 1 9 EQ"):
+        text = "2 10\n1 1\n1 1\n\n%s\n1 1 9 9 EQW\n" % line
+        try:
+            read_bristol(io.StringIO(text))
+            assert False
+        except ValueError:
+            pass
+    text = "2 4\n1 1\n2 1 1\n\n1 1 1 2 EQ\n1 1 0 3 EQ\n"
+    circ, _, outs = read_bristol(io.StringIO(text))
+    assert [circ.evaluate({0: x}).state[o] for x in (0, 1) for o in (2, 3)] == [1, 0] * 2
+
+
+if __name__ == "__main__":
+    test_bristol()
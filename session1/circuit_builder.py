@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+LELEC2770 : Privacy Enhancing Technologies
+
+Circuit builder
+
+Build a :class:`logic_circuit.Circuit` from word-level operations instead of
+writing the gates by hand::
+
+    b = CircuitBuilder()
+    x = b.input("x", 8)
+    y = b.input("y", 8)
+    b.output("s", b.add(x, y))
+    b.output("lt", [b.lt(x, y)])
+    circuit = b.circuit()
+
+Words are lists of gate ids, least significant bit first. The constructions
+minimize the number of AND gates, since XOR gates are free with free-XOR
+garbling: an n-bit addition costs n - 1 ANDs, a comparison n, a
+multiplexer n.
+
+Each word operation is recorded once per bit width as a template, which is
+then instantiated by renaming its wires: building the same operation again,
+in the same or in another builder, does not redo the construction.
+"""
+
+from __future__ import print_function
+
+import six
+
+from logic_circuit import Gate, Circuit, INPUT_GATE
+
+# (operation, widths, parameters) -> _Template
+_TEMPLATES = {}
+
+
+class _Template:
+    """Gates of a word operation, with placeholders for its input words and
+    for the constants.
+
+    Attributes:
+    * gates: list of (local id, kind, in0, in1)
+    * outputs: result of the operation in terms of local ids
+    """
+
+    def __init__(self, build, widths, params):
+        builder = CircuitBuilder(_recording=True)
+        words = [[("in", k, i) for i in range(n)] for k, n in enumerate(widths)]
+        self.outputs = build(builder, *(words + list(params)))
+        self.gates = [
+            (g_id, gate.kind, gate.in0_id, gate.in1_id)
+            for g_id, gate in builder.gates
+        ]
+
+    def instantiate(self, builder, words):
+        wire = {}
+        for k, word in enumerate(words):
+            for i, w in enumerate(word):
+                wire[("in", k, i)] = w
+
+        def get(w):
+            if isinstance(w, RecordingConst):
+                return builder.const(w[1])
+            return wire[w]
+
+        for g_id, kind, in0, in1 in self.gates:
+            wire[g_id] = builder._gate(kind, get(in0), get(in1))
+        return _rename(self.outputs, get)
+
+
+class RecordingConst(tuple):
+    """Placeholder of constant v in a template."""
+
+    def __new__(cls, v):
+        return tuple.__new__(cls, ("const", v))
+
+
+def _rename(x, get):
+    if isinstance(x, list):
+        return [_rename(y, get) for y in x]
+    return get(x)
+
+
+class CircuitBuilder:
+    """Incremental construction of a Circuit from word-level operations
+
+    Gates created by the builder have integer ids; input and output gates
+    are named "name[i]".
+    """
+
+    def __init__(self, _recording=False):
+        self.gates = []
+        self.inputs = []
+        self.outputs = []
+        self._counter = 0
+        # constant wires: value -> id, id -> value
+        self._const_ids = {}
+        self._const_values = {}
+        self._recording = _recording
+
+    # ---- Wires ----
+
+    def input(self, name, bits):
+        """New input word of bits bits.
+
+        :rtype: list of gate ids
+        """
+        word = ["%s[%d]" % (name, i) for i in range(bits)]
+        self.inputs.append((name, word))
+        return word
+
+    def output(self, name, word):
+        """Declare word as output: its bits are output gates "name[i]"."""
+        self.outputs.append((name, list(word)))
+
+    def const(self, v):
+        """Wire of constant value v (0 or 1).
+
+        The constant 0 is XOR(i, i) for the first input i, and costs nothing
+        with free-XOR. The constant 1 costs one non-free gate per circuit.
+        """
+        v = int(v)
+        w = self._const_ids.get(v)
+        if w is None:
+            if self._recording:
+                w = RecordingConst(v)
+            elif v == 0:
+                assert self.inputs, "constants require an input"
+                i = self.inputs[0][1][0]
+                w = self._new_gate("XOR", i, i)
+            else:
+                zero = self.const(0)
+                w = self._new_gate("NOR", zero, zero)
+            self._const_ids[v] = w
+            self._const_values[w] = v
+        return w
+
+    def _new_gate(self, kind, in0, in1):
+        self._counter += 1
+        g_id = self._counter
+        self.gates.append((g_id, Gate(kind, in0, in1)))
+        return g_id
+
+    def _gate(self, kind, a, b):
+        if kind == "XOR":
+            return self.xor(a, b)
+        elif kind == "AND":
+            return self.and_(a, b)
+        else:
+            return self._new_gate(kind, a, b)
+
+    # ---- Bits ----
+
+    def xor(self, a, b):
+        if a == b:
+            return self.const(0)
+        va = self._const_values.get(a)
+        vb = self._const_values.get(b)
+        if va == 0:
+            return b
+        if vb == 0:
+            return a
+        if va is not None and vb is not None:
+            return self.const(va ^ vb)
+        return self._new_gate("XOR", a, b)
+
+    def and_(self, a, b):
+        if a == b:
+            return a
+        va = self._const_values.get(a)
+        vb = self._const_values.get(b)
+        if va is not None:
+            return b if va else self.const(0)
+        if vb is not None:
+            return a if vb else self.const(0)
+        return self._new_gate("AND", a, b)
+
+    def not_(self, a):
+        return self.xor(a, self.const(1))
+
+    def or_(self, a, b):
+        # a | b == a ^ b ^ (a & b): a single AND
+        return self.xor(self.xor(a, b), self.and_(a, b))
+
+    def _full_adder(self, a, b, c):
+        """Sum and carry of a + b + c with a single AND."""
+        t = self.xor(a, c)
+        s = self.xor(t, b)
+        carry = self.xor(c, self.and_(t, self.xor(b, c)))
+        return s, carry
+
+    # ---- Words ----
+
+    def _apply(self, op, words, build, *params):
+        key = (op, tuple(len(w) for w in words), params)
+        template = _TEMPLATES.get(key)
+        if template is None:
+            template = _Template(build, [len(w) for w in words], params)
+            _TEMPLATES[key] = template
+        return template.instantiate(self, words)
+
+    def add(self, x, y, carry_out=False):
+        """x + y modulo 2**n, or on n + 1 bits if carry_out.
+
+        n - 1 ANDs (n with carry_out).
+        """
+        assert len(x) == len(y)
+        return self._apply("add", [x, y], _build_add, carry_out)
+
+    def sub(self, x, y):
+        """x - y modulo 2**n. n - 1 ANDs."""
+        assert len(x) == len(y)
+        return self._apply("sub", [x, y], _build_sub)
+
+    def lt(self, x, y):
+        """x < y (unsigned). n ANDs.
+
+        :rtype: gate id
+        """
+        assert len(x) == len(y)
+        return self._apply("lt", [x, y], _build_lt)[0]
+
+    def gt(self, x, y):
+        """x > y (unsigned)."""
+        return self.lt(y, x)
+
+    def ge(self, x, y):
+        """x >= y (unsigned)."""
+        return self.not_(self.lt(x, y))
+
+    def le(self, x, y):
+        """x <= y (unsigned)."""
+        return self.not_(self.lt(y, x))
+
+    def eq(self, x, y):
+        """x == y. n - 1 ANDs.
+
+        :rtype: gate id
+        """
+        assert len(x) == len(y)
+        return self._apply("eq", [x, y], _build_eq)[0]
+
+    def mux(self, s, x, y):
+        """y if bit s else x. n ANDs."""
+        assert len(x) == len(y)
+        return self._apply("mux", [[s], x, y], _build_mux)
+
+    def mul(self, x, y):
+        """x * y modulo 2**n (schoolbook). n(n+1)/2 + (n-1)(n-2)/2 ANDs."""
+        assert len(x) == len(y)
+        return self._apply("mul", [x, y], _build_mul)
+
+    def hamming_weight(self, x):
+        """Number of bits set in x, on n.bit_length() bits.
+
+        Carry-save compression with full adders: less than n ANDs.
+        """
+        return self._apply("hamming_weight", [x], _build_hamming_weight)
+
+    # ---- Result ----
+
+    def circuit(self):
+        """The Circuit built so far.
+
+        Output gates must not feed other gates (as required by the garbled
+        circuits): an output bit computed by a gate used nowhere else becomes
+        that gate, other output bits are copies AND(w, w).
+
+        :rtype: Circuit
+        """
+        assert not self._recording
+        uses = {}
+        for _, gate in self.gates:
+            for w in (gate.in0_id, gate.in1_id):
+                uses[w] = uses.get(w, 0) + 1
+        input_ids = set(w for _, word in self.inputs for w in word)
+        rename = {}
+        copies = []
+        for name, word in self.outputs:
+            for i, w in enumerate(word):
+                out = "%s[%d]" % (name, i)
+                if w in input_ids or w in rename or uses.get(w, 0) > 0:
+                    copies.append((out, w))
+                else:
+                    rename[w] = out
+        g = dict((w, INPUT_GATE) for w in input_ids)
+        order = [w for _, word in self.inputs for w in word]
+        for g_id, gate in self.gates:
+            new_id = rename.get(g_id, g_id)
+            g[new_id] = gate
+            order.append(new_id)
+        for out, w in copies:
+            w = rename.get(w, w)
+            g[out] = Gate("AND", w, w)
+            order.append(out)
+        outputs = set(
+            "%s[%d]" % (name, i)
+            for name, word in self.outputs
+            for i in range(len(word))
+        )
+        return Circuit(g, outputs, order)
+
+    def input_values(self, name, value):
+        """Values of the input gates of word name for the integer value.
+
+        :rtype: dictionnary {input_gate_id: 0/1}
+        """
+        word = dict(self.inputs)[name]
+        return dict((w, (value >> i) & 1) for i, w in enumerate(word))
+
+    def output_value(self, state, name):
+        """Integer value of output word name in the state of an evaluation."""
+        word = dict(self.outputs)[name]
+        return sum(state["%s[%d]" % (name, i)] << i for i in range(len(word)))
+
+
+# ---- Templates ----
+
+
+def _build_add(b, x, y, carry_out, carry=None):
+    if carry is None:
+        carry = b.const(0)
+    res = []
+    for i in range(len(x)):
+        if i == len(x) - 1 and not carry_out:
+            res.append(b.xor(b.xor(x[i], y[i]), carry))
+        else:
+            s, carry = b._full_adder(x[i], y[i], carry)
+            res.append(s)
+    if carry_out:
+        res.append(carry)
+    return res
+
+
+def _build_sub(b, x, y):
+    # x - y == x + ~y + 1
+    return _build_add(b, x, [b.not_(w) for w in y], False, b.const(1))
+
+
+def _build_lt(b, x, y):
+    # carry out of x + ~y + 1 is x >= y
+    res = _build_add(b, x, [b.not_(w) for w in y], True, b.const(1))
+    return [b.not_(res[-1])]
+
+
+def _build_eq(b, x, y):
+    res = b.const(1)
+    for xi, yi in zip(x, y):
+        res = b.and_(res, b.not_(b.xor(xi, yi)))
+    return [res]
+
+
+def _build_mux(b, s, x, y):
+    s = s[0]
+    return [b.xor(xi, b.and_(s, b.xor(xi, yi))) for xi, yi in zip(x, y)]
+
+
+def _build_mul(b, x, y):
+    n = len(x)
+    res = [b.and_(x[i], y[0]) for i in range(n)]
+    for j in range(1, n):
+        row = [b.and_(x[i], y[j]) for i in range(n - j)]
+        res = res[:j] + b.add(res[j:], row)
+    return res
+
+
+def _build_hamming_weight(b, x):
+    width = max(len(x).bit_length(), 1)
+    columns = [list(x)] + [[] for _ in range(width)]
+    for k in range(width):
+        col = columns[k]
+        while len(col) > 1:
+            if len(col) >= 3:
+                s, c = b._full_adder(col.pop(), col.pop(), col.pop())
+            else:
+                a, c0 = col.pop(), col.pop()
+                s, c = b.xor(a, c0), b.and_(a, c0)
+            col.insert(0, s)
+            columns[k + 1].append(c)
+    return [col[0] if col else b.const(0) for col in columns[:width]]
+
+
+def test_builder():
+    import random
+    from circuit_opt import and_count
+
+    n = 8
+    b = CircuitBuilder()
+    x = b.input("x", n)
+    y = b.input("y", n)
+    s = b.input("s", 1)
+    b.output("add", b.add(x, y))
+    b.output("addc", b.add(x, y, carry_out=True))
+    b.output("sub", b.sub(x, y))
+    b.output("mul", b.mul(x, y))
+    b.output("cmp", [b.lt(x, y), b.gt(x, y), b.le(x, y), b.ge(x, y), b.eq(x, y)])
+    b.output("mux", b.mux(s[0], x, y))
+    b.output("hw", b.hamming_weight(x))
+    circ = b.circuit()
+    mask = 2 ** n - 1
+    for _ in range(50):
+        xv, yv, sv = random.getrandbits(n), random.getrandbits(n), random.getrandbits(1)
+        if random.random() < 0.2:
+            yv = xv
+        inputs = b.input_values("x", xv)
+        inputs.update(b.input_values("y", yv))
+        inputs.update(b.input_values("s", sv))
+        state = circ.evaluate(inputs).state
+        assert b.output_value(state, "add") == (xv + yv) & mask
+        assert b.output_value(state, "addc") == xv + yv
+        assert b.output_value(state, "sub") == (xv - yv) & mask
+        assert b.output_value(state, "mul") == (xv * yv) & mask
+        cmp = [xv < yv, xv > yv, xv <= yv, xv >= yv, xv == yv]
+        cmp = sum(int(c) << i for i, c in enumerate(cmp))
+        assert b.output_value(state, "cmp") == cmp
+        assert b.output_value(state, "mux") == (yv if sv else xv)
+        assert b.output_value(state, "hw") == bin(xv).count("1")
+    for _, gate in six.iteritems(circ.g):
+        assert gate.kind == "INPUT" or not (
+            gate.in0_id in circ.output_gates or gate.in1_id in circ.output_gates
+        )
+
+    # AND counts of the constructions, and template reuse
+    for op, ands in (("add", n - 1), ("lt", n), ("eq", n - 1), ("mux", n)):
+        b = CircuitBuilder()
+        x = b.input("x", n)
+        y = b.input("y", n)
+        if op == "mux":
+            res = b.mux(x[0], x, y)
+        else:
+            res = getattr(b, op)(x, y)
+        b.output("r", res if isinstance(res, list) else [res])
+        circ = b.circuit()
+        # AND(w, w) copies of outputs and the constant 1 are not counted
+        extra = sum(
+            1
+            for gate in six.itervalues(circ.g)
+            if gate.kind not in ("INPUT", "XOR") and gate.in0_id == gate.in1_id
+        )
+        assert and_count(circ) - extra == ands, (op, and_count(circ), extra)
+    assert ("add", (n, n), (False,)) in _TEMPLATES
+
+
+if __name__ == "__main__":
+    test_builder()
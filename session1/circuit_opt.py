@@ -0,0 +1,559 @@
+# -*- coding: utf-8 -*-
+"""
+LELEC2770 : Privacy Enhancing Technologies
+
+Logic circuit optimizer
+
+With free-XOR garbling, only the non-XOR gates of a circuit cost a garbled
+table. The passes of this module rewrite a :class:`logic_circuit.Circuit`
+into an equivalent one with fewer such gates:
+
+- dead gate removal: gates the outputs do not depend on are dropped;
+- common-subexpression elimination: gates of the same kind on the same
+  inputs are merged;
+- XOR/AND rewriting: the circuit is rebuilt as a XOR-AND graph whose edges
+  may be negated. NAND, NOR and OR disappear into negations, constants are
+  folded, and (a & b) ^ (a & c) is factored into a & (b ^ c) when the two
+  ANDs are not used elsewhere.
+
+The input and output gate ids are kept, so that an optimized circuit can be
+used in place of the original one.
+"""
+
+from __future__ import print_function
+
+import random
+
+import six
+
+from logic_circuit import Gate, Circuit, INPUT_GATE
+
+FREE_KINDS = ("INPUT", "XOR")
+# Number of random input assignments used by check_equivalence when the
+# truth table is too large.
+EQUIVALENCE_SAMPLES = 4096
+EQUIVALENCE_MAX_INPUTS = 16
+
+
+def gate_counts(circuit):
+    """Number of gates of each kind.
+
+    :rtype: dictionnary {kind: count}
+    """
+    counts = dict((kind, 0) for kind in Gate.KINDS)
+    for gate in six.itervalues(circuit.g):
+        counts[gate.kind] += 1
+    return counts
+
+
+def and_count(circuit):
+    """Number of non-free gates (all but INPUT and XOR)."""
+    return sum(
+        1 for gate in six.itervalues(circuit.g) if gate.kind not in FREE_KINDS
+    )
+
+
+def _input_ids(circuit):
+    return [
+        g_id
+        for g_id in circuit.compile().ids
+        if circuit.g[g_id].kind == "INPUT"
+    ]
+
+
+# ---- Dead gates and CSE ----
+
+
+def remove_dead_gates(circuit):
+    """Drop the gates the outputs do not depend on (input gates are kept).
+
+    :rtype: Circuit
+    """
+    g = dict(
+        (g_id, gate) for g_id, gate in six.iteritems(circuit.g) if gate.kind == "INPUT"
+    )
+    for g_id in circuit.output_cone():
+        g[g_id] = circuit.g[g_id]
+    return Circuit(g, set(circuit.output_gates))
+
+
+def eliminate_common_subexpressions(circuit):
+    """Merge the gates of the same kind with the same inputs (in any order).
+
+    Output gates are neither merged away nor used in place of other gates:
+    the garbled circuits require that no gate depends on an output gate.
+
+    :rtype: Circuit
+    """
+    alias = {}
+    seen = {}
+    g = {}
+    for g_id in circuit.ordered_gates():
+        gate = circuit.g[g_id]
+        if gate.kind == "INPUT":
+            g[g_id] = gate
+            continue
+        in0 = alias.get(gate.in0_id, gate.in0_id)
+        in1 = alias.get(gate.in1_id, gate.in1_id)
+        key = (gate.kind, frozenset((in0, in1)))
+        if g_id not in circuit.output_gates:
+            if key in seen:
+                alias[g_id] = seen[key]
+                continue
+            seen[key] = g_id
+        g[g_id] = gate if (in0, in1) == (gate.in0_id, gate.in1_id) else Gate(
+            gate.kind, in0, in1
+        )
+    return remove_dead_gates(Circuit(g, set(circuit.output_gates)))
+
+
+# ---- XOR-AND graph ----
+
+# A literal is a pair (node, negated). Node None is the constant 0, hence
+# (None, True) is the constant 1.
+ZERO = (None, False)
+ONE = (None, True)
+
+
+def _neg(lit):
+    return (lit[0], not lit[1])
+
+
+class _XAG:
+    """Hash-consed XOR-AND graph
+
+    Nodes are ("INPUT", g_id), ("AND", lit0, lit1) or ("XOR", node0, node1),
+    numbered in creation order (hence topologically). The negations of the
+    operands of a XOR are moved to its output literal.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.table = {}
+
+    def _node(self, key):
+        node = self.table.get(key)
+        if node is None:
+            node = len(self.nodes)
+            self.nodes.append(key)
+            self.table[key] = node
+        return node
+
+    def input(self, g_id):
+        return (self._node(("INPUT", g_id)), False)
+
+    def and_(self, a, b):
+        if a[0] is None:
+            return b if a[1] else ZERO
+        if b[0] is None:
+            return a if b[1] else ZERO
+        if a[0] == b[0]:
+            return a if a[1] == b[1] else ZERO
+        a, b = min(a, b), max(a, b)
+        return (self._node(("AND", a, b)), False)
+
+    def xor(self, a, b):
+        neg = a[1] != b[1]
+        if a[0] is None:
+            return (b[0], neg)
+        if b[0] is None:
+            return (a[0], neg)
+        if a[0] == b[0]:
+            return (None, neg)
+        n0, n1 = min(a[0], b[0]), max(a[0], b[0])
+        return (self._node(("XOR", n0, n1)), neg)
+
+    def gate(self, kind, a, b):
+        if kind == "AND":
+            return self.and_(a, b)
+        elif kind == "NAND":
+            return _neg(self.and_(a, b))
+        elif kind == "OR":
+            return _neg(self.and_(_neg(a), _neg(b)))
+        elif kind == "NOR":
+            return self.and_(_neg(a), _neg(b))
+        elif kind == "XOR":
+            return self.xor(a, b)
+        else:
+            assert False
+
+    def fanout(self, roots):
+        """Number of uses of each node reachable from the literals roots."""
+        count = [0] * len(self.nodes)
+        for node, _ in roots:
+            if node is not None:
+                count[node] += 1
+        for node in range(len(self.nodes) - 1, -1, -1):
+            key = self.nodes[node]
+            if count[node] == 0 or key[0] == "INPUT":
+                continue
+            if key[0] == "AND":
+                operands = (key[1][0], key[2][0])
+            else:
+                operands = key[1:]
+            for op in operands:
+                count[op] += 1
+        return count
+
+    def factor(self, outputs, names):
+        """Copy of the graph where (a & b) ^ (a & c) is replaced by
+        a & (b ^ c) when both ANDs have no other use.
+
+        :returns: the new graph, outputs and names
+        """
+        fanout = self.fanout(outputs.values())
+        res = _XAG()
+        new = {}
+
+        def lit(l):
+            if l[0] is None:
+                return l
+            node, neg = new[l[0]]
+            return (node, neg != l[1])
+
+        def factored(n0, n1):
+            key0, key1 = self.nodes[n0], self.nodes[n1]
+            if key0[0] != "AND" or key1[0] != "AND":
+                return None
+            if fanout[n0] != 1 or fanout[n1] != 1:
+                return None
+            for common, x in ((key0[1], key0[2]), (key0[2], key0[1])):
+                for other, y in ((key1[1], key1[2]), (key1[2], key1[1])):
+                    if common == other:
+                        return res.and_(lit(common), res.xor(lit(x), lit(y)))
+            return None
+
+        for node, key in enumerate(self.nodes):
+            if key[0] == "INPUT":
+                new[node] = res.input(key[1])
+            elif key[0] == "AND":
+                new[node] = res.and_(lit(key[1]), lit(key[2]))
+            else:
+                new[node] = factored(key[1], key[2]) or res.xor(
+                    lit((key[1], False)), lit((key[2], False))
+                )
+        new_names = {}
+        for node, name in six.iteritems(names):
+            l = new[node]
+            if l[0] is not None and not l[1]:
+                new_names.setdefault(l[0], name)
+        outputs = dict((out, lit(l)) for out, l in six.iteritems(outputs))
+        return res, outputs, new_names
+
+
+def _circuit_to_xag(circuit):
+    xag = _XAG()
+    lits = {}
+    names = {}
+    for g_id in _input_ids(circuit):
+        lits[g_id] = xag.input(g_id)
+    for g_id in circuit.output_cone():
+        gate = circuit.g[g_id]
+        if gate.kind == "INPUT":
+            continue
+        lit = xag.gate(gate.kind, lits[gate.in0_id], lits[gate.in1_id])
+        lits[g_id] = lit
+        if lit[0] is not None and not lit[1] and g_id not in circuit.output_gates:
+            names.setdefault(lit[0], g_id)
+    outputs = dict((g_id, lits[g_id]) for g_id in circuit.output_gates)
+    return xag, outputs, names
+
+
+# Kind of the gate computing ((x ^ na) & (y ^ nb)) ^ nout for na == nb,
+# indexed by (na, nout).
+_AND_KINDS = {(0, 0): "AND", (0, 1): "NAND", (1, 0): "NOR", (1, 1): "OR"}
+
+
+def _xag_to_circuit(circuit, xag, outputs, names):
+    """Emit a Circuit computing outputs (literals of xag).
+
+    Each node is emitted once, as a gate computing either the node or its
+    negation (the polarity of the wire): the negations of the literals are
+    folded into the kind of the AND gates using them (AND, NAND, OR, NOR),
+    and XOR gates just carry them. The polarity of an AND node is chosen to
+    suit most of its uses. Outputs that cannot be gates of their own nodes
+    are XOR copies with a constant wire: XOR(w, zero) is free, only one
+    non-free gate (the constant one) is spent for all the negated copies.
+    """
+    input_ids = _input_ids(circuit)
+    used_ids = set(circuit.g)
+    g = dict((g_id, INPUT_GATE) for g_id in input_ids)
+    counter = [0]
+
+    def fresh():
+        while True:
+            counter[0] += 1
+            g_id = "_opt%d" % counter[0]
+            if g_id not in used_ids:
+                used_ids.add(g_id)
+                return g_id
+
+    live = xag.fanout(outputs.values())
+    # number of negated and plain uses of each node
+    uses = [[0, 0] for _ in xag.nodes]
+    for node, neg in six.itervalues(outputs):
+        if node is not None:
+            uses[node][neg] += 1
+    for node, key in enumerate(xag.nodes):
+        if live[node] and key[0] == "AND":
+            for op, neg in key[1:]:
+                uses[op][neg] += 1
+    # An output gets the name of its node when nothing else uses the node
+    # (output gates cannot be used as inputs of other gates).
+    claim = {}
+    for out in circuit.compile().ids:
+        if out not in outputs:
+            continue
+        node, neg = outputs[out]
+        if node is None or live[node] != 1 or xag.nodes[node][0] == "INPUT":
+            continue
+        claim[node] = (out, neg)
+    emitted = {}
+
+    def emit(kind, in0, in1, g_id=None):
+        key = (kind, frozenset((in0, in1)))
+        if g_id is None and key in emitted:
+            return emitted[key]
+        if g_id is None:
+            g_id = fresh()
+        g[g_id] = Gate(kind, in0, in1)
+        if g_id not in outputs:
+            emitted.setdefault(key, g_id)
+        return g_id
+
+    # node -> (gate id, polarity): the gate computes node ^ polarity
+    wire = {}
+    for node, key in enumerate(xag.nodes):
+        if key[0] == "INPUT":
+            wire[node] = (key[1], 0)
+            continue
+        if not live[node]:
+            continue
+        if node in claim:
+            g_id, want = claim[node]
+        else:
+            g_id = names.get(node)
+            if g_id is None or g_id in g:
+                g_id = fresh()
+            want = int(uses[node][1] > uses[node][0])
+        if key[0] == "XOR":
+            (w0, p0), (w1, p1) = wire[key[1]], wire[key[2]]
+            if node in claim and p0 ^ p1 != want:
+                # fixed by an output copy
+                del claim[node]
+                g_id = fresh()
+            emit("XOR", w0, w1, g_id)
+            wire[node] = (g_id, p0 ^ p1)
+            continue
+        (a, neg_a), (b, neg_b) = key[1], key[2]
+        (wa, pa), (wb, pb) = wire[a], wire[b]
+        pa ^= neg_a
+        pb ^= neg_b
+        if pa == pb:
+            emit(_AND_KINDS[pa, want], wa, wb, g_id)
+        else:
+            # wa & ~wb == wa ^ (wa & wb), and its negation is wa ^ ~(wa & wb)
+            if pa:
+                wa, wb = wb, wa
+            emit("XOR", wa, emit(_AND_KINDS[0, want], wa, wb), g_id)
+        wire[node] = (g_id, want)
+
+    consts = {}
+
+    def const_wire(v):
+        if v not in consts:
+            assert input_ids, "constant circuit without inputs"
+            if v:
+                consts[1] = emit("NOR", const_wire(0), const_wire(0))
+            else:
+                consts[0] = emit("XOR", input_ids[0], input_ids[0])
+        return consts[v]
+
+    for out, (node, neg) in six.iteritems(outputs):
+        if node in claim and claim[node][0] == out:
+            continue
+        if node is None:
+            if neg:
+                emit("XOR", const_wire(1), const_wire(0), out)
+            else:
+                emit("XOR", input_ids[0], input_ids[0], out)
+            continue
+        w, p = wire[node]
+        key = xag.nodes[node]
+        if key[0] == "XOR" and wire[key[1]][1] ^ wire[key[2]][1] == neg:
+            # duplicate of the XOR gate
+            emit("XOR", wire[key[1]][0], wire[key[2]][0], out)
+        else:
+            emit("XOR", w, const_wire(p ^ neg), out)
+    return Circuit(g, set(circuit.output_gates))
+
+
+def rewrite_xor_and(circuit, max_rounds=4):
+    """Rebuild circuit as a XOR-AND graph and emit it back.
+
+    This folds constants (e.g. XOR(a, a), AND(a, NOR(a, a))), turns
+    NAND/NOR/OR into AND with negations, merges common subexpressions and
+    factors (a & b) ^ (a & c) into a & (b ^ c) when both ANDs have no other
+    use. Factoring is repeated until the number of non-free gates stops
+    decreasing (at most max_rounds times).
+
+    :returns: the rewritten circuit, or circuit itself if the rewriting does
+        not reduce the number of non-free gates
+    :rtype: Circuit
+    """
+    xag, outputs, names = _circuit_to_xag(circuit)
+    best = circuit
+    for i in range(max_rounds + 1):
+        if i:
+            xag, outputs, names = xag.factor(outputs, names)
+        res = _xag_to_circuit(circuit, xag, outputs, names)
+        if and_count(res) < and_count(best):
+            best = res
+        elif best is not circuit:
+            break
+    return best
+
+
+# ---- Pipeline ----
+
+PASSES = {
+    "dead_gates": remove_dead_gates,
+    "cse": eliminate_common_subexpressions,
+    "xor_and": rewrite_xor_and,
+}
+DEFAULT_PIPELINE = ("dead_gates", "cse", "xor_and")
+
+
+def check_equivalence(circuit1, circuit2, samples=EQUIVALENCE_SAMPLES):
+    """Check that two circuits with the same inputs compute the same outputs.
+
+    All the input assignments are tried when there are at most
+    EQUIVALENCE_MAX_INPUTS inputs, otherwise samples random ones (using
+    bit-sliced evaluation in both cases).
+
+    :rtype: bool
+    """
+    inputs1 = sorted(_input_ids(circuit1), key=repr)
+    inputs2 = sorted(_input_ids(circuit2), key=repr)
+    if inputs1 != inputs2 or circuit1.output_gates != circuit2.output_gates:
+        return False
+    if len(inputs1) <= EQUIVALENCE_MAX_INPUTS:
+        _, out1 = circuit1.truth_table(inputs1)
+        _, out2 = circuit2.truth_table(inputs1)
+    else:
+        words = dict((g_id, random.getrandbits(samples)) for g_id in inputs1)
+        out1 = circuit1.evaluate_sliced(words, samples)
+        out2 = circuit2.evaluate_sliced(words, samples)
+    return out1 == out2
+
+
+class OptimizationReport:
+    """Gate counts before and after each pass of :func:`optimize`
+
+    Attributes:
+    * steps: list of (pass name, gate count, non-free gate count), the first
+      one being ("input", ...)
+    * before, after: gate_counts of the input and output circuits
+    """
+
+    def __init__(self, circuit):
+        self.steps = []
+        self.before = gate_counts(circuit)
+        self.after = self.before
+        self.add("input", circuit)
+
+    def add(self, name, circuit):
+        self.steps.append((name, len(circuit.g), and_count(circuit)))
+        self.after = gate_counts(circuit)
+
+    @property
+    def and_before(self):
+        return self.steps[0][2]
+
+    @property
+    def and_after(self):
+        return self.steps[-1][2]
+
+    def __str__(self):
+        lines = ["%-12s %8s %8s" % ("pass", "gates", "non-XOR")]
+        lines.extend("%-12s %8d %8d" % step for step in self.steps)
+        return "\n".join(lines)
+
+
+def optimize(circuit, pipeline=DEFAULT_PIPELINE, check=True):
+    """Run the passes of pipeline (names of PASSES) on circuit.
+
+    :param check: check that the result is equivalent to circuit
+    :returns: the optimized circuit (circuit itself if the passes do not
+        reduce its number of non-free gates) and a report
+    :rtype: (Circuit, OptimizationReport)
+    """
+    report = OptimizationReport(circuit)
+    res = circuit
+    for name in pipeline:
+        res = PASSES[name](res)
+        report.add(name, res)
+    if and_count(res) >= and_count(circuit):
+        res = circuit
+        report.add("keep input", res)
+    if check:
+        assert check_equivalence(circuit, res), "optimized circuit differs"
+    return res, report
+
+
+def test_optimize():
+    from prs import prs_circuit
+
+    opt, report = optimize(prs_circuit)
+    assert report.and_before == 6 and report.and_after == 4
+    assert opt.output_gates == prs_circuit.output_gates
+
+    circ = Circuit(
+        {
+            "a": INPUT_GATE,
+            "b": INPUT_GATE,
+            "c": INPUT_GATE,
+            "dead": Gate("AND", "a", "c"),
+            "ab": Gate("AND", "a", "b"),
+            "ba": Gate("AND", "b", "a"),
+            "zero": Gate("XOR", "ab", "ba"),
+            "na": Gate("NAND", "a", "a"),
+            "or": Gate("OR", "na", "zero"),
+            "nor": Gate("NOR", "or", "c"),
+            "out0": Gate("OR", "ab", "nor"),
+            "out1": Gate("XOR", "zero", "zero"),
+            "out2": Gate("NAND", "ab", "ba"),
+        },
+        {"out0", "out1", "out2"},
+    )
+    opt, report = optimize(circ)
+    assert "dead" not in opt.g
+    assert report.and_after < report.and_before
+
+    for _ in range(20):
+        g = {}
+        for i in range(8):
+            g[i] = INPUT_GATE
+        for i in range(8, 80):
+            g[i] = Gate(
+                random.choice(Gate.KINDS[1:]), random.randrange(i), random.randrange(i)
+            )
+        outputs = set()
+        for i in random.sample(range(40, 80), 5):
+            g["out%d" % i] = Gate(random.choice(Gate.KINDS[1:]), i, i - 1)
+            outputs.add("out%d" % i)
+        circ = Circuit(g, outputs)
+        opt, report = optimize(circ)
+        assert report.and_after <= report.and_before
+        for g_id, gate in six.iteritems(opt.g):
+            assert gate.in0_id not in outputs and gate.in1_id not in outputs
+
+    # negations and output copies cost nothing
+    circ = Circuit({0: INPUT_GATE, 2: INPUT_GATE, 3: Gate("OR", 0, 2), 4: Gate("NAND", 3, 2)}, {3, 4})
+    opt, report = optimize(circ)
+    assert report.and_after <= report.and_before == 2
+    assert and_count(rewrite_xor_and(circ)) <= 2
+
+
+if __name__ == "__main__":
+    test_optimize()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+LELEC2770 : Privacy Enhancing Technologies
+
+Persistent discrete log tables
+
+The baby-step table of :class:`elgamal.DLogTable` is stored on disk as a
+sorted array of fixed-width records (fingerprint of g^j, j) and mapped
+read-only in memory, so that all the processes decrypting under the same
+group share a single page-cached copy and do not rebuild it.
+
+File layout (big-endian):
+
+- header: magic, version, directory bits, m, bound, SHA256 digest of (g, p, q)
+- directory: 2**dir_bits + 1 record indices, one bucket per fingerprint
+  prefix
+- records: m records (fingerprint: 8 bytes, j: 4 bytes) sorted by
+  fingerprint
+"""
+
+import binascii
+import mmap
+import os
+import struct
+
+import gmpy
+from Crypto.Hash import SHA256
+
+import elgamal
+
+MAGIC = b"EGDL"
+VERSION = 1
+HEADER = struct.Struct(">4sHHQQ32s")
+DIRECTORY_ENTRY = struct.Struct(">I")
+RECORD = struct.Struct(">QI")
+FINGERPRINT_BITS = 64
+FINGERPRINT_MASK = 2 ** FINGERPRINT_BITS - 1
+
+
+def group_digest(G):
+    """SHA256 digest identifying the group parameters G = (g, p, q).
+
+    :rtype: bytes
+    """
+    g, p, q = G
+    return SHA256.new(("%d,%d,%d" % (g, p, q)).encode("ascii")).digest()
+
+
+def table_path(directory, G, bound=2 ** 20):
+    """Canonical path of the table for G and bound in directory."""
+    name = "%s-%d.dlog" % (binascii.hexlify(group_digest(G)).decode("ascii"), bound)
+    return os.path.join(directory, name)
+
+
+def build_table(path, G, bound=2 ** 20):
+    """Build the table for G and bound, and write it at path.
+
+    The file is written next to path and then renamed, so that concurrent
+    readers never see a partial table.
+
+    :returns: path
+    """
+    g, p, q = G
+    g = int(g)
+    p = int(p)
+    m = elgamal._ceil_sqrt(bound)
+    if m >= 2 ** 32:
+        raise ValueError("bound too large for the table format")
+    dir_bits = max(m.bit_length() - 1, 0)
+    records = []
+    seen = set()
+    a = 1
+    for j in range(m):
+        # keep the smallest exponent if g has a small order
+        if a not in seen:
+            seen.add(a)
+            records.append((a & FINGERPRINT_MASK, j))
+        a = a * g % p
+    records.sort()
+
+    directory = [0] * (2 ** dir_bits + 1)
+    shift = FINGERPRINT_BITS - dir_bits
+    for fp, _ in records:
+        directory[(fp >> shift) + 1] += 1
+    for i in range(1, len(directory)):
+        directory[i] += directory[i - 1]
+
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, dir_bits, m, bound, group_digest(G)))
+        f.write(b"".join(DIRECTORY_ENTRY.pack(d) for d in directory))
+        f.write(b"".join(RECORD.pack(fp, j) for fp, j in records))
+    os.rename(tmp_path, path)
+    return path
+
+
+class MappedDLogTable:
+    """Read-only memory-mapped baby-step giant-step table
+
+    Same interface as :class:`elgamal.DLogTable`.
+
+    :param path: table file created by :func:`build_table`
+    :param G: group parameters (g, p, q) the table must have been built for
+    :raises ValueError: if the file is not a table for G
+    """
+
+    def __init__(self, path, G):
+        g, p, q = G
+        self.p = int(p)
+        self.g = int(g)
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header(G)
+        except Exception:
+            self.map.close()
+            raise
+
+    def _read_header(self, G):
+        path = self.path
+        if len(self.map) < HEADER.size:
+            raise ValueError("truncated dlog table: %s" % path)
+        magic, version, dir_bits, m, bound, digest = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a dlog table: %s" % path)
+        if digest != group_digest(G):
+            raise ValueError("dlog table %s was built for another group" % path)
+        self.dir_bits = dir_bits
+        self.m = m
+        self.bound = bound
+        self._shift = FINGERPRINT_BITS - dir_bits
+        self._dir_offset = HEADER.size
+        self._rec_offset = self._dir_offset + (2 ** dir_bits + 1) * DIRECTORY_ENTRY.size
+        if len(self.map) < self._rec_offset:
+            raise ValueError("truncated dlog table: %s" % path)
+        self.count = self._dir_entry(2 ** dir_bits)
+        if len(self.map) != self._rec_offset + self.count * RECORD.size:
+            raise ValueError("truncated dlog table: %s" % path)
+        self.giant = int(gmpy.invert(pow(self.g, m, self.p), self.p))
+
+    def _dir_entry(self, i):
+        return DIRECTORY_ENTRY.unpack_from(
+            self.map, self._dir_offset + i * DIRECTORY_ENTRY.size
+        )[0]
+
+    def _record(self, i):
+        return RECORD.unpack_from(self.map, self._rec_offset + i * RECORD.size)
+
+    def lookup(self, a):
+        """Return the candidate exponents j such that g^j may be a.
+
+        Candidates only share the fingerprint of a and must be checked.
+        """
+        fp = a & FINGERPRINT_MASK
+        b = fp >> self._shift
+        res = []
+        for i in range(self._dir_entry(b), self._dir_entry(b + 1)):
+            rec_fp, j = self._record(i)
+            if rec_fp == fp:
+                res.append(j)
+            elif rec_fp > fp:
+                break
+        return res
+
+    def solve(self, g_m):
+        """Compute the discrete log of g_m.
+
+        :returns: the discrete log or None if there is none below bound
+        """
+        target = int(g_m) % self.p
+        h = target
+        for i in range(0, self.bound, self.m):
+            for j in self.lookup(h):
+                if i + j < self.bound and pow(self.g, i + j, self.p) == target:
+                    return i + j
+            h = h * self.giant % self.p
+        return None
+
+    def close(self):
+        """Unmap the table, and unregister it if it is registered."""
+        elgamal.unregister_dlog_table(self)
+        self.map.close()
+
+
+def load_table(path, G, register=True):
+    """Map the table at path, and by default register it so that
+    :func:`elgamal.dLog` and :meth:`elgamal.ElgamalSecretKey.decrypt` use it.
+
+    :rtype: MappedDLogTable
+    """
+    table = MappedDLogTable(path, G)
+    if register:
+        elgamal.register_dlog_table(table)
+    return table
+
+
+def load_or_build_table(directory, G, bound=2 ** 20, register=True):
+    """Load the table for G and bound from directory, building it first if
+    it does not exist yet.
+
+    :rtype: MappedDLogTable
+    """
+    path = table_path(directory, G, bound)
+    if not os.path.exists(path):
+        build_table(path, G, bound)
+    return load_table(path, G, register)
+
+
+def verify_table(path, G):
+    """Check that the table at path is well-formed and correct for G.
+
+    Every record is recomputed, which costs about m group operations.
+
+    :rtype: bool
+    """
+    try:
+        table = MappedDLogTable(path, G)
+    except ValueError:
+        return False
+    try:
+        prev = -1
+        for b in range(2 ** table.dir_bits):
+            start, end = table._dir_entry(b), table._dir_entry(b + 1)
+            if start > end:
+                return False
+            for i in range(start, end):
+                fp, j = table._record(i)
+                if fp < prev or fp >> table._shift != b or j >= table.m:
+                    return False
+                if pow(table.g, j, table.p) & FINGERPRINT_MASK != fp:
+                    return False
+                prev = fp
+        distinct = set()
+        a = 1
+        for j in range(table.m):
+            distinct.add(a)
+            a = a * table.g % table.p
+        return table.count == len(distinct)
+    finally:
+        table.close()
+
+
+def test_dlog_store():
+    import shutil
+    import tempfile
+
+    pk, sk = elgamal.elgamal_param_gen()
+    g, p, q = pk.G
+    directory = tempfile.mkdtemp()
+    table = load_or_build_table(directory, pk.G)
+    assert verify_table(table.path, pk.G)
+    for m in (0, 1, 1023, 1024, 2 ** 20 - 1):
+        assert table.solve(pow(g, m, p)) == m
+        assert sk.decrypt(pk.encrypt(m)) == m
+    assert table.solve(pow(g, 2 ** 20, p)) is None
+    other_pk, _ = elgamal.elgamal_param_gen()
+    try:
+        MappedDLogTable(table.path, other_pk.G)
+        assert False
+    except ValueError:
+        pass
+    assert not verify_table(table.path, other_pk.G)
+    # truncated copies are rejected with ValueError
+    with open(table.path, "rb") as f:
+        data = f.read()
+    truncated = os.path.join(directory, "truncated")
+    for n in (1, HEADER.size, HEADER.size + DIRECTORY_ENTRY.size, len(data) - 1):
+        with open(truncated, "wb") as f:
+            f.write(data[:n])
+        try:
+            MappedDLogTable(truncated, pk.G)
+            assert False
+        except ValueError:
+            pass
+    # a closed table is not used any more
+    table.close()
+    assert table not in elgamal._REGISTERED_DLOG_TABLES.values()
+    assert sk.decrypt(pk.encrypt(1024)) == 1024
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test_dlog_store()
@@ -5,15 +5,65 @@ LELEC2770 : Privacy Enhancing Technologies
 El Gamal encryption library
 """
 
+import collections
+import math
+import threading
+
 import gmpy
-from Crypto.Random.random import randint
+from six.moves import queue
+from Crypto.Random.random import randint, getrandbits
 from Crypto.Hash import SHA256
+from Crypto.Util.number import bytes_to_long
 
+# Default bit length of the plaintexts, bounded by the cost of the discrete
+# log needed at decryption.
+MSG_BITS = 20
 
-def elgamal_param_gen():
-    """Generate an El Gamal keypair
+# Memory bound (number of group elements) of a fixed-base exponentiation
+# table, number of exponentiations with a base before its table is built, and
+# minimum modulus size for which the table beats the builtin pow (see
+# bench_fixed_base).
+FIXED_BASE_MAX_ENTRIES = 4096
+FIXED_BASE_THRESHOLD = 2
+FIXED_BASE_MIN_BITS = 256
 
-    :rtype: (ElgamalPublicKey, ElgamalSecretKey)
+# Bit length of the random exponents of the batch proof verification: a batch
+# containing a bad proof passes with probability at most 2^-BATCH_CHECK_BITS.
+BATCH_CHECK_BITS = 64
+
+
+def _named_group(p):
+    q = (p - 1) // 2
+    # 4 = 2^2 is a square, hence a generator of the subgroup of order q.
+    return gmpy.mpz(4), gmpy.mpz(p), gmpy.mpz(q)
+
+
+# Fixed safe-prime groups (g, p, q), p = 2q + 1, g of order q.
+GROUPS = {
+    "safe66": _named_group(0x3236EB09444CB6423),
+    "safe512": _named_group(
+        int(
+            "EBA9C699C5D4BA9201658B2247D2AC5BCF6E979F42499885CFAB4F90D586CF30"
+            "BAC899AB352B21123E69F38202D8D7609147FB761407D82DB1FC82FD5EE3BF37",
+            16,
+        )
+    ),
+    "safe1024": _named_group(
+        int(
+            "A5FC694C7F5FBD4EFFA0C54503BF00B8FD759FFF1F8AE8784E1EDA3420356BE5"
+            "3E65C6F3987D88D61BFF84FFC37AA72BCD30069AC8D940123D9D740E91922BA2"
+            "A6D26C5117DEDD89B98705E84C68B92AD8EB32E8529D5AC68649B05EB9561032"
+            "0D43DE238141CC2A7C0D8F9120C8557855E4D03AC0BEA36435B493C1DB929677",
+            16,
+        )
+    ),
+}
+
+
+def elgamal_group_gen():
+    """Generate fresh El Gamal group parameters (prime search).
+
+    :rtype: (g, p, q)
     """
     p = 4
     while not gmpy.is_prime(p):
@@ -24,20 +74,171 @@ def elgamal_param_gen():
     g_prime = randint(1, int(p - 1))
     g = pow(g_prime, 2, p)  # generator of the group
     assert pow(g, q, p) == 1
-    G = g, p, q
+    return g, p, q
+
+
+def elgamal_param_gen(msg_bits=MSG_BITS, G=None):
+    """Generate an El Gamal keypair
+
+    :param msg_bits: maximum bit length of the plaintexts
+    :param G: group parameters (g, p, q) or name of a group of GROUPS to use.
+        By default, fresh group parameters are generated, which requires a
+        prime search.
+    :rtype: (ElgamalPublicKey, ElgamalSecretKey)
+    """
+    if G is None:
+        G = elgamal_group_gen()
+    elif not isinstance(G, tuple):
+        G = GROUPS[G]
+    g, p, q = G
     x = randint(1, int(q - 1))  # secret key
     y = pow(g, x, p)  # public key
-    pk = ElgamalPublicKey(G, y)
-    sk = ElgamalSecretKey(G, x)
+    pk = ElgamalPublicKey(G, y, msg_bits)
+    sk = ElgamalSecretKey(G, x, msg_bits)
     return pk, sk
 
 
+class KeyPool:
+    """Pool of El Gamal keypairs generated ahead of time
+
+    A background thread keeps up to size keypairs ready, so that get does not
+    wait for a prime search. When the pool is empty, get generates a keypair
+    on the spot (a miss).
+
+    :param size: number of keypairs to keep ready
+    :param G: group parameters or group name to use for all the keypairs
+        (fresh secrets only), None for fresh group parameters for each one
+    :param msg_bits: maximum bit length of the plaintexts
+    """
+
+    def __init__(self, size=16, G=None, msg_bits=MSG_BITS):
+        self.G = G
+        self.msg_bits = msg_bits
+        self.hits = 0
+        self.misses = 0
+        self._queue = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self):
+        while not self._stop.is_set():
+            keypair = elgamal_param_gen(self.msg_bits, self.G)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(keypair, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """Take a keypair from the pool.
+
+        :rtype: (ElgamalPublicKey, ElgamalSecretKey)
+        """
+        try:
+            keypair = self._queue.get_nowait()
+            self.hits += 1
+        except queue.Empty:
+            keypair = elgamal_param_gen(self.msg_bits, self.G)
+            self.misses += 1
+        return keypair
+
+    def ready(self):
+        """Number of keypairs currently in the pool."""
+        return self._queue.qsize()
+
+    def stop(self):
+        """Stop the background generation."""
+        self._stop.set()
+        self._thread.join()
+
+
+class ProofPool:
+    """Pool of verifiability proof precomputations
+
+    Precomputations (see :meth:`ElgamalPublicKey.proof_precomputation`) are
+    made ahead of time by fill, e.g. while waiting for the ciphertexts, so
+    that proving only costs two exponentiations. When the pool is empty, take
+    computes one on the spot (a miss).
+
+    :param pk: public key the proofs are made for
+    """
+
+    def __init__(self, pk):
+        self.pk = pk
+        self.precomputations = []
+        self.hits = 0
+        self.misses = 0
+
+    def fill(self, n):
+        """Add n precomputations to the pool."""
+        self.precomputations.extend(self.pk.proof_precomputation() for _ in range(n))
+
+    def take(self):
+        if self.precomputations:
+            self.hits += 1
+            return self.precomputations.pop()
+        self.misses += 1
+        return self.pk.proof_precomputation()
+
+    def __len__(self):
+        return len(self.precomputations)
+
+
+class _PrecomputedProofs:
+    """ProofPool-like list of precomputations, None for missing ones."""
+
+    def __init__(self, precomputations, pk):
+        self.precomputations = list(reversed(precomputations))
+        self.pk = pk
+
+    def take(self):
+        pre = self.precomputations.pop()
+        if pre is None:
+            pre = self.pk.proof_precomputation()
+        return pre
+
+
 class ElgamalPublicKey:
-    """El Gamal public key"""
+    """El Gamal public key
 
-    def __init__(self, G, y):
+    :param msg_bits: maximum bit length of the plaintexts
+    """
+
+    def __init__(self, G, y, msg_bits=MSG_BITS):
         self.G = G
         self.y = y
+        self.msg_bits = msg_bits
+        self._fixed_bases = {}
+        self._fixed_base_uses = {}
+        self._hash_prefix = None
+
+    def _fixed_base_pow(self, base, e):
+        """Compute base^e mod p with a lazily built FixedBaseExp table.
+
+        :param base: "g" or "y"
+        """
+        table = self._fixed_bases.get(base)
+        if table is None:
+            g, p, q = self.G
+            b = g if base == "g" else self.y
+            uses = self._fixed_base_uses.get(base, 0) + 1
+            self._fixed_base_uses[base] = uses
+            if uses < FIXED_BASE_THRESHOLD or int(p).bit_length() < FIXED_BASE_MIN_BITS:
+                return pow(b, e % q, p)
+            table = FixedBaseExp(b, p, q)
+            self._fixed_bases[base] = table
+        return table.pow(e)
+
+    def __getstate__(self):
+        # Fixed-base tables are cheaper to rebuild than to transfer.
+        state = self.__dict__.copy()
+        state["_fixed_bases"] = {}
+        state["_fixed_base_uses"] = {}
+        state["_hash_prefix"] = None
+        return state
 
     def random(self):
         """Generate a random group element."""
@@ -54,60 +255,171 @@ class ElgamalPublicKey:
         """
         if r == None:
             r = self.random()
-        # Message length must be less than 20 bits. @students: Why is it so ?
-        assert len(format(m, "b")) <= 20
+        # Message length must be less than msg_bits (20 by default) bits.
+        # @students: Why is it so ?
+        assert len(format(m, "b")) <= self.msg_bits
         g = self.G[0]
         p = self.G[1]
 
         if r < 0:
             r = p - r
-        c1 = pow(g, r, p)
-        c2 = (pow(g, m, p) * pow(self.y, r, p)) % p
+        c1 = self._fixed_base_pow("g", r)
+        c2 = (self._fixed_base_pow("g", m) * self._fixed_base_pow("y", r)) % p
+
+        return ElgamalCiphertext(p, c1, c2)
+
+    def encrypt_many(self, ms, rs=None, workers=None):
+        """Encrypt a batch of messages.
 
+        The fixed-base tables of g and y are built upfront and shared by the
+        whole batch.
+
+        :param ms: plaintexts
+        :param rs: optionnal random group elements, one per plaintext
+        :param workers: if not None, number of processes to spread the batch
+            over
+        :type ms: list of int
+        :rtype: list of ElgamalCiphertext, in the order of ms
+        """
+        if rs is None:
+            rs = [None] * len(ms)
+        assert len(rs) == len(ms)
+        items = list(zip(ms, rs))
+        if workers is not None and workers > 1 and len(items) > 1:
+            return _parallel_map(_encrypt_chunk, self, items, workers)
+        for base in ("g", "y"):
+            uses = self._fixed_base_uses.get(base, 0)
+            self._fixed_base_uses[base] = max(uses, FIXED_BASE_THRESHOLD - 1)
+        return [self.encrypt(m, r) for m, r in items]
+
+    def _commit(self, m, r):
+        """Encryption of m with randomness r, without bound on m (commitments
+        of the verifiability proof)."""
+        p = self.G[1]
+        c1 = self._fixed_base_pow("g", r)
+        c2 = (self._fixed_base_pow("g", m) * self._fixed_base_pow("y", r)) % p
         return ElgamalCiphertext(p, c1, c2)
 
     def verifiability_proof(self, c, m, r, s=None, u=None, t=None):
         """ This ZK proof ensures that c is a el_gamal on m = 0 or 1
         s,u,t are the randomness used in the proof (optional)
         """
+        return self.verifiability_proof_with_commitments(c, m, r, s, u, t)[0]
+
+    def verifiability_proof_with_commitments(
+        self, c, m, r, s=None, u=None, t=None, precomputation=None
+    ):
+        """Same as verifiability_proof, but also return the commitments
+        (w0, w1) of the proof, which allow batch verification (see
+        :meth:`verifiability_proof_check_many`).
+
+        :param precomputation: result of :meth:`proof_precomputation`, to use
+            instead of s, u, t
+        :rtype: ([u0, u1, t0, t1], (ElgamalCiphertext, ElgamalCiphertext))
+        """
         # notations
         p = self.G[1]
+        q = self.G[2]
 
         assert m == 0 or m == 1  # the proof works only if m = 0 or 1
 
-        if s == None:
-            s = self.random()
-        if u == None:
-            u = self.random()
-        if t == None:
-            t = self.random()
+        if precomputation is None:
+            precomputation = self.proof_precomputation(s, u, t)
+        s, u, t, g_s, y_s, g_u, y_u, g_t = precomputation
+        # c1^-t and c2^-t: the only exponentiations that depend on c
+        c1_t = pow(c.c1, -t % q, p)
+        c2_t = pow(c.c2, -t % q, p)
 
+        # All the exponents live modulo the order q of g.
         if m == 0:
             # commitment
             u1 = u
             t1 = t
-            w0 = self.encrypt(0, s)
-            w1 = self.encrypt(t1, u1 - t1 * r)
+            # w0 = Enc(0, s)
+            w0 = ElgamalCiphertext(p, g_s, y_s)
+            # w1 = Enc(t1, u1 - t1 * r) = (g^u1 / c1^t1, g^t1 * y^u1 / c2^t1)
+            w1 = ElgamalCiphertext(p, g_u * c1_t % p, g_t * y_u % p * c2_t % p)
             # challenge
-            t0 = self._hashf([self.G, self.y, c, w0, w1]) - t1
+            t0 = (self._hashf([c, w0, w1]) - t1) % q
             # response
-            u0 = (s + r * t0) % p
+            u0 = (s + r * t0) % q
         else:
             # m == 1
             # commitment
             u0 = u
             t0 = t
-            w0 = self.encrypt(-t0, u0 - t0 * r)
-            w1 = self.encrypt(0, s)
+            # w0 = Enc(-t0, u0 - t0 * r) = (g^u0 / c1^t0, y^u0 / c2^t0)
+            w0 = ElgamalCiphertext(p, g_u * c1_t % p, y_u * c2_t % p)
+            # w1 = Enc(0, s)
+            w1 = ElgamalCiphertext(p, g_s, y_s)
             # challenge
-            t1 = self._hashf([self.G, self.y, c, w0, w1]) - t0
+            t1 = (self._hashf([c, w0, w1]) - t0) % q
             # response
-            u1 = (s + r * t1) % p
-        return [u0, u1, t0, t1]
+            u1 = (s + r * t1) % q
+        return [u0, u1, t0, t1], (w0, w1)
 
-    def verifiability_proof_check(self, c, proof):
-        """ Return True if the ZKP proof is correct with respect to c
-        meaning that c is a el_gamal on either 0 or 1
+    def proof_precomputation(self, s=None, u=None, t=None):
+        """Offline part of a verifiability proof, which does not depend on the
+        ciphertext: the randomness s, u, t and g^s, y^s, g^u, y^u, g^t.
+
+        :rtype: tuple
+        """
+        q = self.G[2]
+        if s == None:
+            s = self.random()
+        if u == None:
+            u = self.random()
+        if t == None:
+            t = self.random()
+        s, u, t = s % q, u % q, t % q
+        return (
+            s,
+            u,
+            t,
+            self._fixed_base_pow("g", s),
+            self._fixed_base_pow("y", s),
+            self._fixed_base_pow("g", u),
+            self._fixed_base_pow("y", u),
+            self._fixed_base_pow("g", t),
+        )
+
+    def prove_many(self, cs, ms, rs, workers=None, pool=None, with_commitments=False):
+        """Generate the verifiability proofs of a batch of ciphertexts.
+
+        :param cs: ciphertexts
+        :param ms: their plaintexts (0 or 1)
+        :param rs: the randomness used to encrypt them
+        :param workers: if not None, number of processes to spread the batch
+            over
+        :param pool: ProofPool to take the precomputations from
+        :param with_commitments: also return the commitments of the proofs
+        :returns: the proofs (and their commitments), in the order of cs
+        :rtype: list of [u0, u1, t0, t1] (or of (proof, (w0, w1)))
+        """
+        assert len(cs) == len(ms) == len(rs)
+        if pool is not None:
+            precomputations = [pool.take() for _ in cs]
+        else:
+            precomputations = [None] * len(cs)
+        items = list(zip(cs, ms, rs, precomputations))
+        if workers is not None and workers > 1 and len(items) > 1:
+            res = _parallel_map(_prove_chunk, self, items, workers)
+        else:
+            for base in ("g", "y"):
+                uses = self._fixed_base_uses.get(base, 0)
+                self._fixed_base_uses[base] = max(uses, FIXED_BASE_THRESHOLD - 1)
+            res = [
+                self.verifiability_proof_with_commitments(c, m, r, precomputation=pre)
+                for c, m, r, pre in items
+            ]
+        if with_commitments:
+            return res
+        return [proof for proof, _ in res]
+
+    def proof_commitments(self, c, proof):
+        """Recompute the commitments (w0, w1) of a proof on c.
+
+        :rtype: (ElgamalCiphertext, ElgamalCiphertext)
         """
         # notations
         c1 = c.c1
@@ -118,52 +430,375 @@ class ElgamalPublicKey:
 
         u0, u1, t0, t1 = proof
 
-        w0_1 = u0 * g - t0 * c1
-        w0_2 = u0 * y - t0 * c2
+        # w0 = (g^u0 / c1^t0, y^u0 / c2^t0)
+        w0_1 = multi_exp([g, c1], [u0, -t0], p)
+        w0_2 = multi_exp([y, c2], [u0, -t0], p)
         w0 = ElgamalCiphertext(p, w0_1, w0_2)
 
-        w1_1 = u1 * g - t1 * c1
-        w1_2 = u1 * y - t1 * c2 + t1 * g
+        # w1 = (g^u1 / c1^t1, y^u1 * g^t1 / c2^t1)
+        w1_1 = multi_exp([g, c1], [u1, -t1], p)
+        w1_2 = multi_exp([y, g, c2], [u1, t1, -t1], p)
         w1 = ElgamalCiphertext(p, w1_1, w1_2)
+        return w0, w1
 
-        return (t0 + t1) % p == self._hashf([self.G, self.y, c, w0, w1])
+    def verifiability_proof_check(self, c, proof):
+        """ Return True if the ZKP proof is correct with respect to c
+        meaning that c is a el_gamal on either 0 or 1
+        """
+        q = self.G[2]
+        t0, t1 = proof[2:]
+        w0, w1 = self.proof_commitments(c, proof)
+        return (t0 + t1) % q == self._hashf([c, w0, w1])
 
-    def _hashf(self, L):
+    def verifiability_proof_check_many(self, cs, proofs, commitments=None):
+        """Check many verifiability proofs at once.
+
+        With the commitments (w0, w1) of the proofs (see
+        :meth:`verifiability_proof_with_commitments`), the hashes are checked
+        one by one and all the group equations of all the proofs are checked
+        together: each equation is raised to a random BATCH_CHECK_BITS-bit
+        exponent and their product is computed by a single multi
+        exponentiation. If this product is not 1, the batch is split in halves
+        to find the bad proofs.
+        Without the commitments, the proofs are checked one by one.
+
+        :type cs: list of ElgamalCiphertext
+        :type proofs: list of [u0, u1, t0, t1]
+        :type commitments: list of (w0, w1) or None
+        :returns: for each proof, whether it is correct
+        :rtype: list of bool
+        """
+        if commitments is None:
+            return [self.verifiability_proof_check(c, pr) for c, pr in zip(cs, proofs)]
         p = self.G[1]
-        hash_f = SHA256.new()
-        for obj in L:
-            if type(obj) is tuple:
-                for i in obj:
-                    hash_f.update(str(i))
-            elif obj is ElgamalCiphertext:
-                hash_f.update(str(obj.c1))
-                hash_f.update(str(obj.c2))
+        q = self.G[2]
+        assert len(cs) == len(proofs) == len(commitments)
+        ok = [True] * len(cs)
+        candidates = []
+        for i, (c, proof, (w0, w1)) in enumerate(zip(cs, proofs, commitments)):
+            t0, t1 = proof[2:]
+            elements = (c.c1, c.c2, w0.c1, w0.c2, w1.c1, w1.c2)
+            # The random linear combination is only sound in the subgroup of
+            # order q, i.e. the quadratic residues.
+            if (t0 + t1) % q != self._hashf([c, w0, w1]) or not all(
+                0 < x < p and gmpy.jacobi(x, p) == 1 for x in elements
+            ):
+                ok[i] = False
+            else:
+                candidates.append(i)
+        todo = [candidates]
+        while todo:
+            idx = todo.pop()
+            if not idx or self._batch_equations_hold(
+                [(cs[i], proofs[i], commitments[i]) for i in idx]
+            ):
+                continue
+            if len(idx) == 1:
+                ok[idx[0]] = False
             else:
-                hash_f.update(str(obj))
+                todo.append(idx[: len(idx) // 2])
+                todo.append(idx[len(idx) // 2 :])
+        return ok
+
+    def _batch_equations_hold(self, items):
+        g, p, q = self.G
+        e_g = 0
+        e_y = 0
+        bases = []
+        exps = []
+        for c, (u0, u1, t0, t1), (w0, w1) in items:
+            d1, d2, d3, d4 = [getrandbits(BATCH_CHECK_BITS) for _ in range(4)]
+            # g^u0 = w0_1 c1^t0, y^u0 = w0_2 c2^t0,
+            # g^u1 = w1_1 c1^t1, y^u1 g^t1 = w1_2 c2^t1
+            e_g += d1 * u0 + d3 * u1 + d4 * t1
+            e_y += d2 * u0 + d4 * u1
+            bases += [c.c1, c.c2, w0.c1, w0.c2, w1.c1, w1.c2]
+            exps += [
+                -(d1 * t0 + d3 * t1) % q,
+                -(d2 * t0 + d4 * t1) % q,
+                -d1 % q,
+                -d2 % q,
+                -d3 % q,
+                -d4 % q,
+            ]
+        bases += [g, self.y]
+        exps += [e_g % q, e_y % q]
+        return multi_exp(bases, exps, p) == 1
+
+    def _hashf(self, L):
+        """Hash of G, y and the objects of L, modulo q.
+
+        The hash state after (G, y) is computed once per key.
+        """
+        q = self.G[2]
+        if self._hash_prefix is None:
+            hash_f = SHA256.new()
+            _hash_update(hash_f, self.G)
+            _hash_update(hash_f, self.y)
+            self._hash_prefix = hash_f
+        hash_f = self._hash_prefix.copy()
+        for obj in L:
+            _hash_update(hash_f, obj)
         d = hash_f.digest()
-        return int(d.encode("hex"), 16) % p
+        return bytes_to_long(d) % q
+
+
+def _hash_update(hash_f, obj):
+    if type(obj) is tuple:
+        for i in obj:
+            _hash_update(hash_f, i)
+    elif isinstance(obj, ElgamalCiphertext):
+        _hash_update(hash_f, obj.c1)
+        _hash_update(hash_f, obj.c2)
+    else:
+        hash_f.update(str(obj).encode("ascii") + b",")
+
+
+class FixedBaseExp:
+    """Fixed-base windowed exponentiation
+
+    For a base b of order q, stores b^(d * 2^(w*i)) for every w-bit digit d
+    and window i, so that b^e costs one multiplication per non-zero digit of
+    e (no squaring). The window size w is the largest one for which the
+    table fits in max_entries group elements.
 
+    :param base: base b
+    :param p: modulus
+    :param order: order q of b (exponents are reduced modulo q)
+    :param max_entries: memory bound, in number of group elements
+    """
+
+    def __init__(self, base, p, order, max_entries=FIXED_BASE_MAX_ENTRIES):
+        self.p = gmpy.mpz(p)
+        self.order = int(order)
+        bits = self.order.bit_length()
+        w = 1
+        while w < 16 and -(-bits // (w + 1)) * (2 ** (w + 1) - 1) <= max_entries:
+            w += 1
+        self.w = w
+        self.mask = 2 ** w - 1
+        self.table = []
+        b = gmpy.mpz(base) % self.p
+        for _ in range(-(-bits // w)):
+            row = [gmpy.mpz(1)]
+            a = 1
+            for _ in range(self.mask):
+                a = a * b % self.p
+                row.append(a)
+            self.table.append(row)
+            b = a * b % self.p  # b^(2^w)
+
+    def pow(self, e):
+        """Compute base^e mod p.
+
+        :param e: exponent (any integer)
+        """
+        e = int(e) % self.order
+        p = self.p
+        w = self.w
+        mask = self.mask
+        res = gmpy.mpz(1)
+        for row in self.table:
+            d = e & mask
+            if d:
+                res = res * row[d] % p
+            e >>= w
+        return res
+
+
+def batch_invert(xs, p):
+    """Invert all the elements of xs modulo p with a single modular inversion
+    (Montgomery's trick): 3 multiplications per element instead of one
+    inversion each.
+
+    :type xs: list of int, all invertible modulo p
+    :rtype: list of int
+    """
+    n = len(xs)
+    if n == 0:
+        return []
+    # prefix[i] = xs[0] * ... * xs[i-1]
+    prefix = [1] * (n + 1)
+    for i, x in enumerate(xs):
+        prefix[i + 1] = prefix[i] * x % p
+    inv = gmpy.invert(prefix[n], p)
+    res = [None] * n
+    for i in range(n - 1, -1, -1):
+        res[i] = inv * prefix[i] % p
+        inv = inv * xs[i] % p
+    return res
+
+
+def _parallel_map(fn, key, items, workers):
+    """Run fn((key, chunk)) over workers contiguous chunks of items in a
+    process pool and concatenate the results in order."""
+    import multiprocessing
+
+    size = -(-len(items) // workers)
+    chunks = [(key, items[i : i + size]) for i in range(0, len(items), size)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(fn, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return [x for res in results for x in res]
+
+
+def _prove_chunk(args):
+    pk, items = args
+    return pk.prove_many(
+        [c for c, _, _, _ in items],
+        [m for _, m, _, _ in items],
+        [r for _, _, r, _ in items],
+        pool=_PrecomputedProofs([pre for _, _, _, pre in items], pk),
+        with_commitments=True,
+    )
+
+
+def _encrypt_chunk(args):
+    pk, items = args
+    return pk.encrypt_many([m for m, _ in items], [r for _, r in items])
+
+
+def _decrypt_chunk(args):
+    sk, cs = args
+    return sk.decrypt_many(cs)
+
+
+def dLog(p, g, g_m, bound=2 ** 20):
+    """Compute the discrete log of g_m with basis g, modulo p
+
+    Baby-step giant-step over the range [0, bound): about 2*sqrt(bound)
+    group operations instead of bound. The baby-step table only depends on
+    (p, g, bound) and is shared by all the calls (see :func:`dlog_table`).
+
+    :returns: the discrete log or None if there is none below bound
+    """
+    return dlog_table(p, g, bound).solve(g_m)
+
+
+# Baby-step tables already built, keyed by (p, g, bound), least recently
+# used first. At most DLOG_CACHE_SIZE of them are kept.
+_DLOG_TABLES = collections.OrderedDict()
+DLOG_CACHE_SIZE = 8
+# Tables registered with register_dlog_table, never evicted.
+_REGISTERED_DLOG_TABLES = {}
+
+
+# Maximum number of baby steps of a table enlarged for batch decryption.
+DLOG_MAX_BABY_STEPS = 2 ** 18
 
-def dLog(p, g, g_m):
-    """Compute the discrete log of g_m with basis g, modulo p"""
-    # TODO: optimize this
-    a = 1
-    i = 0
-    while i < 2 ** 20:
-        if a == g_m:
-            return i
+
+def dlog_table(p, g, bound=2 ** 20, baby_steps=None):
+    """Return the (cached) baby-step giant-step table for (p, g, bound).
+
+    :param baby_steps: minimum number of baby steps wanted (default:
+        sqrt(bound)). A cached DLogTable with fewer baby steps is replaced by
+        a bigger one, registered tables are always kept.
+    :rtype: DLogTable
+    """
+    k = (int(p), int(g), int(bound))
+    table = _REGISTERED_DLOG_TABLES.get(k)
+    if table is not None:
+        return table
+    table = _DLOG_TABLES.pop(k, None)
+    if table is None or (
+        baby_steps is not None and table.m < min(baby_steps, DLOG_MAX_BABY_STEPS)
+    ):
+        if baby_steps is not None:
+            baby_steps = min(baby_steps, DLOG_MAX_BABY_STEPS)
+        table = DLogTable(p, g, bound, baby_steps)
+    _DLOG_TABLES[k] = table
+    while len(_DLOG_TABLES) > DLOG_CACHE_SIZE:
+        _DLOG_TABLES.popitem(last=False)
+    return table
+
+
+def register_dlog_table(table):
+    """Make dLog use table (e.g. a :class:`dlog_store.MappedDLogTable`) for
+    its (p, g, bound)."""
+    k = (table.p, table.g, table.bound)
+    _DLOG_TABLES.pop(k, None)
+    _REGISTERED_DLOG_TABLES[k] = table
+
+
+def unregister_dlog_table(table):
+    """Stop using a table registered with :func:`register_dlog_table` (no-op
+    if another table is registered for its (p, g, bound))."""
+    k = (table.p, table.g, table.bound)
+    if _REGISTERED_DLOG_TABLES.get(k) is table:
+        del _REGISTERED_DLOG_TABLES[k]
+
+
+def _ceil_sqrt(n):
+    """Smallest m >= 1 such that m * m >= n."""
+    m = max(1, int(math.sqrt(n)))
+    while m * m < n:
+        m += 1
+    while m > 1 and (m - 1) * (m - 1) >= n:
+        m -= 1
+    return m
+
+
+class DLogTable:
+    """Baby-step giant-step table for discrete logs in [0, bound)
+
+    The baby steps {g^j: j} for j < m = ceil(sqrt(bound)) are stored in a
+    dictionnary, and solve walks at most bound/m giant steps of g^(-m).
+    A larger m makes each solve cheaper, which pays off when many discrete
+    logs are computed with the same table.
+
+    :param p: modulus
+    :param g: basis
+    :param bound: exclusive upper bound on the discrete logs to recover
+    :param baby_steps: number m of baby steps (default: ceil(sqrt(bound)))
+    """
+
+    def __init__(self, p, g, bound=2 ** 20, baby_steps=None):
+        self.p = int(p)
+        self.g = int(g)
+        self.bound = int(bound)
+        if baby_steps is None:
+            m = _ceil_sqrt(self.bound)
         else:
-            a = a * g % p
-            i += 1
-    return None  # no DLog < 2**20 found
+            m = max(1, min(int(baby_steps), self.bound))
+        self.m = m
+        self.baby = {}
+        a = 1
+        for j in range(m):
+            # keep the smallest exponent if g has a small order
+            self.baby.setdefault(a, j)
+            a = a * self.g % self.p
+        # a == g^m
+        self.giant = int(gmpy.invert(a, self.p))
+
+    def solve(self, g_m):
+        """Compute the discrete log of g_m.
+
+        :returns: the discrete log or None if there is none below bound
+        """
+        h = int(g_m) % self.p
+        for i in range(0, self.bound, self.m):
+            j = self.baby.get(h)
+            if j is not None:
+                if i + j < self.bound:
+                    return i + j
+                return None
+            h = h * self.giant % self.p
+        return None
 
 
 class ElgamalSecretKey:
-    """El Gamal secret key."""
+    """El Gamal secret key.
+
+    :param msg_bits: maximum bit length of the plaintexts
+    """
 
-    def __init__(self, G, x):
+    def __init__(self, G, x, msg_bits=MSG_BITS):
         self.G = G
         self.x = x
+        self.msg_bits = msg_bits
 
     def decrypt(self, c):
         """Decrypt ciphertext c.
@@ -178,9 +813,43 @@ class ElgamalSecretKey:
         c2 = c.c2
         c1_prime = pow(c1, self.x, p)
         g_m = gmpy.divm(c2, c1_prime, p)
-        m = dLog(p, g, g_m)
+        m = dLog(p, g, g_m, 2 ** self.msg_bits)
         return m
 
+    def decrypt_many(self, cs, workers=None):
+        """Decrypt a batch of ciphertexts.
+
+        All the divisions are done with a single modular inversion (see
+        :func:`batch_invert`), and all the discrete logs with the same table,
+        enlarged to about sqrt(n * bound) baby steps for a batch of n
+        ciphertexts so that each discrete log costs about sqrt(bound / n)
+        giant steps.
+
+        :param workers: if not None, number of processes to spread the batch
+            over
+        :type cs: list of ElgamalCiphertext
+        :returns: plaintexts, in the order of cs
+        :rtype: list of int
+        """
+        cs = list(cs)
+        if not cs:
+            return []
+        if workers is not None and workers > 1 and len(cs) > 1:
+            return _parallel_map(_decrypt_chunk, self, cs, workers)
+        g = self.G[0]
+        p = self.G[1]
+        for c in cs:
+            assert isinstance(c, ElgamalCiphertext)
+        c1_primes = [pow(c.c1, self.x, p) for c in cs]
+        inverses = batch_invert(c1_primes, p)
+        bound = 2 ** self.msg_bits
+        # never less than the default table of dlog_table
+        baby_steps = _ceil_sqrt(bound)
+        while baby_steps * baby_steps < bound * len(cs):
+            baby_steps *= 2
+        table = dlog_table(p, g, bound, baby_steps)
+        return [table.solve(c.c2 * inv % p) for c, inv in zip(cs, inverses)]
+
 
 class ElgamalCiphertext:
     """El Gamal ciphertext.
@@ -193,6 +862,9 @@ class ElgamalCiphertext:
     exponentiation)
 
     Available operations: addition, subtraction, negation, multiplication.
+    Aggregations of many ciphertexts should use :meth:`sum` and
+    :meth:`linear_combination`, which keep the operands reduced modulo p and
+    share the work between the ciphertexts.
     """
 
     def __init__(self, p, c1, c2):
@@ -201,11 +873,15 @@ class ElgamalCiphertext:
         self.c2 = c2
 
     def __add__(self, other):
-        return ElgamalCiphertext(self.p, self.c1 * other.c1, self.c2 * other.c2)
+        return ElgamalCiphertext(
+            self.p, self.c1 * other.c1 % self.p, self.c2 * other.c2 % self.p
+        )
 
     def __neg__(self):
-        inv_c1 = gmpy.invert(self.c1, self.p)
-        inv_c2 = gmpy.invert(self.c2, self.p)
+        # 1/c1 = c2/(c1*c2) and 1/c2 = c1/(c1*c2): a single inversion.
+        inv = gmpy.invert(self.c1 * self.c2 % self.p, self.p)
+        inv_c1 = inv * self.c2 % self.p
+        inv_c2 = inv * self.c1 % self.p
         return ElgamalCiphertext(self.p, inv_c1, inv_c2)
 
     def __sub__(self, other):
@@ -221,3 +897,365 @@ class ElgamalCiphertext:
 
     def __rmul__(self, other):
         return self.__mul__(other)
+
+    @classmethod
+    def sum(cls, cs):
+        """Homomorphic sum of the ciphertexts of cs (at least one).
+
+        :type cs: iterable of ElgamalCiphertext
+        :rtype: ElgamalCiphertext
+        """
+        it = iter(cs)
+        first = next(it)
+        p = first.p
+        c1 = first.c1
+        c2 = first.c2
+        for c in it:
+            c1 = c1 * c.c1 % p
+            c2 = c2 * c.c2 % p
+        return cls(p, c1, c2)
+
+    @classmethod
+    def linear_combination(cls, cs, scalars):
+        """Homomorphic sum of the alpha*c for c, alpha in zip(cs, scalars).
+
+        Computed by simultaneous multi-exponentiation (see :func:`multi_exp`)
+        instead of one exponentiation per ciphertext. Negative scalars are
+        reduced modulo p - 1 and do not require any inversion.
+
+        :type cs: list of ElgamalCiphertext (at least one)
+        :type scalars: list of int
+        :rtype: ElgamalCiphertext
+        """
+        cs = list(cs)
+        scalars = list(scalars)
+        assert len(cs) == len(scalars) and cs
+        p = cs[0].p
+        c1 = multi_exp([c.c1 for c in cs], scalars, p)
+        c2 = multi_exp([c.c2 for c in cs], scalars, p)
+        return cls(p, c1, c2)
+
+    @classmethod
+    def negate_many(cls, cs):
+        """Negate all the ciphertexts of cs with a single modular inversion.
+
+        :type cs: list of ElgamalCiphertext (with the same p)
+        :rtype: list of ElgamalCiphertext
+        """
+        cs = list(cs)
+        if not cs:
+            return []
+        p = cs[0].p
+        invs = batch_invert([c.c1 * c.c2 % p for c in cs], p)
+        return [cls(p, inv * c.c2 % p, inv * c.c1 % p) for c, inv in zip(cs, invs)]
+
+
+# Number of bases from which multi_exp switches from Straus to Pippenger.
+PIPPENGER_THRESHOLD = 64
+
+
+def multi_exp(bases, exps, p):
+    """Compute the product of the b^e mod p for b, e in zip(bases, exps).
+
+    All the bases share the same squarings: interleaved 4-bit windows
+    (Straus) for a few bases, bucket method (Pippenger) for many bases.
+    Exponents are reduced modulo p - 1, hence the bases must be invertible
+    modulo p.
+
+    :rtype: int
+    """
+    order = p - 1
+    exps = [int(e % order) for e in exps]
+    bits = max(e.bit_length() for e in exps) if exps else 0
+    if len(bases) < PIPPENGER_THRESHOLD:
+        return _straus(bases, exps, p, bits)
+    return _pippenger(bases, exps, p, bits)
+
+
+def _straus(bases, exps, p, bits, w=4):
+    mask = 2 ** w - 1
+    tables = []
+    for b in bases:
+        row = [1, b % p]
+        for _ in range(mask - 1):
+            row.append(row[-1] * b % p)
+        tables.append(row)
+    res = 1
+    for shift in range(w * (-(-bits // w) - 1), -1, -w):
+        for _ in range(w):
+            res = res * res % p
+        for row, e in zip(tables, exps):
+            d = (e >> shift) & mask
+            if d:
+                res = res * row[d] % p
+    return res
+
+
+def _pippenger(bases, exps, p, bits):
+    w = max(1, len(bases).bit_length() - 3)
+    mask = 2 ** w - 1
+    res = 1
+    for shift in range(w * (-(-bits // w) - 1), -1, -w):
+        for _ in range(w):
+            res = res * res % p
+        buckets = [1] * (mask + 1)
+        for b, e in zip(bases, exps):
+            d = (e >> shift) & mask
+            if d:
+                buckets[d] = buckets[d] * b % p
+        # prod_d buckets[d]^d with running products
+        running = 1
+        acc = 1
+        for d in range(mask, 0, -1):
+            running = running * buckets[d] % p
+            acc = acc * running % p
+        res = res * acc % p
+    return res
+
+
+def test_dlog():
+    pk, sk = elgamal_param_gen()
+    g, p, q = pk.G
+    for m in (0, 1, 2, 1023, 1024, 1025, 2 ** 20 - 1):
+        assert dLog(p, g, pow(g, m, p)) == m
+        assert sk.decrypt(pk.encrypt(m)) == m
+    assert dLog(p, g, pow(g, 2 ** 20, p)) is None
+    assert dLog(p, g, pow(g, 1000, p), bound=1000) is None
+    # the cache of tables is bounded
+    for bound in range(2, 4 + 2 * DLOG_CACHE_SIZE):
+        assert dLog(p, g, pow(g, 1, p), bound=bound) == 1
+    assert len(_DLOG_TABLES) == DLOG_CACHE_SIZE
+    pk, sk = elgamal_param_gen(msg_bits=32)
+    assert sk.decrypt(pk.encrypt(2 ** 32 - 1)) == 2 ** 32 - 1
+
+
+def test_fixed_base():
+    pk, sk = elgamal_param_gen()
+    g, p, q = pk.G
+    fb = FixedBaseExp(g, p, q)
+    for e in (0, 1, q - 1, q, q + 5, -3, randint(1, int(p))):
+        assert fb.pow(e) == pow(g, e % q, p)
+    for m in (0, 1, 5, 2 ** 20 - 1):
+        assert sk.decrypt(pk.encrypt(m)) == m
+
+
+def bench_fixed_base(bits=1024, n=1000):
+    """Compare FixedBaseExp against pow for n random exponents modulo a
+    random prime of the given bit length."""
+    import time
+
+    p = gmpy.next_prime(randint(2 ** (bits - 1), 2 ** bits - 1))
+    q = p - 1
+    g = randint(2, int(p - 1))
+    exps = [randint(1, int(q)) for _ in range(n)]
+    t0 = time.time()
+    fb = FixedBaseExp(g, p, q)
+    t1 = time.time()
+    for e in exps:
+        fb.pow(e)
+    t2 = time.time()
+    for e in exps:
+        pow(g, e, p)
+    t3 = time.time()
+    print("table: window %d bits, built in %.2f ms" % (fb.w, 1000 * (t1 - t0)))
+    print("fixed base: %.2f us/exp" % (1e6 * (t2 - t1) / n))
+    print("pow: %.2f us/exp" % (1e6 * (t3 - t2) / n))
+    print("speedup: %.2fx" % ((t3 - t2) / (t2 - t1)))
+
+
+def test_batch():
+    pk, sk = elgamal_param_gen()
+    p = pk.G[1]
+    xs = [randint(1, int(p - 1)) for _ in range(10)]
+    assert batch_invert(xs, p) == [gmpy.invert(x, p) for x in xs]
+    ms = [randint(0, 2 ** 20 - 1) for _ in range(50)]
+    cs = pk.encrypt_many(ms)
+    assert sk.decrypt_many(cs) == ms
+    assert [sk.decrypt(c) for c in cs] == ms
+    assert sk.decrypt_many(pk.encrypt_many(ms, workers=2), workers=2) == ms
+    # an empty or small batch does not install a smaller table
+    pk, sk = elgamal_param_gen()
+    g, p, q = pk.G
+    assert sk.decrypt_many([]) == []
+    sk.decrypt_many([pk.encrypt(5)])
+    assert dlog_table(p, g, 2 ** sk.msg_bits).m >= 2 ** (sk.msg_bits // 2)
+
+
+def test_aggregation():
+    pk, sk = elgamal_param_gen()
+    p = pk.G[1]
+    for n in (1, 3, PIPPENGER_THRESHOLD + 5):
+        ms = [randint(0, 100) for _ in range(n)]
+        alphas = [randint(-50, 50) for _ in range(n)]
+        cs = pk.encrypt_many(ms)
+        bases = [c.c1 for c in cs]
+        assert multi_exp(bases, alphas, p) == _straus(
+            bases, [a % (p - 1) for a in alphas], p, int(p).bit_length()
+        )
+        assert sk.decrypt(ElgamalCiphertext.sum(cs)) == sum(ms)
+        total = sum(m * a for m, a in zip(ms, alphas))
+        lc = ElgamalCiphertext.linear_combination(cs, alphas)
+        if total >= 0:
+            assert sk.decrypt(lc) == total
+        else:
+            assert sk.decrypt(-lc) == -total
+        assert lc.c1 < p and lc.c2 < p
+    c = pk.encrypt(7)
+    assert sk.decrypt(pk.encrypt(10) - c) == 3
+    neg = ElgamalCiphertext.negate_many([c, c])
+    assert (neg[0].c1, neg[0].c2) == ((-c).c1, (-c).c2)
+
+
+def test_groups():
+    for name, (g, p, q) in GROUPS.items():
+        assert gmpy.is_prime(p) and gmpy.is_prime(q) and p == 2 * q + 1
+        assert pow(g, q, p) == 1 and g != 1
+    pk, sk = elgamal_param_gen(G="safe66")
+    assert pk.G == GROUPS["safe66"]
+    assert sk.decrypt(pk.encrypt(12345)) == 12345
+    pool = KeyPool(2, G="safe66")
+    pk, sk = pool.get()
+    pool.stop()
+    assert sk.decrypt(pk.encrypt(3)) == 3
+    assert pool.hits + pool.misses == 1
+
+
+def bench_param_gen(n=50):
+    """Keypair generation throughput with fresh groups, a named group and a
+    warm pool."""
+    import time
+
+    t0 = time.time()
+    for _ in range(n):
+        elgamal_param_gen()
+    t1 = time.time()
+    for _ in range(n):
+        elgamal_param_gen(G="safe66")
+    t2 = time.time()
+    pool = KeyPool(n)
+    t3 = time.time()
+    while pool.ready() < n:
+        time.sleep(0.01)
+    t4 = time.time()
+    for _ in range(n):
+        pool.get()
+    t5 = time.time()
+    pool.stop()
+    print("fresh group: %.0f keypairs/s" % (n / (t1 - t0)))
+    print("named group: %.0f keypairs/s" % (n / (t2 - t1)))
+    print("pool: startup %.2f ms, warm-up %.2f s, %.0f keypairs/s when warm"
+          % (1000 * (t3 - t2), t4 - t3, n / (t5 - t4)))
+
+
+def test_proofs():
+    pk, sk = elgamal_param_gen()
+    cs = []
+    proofs = []
+    commitments = []
+    for i in range(20):
+        m = i % 2
+        r = pk.random()
+        c = pk.encrypt(m, r)
+        proof, w = pk.verifiability_proof_with_commitments(c, m, r)
+        assert pk.verifiability_proof_check(c, proof)
+        cs.append(c)
+        proofs.append(proof)
+        commitments.append(w)
+    assert all(pk.verifiability_proof_check_many(cs, proofs, commitments))
+    assert all(pk.verifiability_proof_check_many(cs, proofs))
+    # c3 encrypts 2, proof 5 is for another ciphertext, and proof 7 only
+    # fails the group equations
+    r = pk.random()
+    cs[3] = pk.encrypt(1, r) + pk.encrypt(1)
+    proofs[5] = pk.verifiability_proof(pk.encrypt(0, r), 0, r)
+    proofs[7] = [proofs[7][0] + 1] + proofs[7][1:]
+    checks = pk.verifiability_proof_check_many(cs, proofs, commitments)
+    assert [i for i, ok in enumerate(checks) if not ok] == [3, 5, 7]
+    assert not pk.verifiability_proof_check(cs[3], proofs[3])
+    assert not pk.verifiability_proof_check(cs[7], proofs[7])
+
+
+def test_prove_many():
+    pk, sk = elgamal_param_gen()
+    ms = [i % 2 for i in range(10)]
+    rs = [pk.random() for _ in ms]
+    cs = [pk.encrypt(m, r) for m, r in zip(ms, rs)]
+    pool = ProofPool(pk)
+    pool.fill(6)
+    res = pk.prove_many(cs, ms, rs, pool=pool, with_commitments=True)
+    assert pool.hits == 6 and pool.misses == 4 and len(pool) == 0
+    proofs = [proof for proof, _ in res]
+    assert all(pk.verifiability_proof_check_many(cs, proofs, [w for _, w in res]))
+    proofs = pk.prove_many(cs, ms, rs, workers=2)
+    assert all(pk.verifiability_proof_check(c, proof) for c, proof in zip(cs, proofs))
+    s, u, t = 5, 6, 7
+    assert pk.verifiability_proof(cs[0], 0, rs[0], s, u, t) == pk.prove_many(
+        cs[:1], [0], rs[:1], pool=_PrecomputedProofs([pk.proof_precomputation(s, u, t)], pk)
+    )[0]
+
+
+def bench_prove_many(n=2000, max_workers=None):
+    """Proof generation throughput: online proving with a filled ProofPool,
+    and with 1 to max_workers processes."""
+    import multiprocessing
+    import time
+
+    pk, sk = elgamal_param_gen()
+    ms = [i % 2 for i in range(n)]
+    rs = [pk.random() for _ in ms]
+    cs = [pk.encrypt(m, r) for m, r in zip(ms, rs)]
+    t0 = time.time()
+    for c, m, r in zip(cs, ms, rs):
+        pk.verifiability_proof(c, m, r)
+    t1 = time.time()
+    pool = ProofPool(pk)
+    pool.fill(n)
+    t2 = time.time()
+    pk.prove_many(cs, ms, rs, pool=pool)
+    t3 = time.time()
+    print("sequential: %.0f proofs/s" % (n / (t1 - t0)))
+    print("offline: %.0f precomputations/s, online: %.0f proofs/s"
+          % (n / (t2 - t1), n / (t3 - t2)))
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    for workers in range(1, max_workers + 1):
+        t0 = time.time()
+        pk.prove_many(cs, ms, rs, workers=workers)
+        t1 = time.time()
+        print("%d workers: %.0f proofs/s (%.0f proofs/s per core)"
+              % (workers, n / (t1 - t0), n / (t1 - t0) / workers))
+
+
+def bench_proof_check(ns=(1000, 10000, 100000)):
+    """Individual against batch verification of n proofs."""
+    import time
+
+    pk, sk = elgamal_param_gen()
+    for n in ns:
+        cs = []
+        proofs = []
+        commitments = []
+        for i in range(n):
+            r = pk.random()
+            c = pk.encrypt(i % 2, r)
+            proof, w = pk.verifiability_proof_with_commitments(c, i % 2, r)
+            cs.append(c)
+            proofs.append(proof)
+            commitments.append(w)
+        t0 = time.time()
+        assert all(pk.verifiability_proof_check(c, pr) for c, pr in zip(cs, proofs))
+        t1 = time.time()
+        assert all(pk.verifiability_proof_check_many(cs, proofs, commitments))
+        t2 = time.time()
+        print("%d proofs: individual %.2f s, batch %.2f s (%.1fx)"
+              % (n, t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1)))
+
+
+if __name__ == "__main__":
+    test_proofs()
+    test_prove_many()
+    test_groups()
+    test_dlog()
+    test_fixed_base()
+    test_batch()
+    test_aggregation()
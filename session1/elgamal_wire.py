@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+LELEC2770 : Privacy Enhancing Technologies
+
+Binary wire format for El Gamal keys, ciphertexts and proofs
+
+All integers are big-endian.
+
+- group elements (ciphertext components) are fixed-width: as many bytes as
+  p, see :func:`element_width`. The width is implied by p and never stored
+  along each ciphertext.
+- other integers (key parameters, proofs) are length-prefixed: sign byte,
+  2-byte length, magnitude.
+
+Decoding functions accept any buffer (bytes, bytearray, mmap, memoryview)
+and an offset, and never copy the buffer.
+"""
+
+import struct
+
+from Crypto.Util.number import bytes_to_long, long_to_bytes
+
+from elgamal import ElgamalPublicKey, ElgamalCiphertext
+
+PK_MAGIC = b"EGPK"
+STREAM_MAGIC = b"EGCS"
+VERSION = 1
+INT_HEADER = struct.Struct(">BH")
+PK_HEADER = struct.Struct(">4sBH")
+STREAM_HEADER = struct.Struct(">4sBI")
+
+
+def element_width(p):
+    """Number of bytes of a group element modulo p."""
+    return (int(p).bit_length() + 7) // 8
+
+
+def encode_int(x):
+    """Length-prefixed encoding of an integer (of any sign).
+
+    :rtype: bytes
+    """
+    x = int(x)
+    sign = 1 if x < 0 else 0
+    x = abs(x)
+    mag = long_to_bytes(x) if x else b""
+    return INT_HEADER.pack(sign, len(mag)) + mag
+
+
+def decode_int(buf, offset=0):
+    """Decode an integer encoded by :func:`encode_int`.
+
+    :returns: the integer and the offset of the next byte
+    :rtype: (int, int)
+    """
+    buf = memoryview(buf)
+    if offset + INT_HEADER.size > len(buf):
+        raise ValueError("truncated integer")
+    sign, length = INT_HEADER.unpack_from(buf, offset)
+    offset += INT_HEADER.size
+    if offset + length > len(buf):
+        raise ValueError("truncated integer")
+    x = bytes_to_long(buf[offset : offset + length].tobytes())
+    return (-x if sign else x), offset + length
+
+
+def encode_public_key(pk):
+    """Encode an ElgamalPublicKey.
+
+    :rtype: bytes
+    """
+    g, p, q = pk.G
+    return PK_HEADER.pack(PK_MAGIC, VERSION, pk.msg_bits) + b"".join(
+        encode_int(x) for x in (g, p, q, pk.y)
+    )
+
+
+def decode_public_key(buf, offset=0):
+    """Decode a public key encoded by :func:`encode_public_key`.
+
+    :returns: the key and the offset of the next byte
+    :rtype: (ElgamalPublicKey, int)
+    """
+    if offset + PK_HEADER.size > len(buf):
+        raise ValueError("truncated public key")
+    magic, version, msg_bits = PK_HEADER.unpack_from(buf, offset)
+    if magic != PK_MAGIC or version != VERSION:
+        raise ValueError("not an El Gamal public key")
+    offset += PK_HEADER.size
+    values = []
+    for _ in range(4):
+        x, offset = decode_int(buf, offset)
+        values.append(x)
+    g, p, q, y = values
+    return ElgamalPublicKey((g, p, q), y, msg_bits), offset
+
+
+def encode_ciphertext(c):
+    """Fixed-width encoding of a ciphertext: c1 || c2.
+
+    :rtype: bytes of length 2 * element_width(c.p)
+    """
+    w = element_width(c.p)
+    return long_to_bytes(int(c.c1), w) + long_to_bytes(int(c.c2), w)
+
+
+def decode_ciphertext(buf, p, offset=0):
+    """Decode a ciphertext encoded by :func:`encode_ciphertext`.
+
+    :param p: modulus of the ciphertext
+    :rtype: ElgamalCiphertext
+    """
+    buf = memoryview(buf)
+    w = element_width(p)
+    if offset + 2 * w > len(buf):
+        raise ValueError("truncated ciphertext")
+    c1 = bytes_to_long(buf[offset : offset + w].tobytes())
+    c2 = bytes_to_long(buf[offset + w : offset + 2 * w].tobytes())
+    if not (0 < c1 < p and 0 < c2 < p):
+        raise ValueError("ciphertext component out of range")
+    return ElgamalCiphertext(p, c1, c2)
+
+
+def encode_proof(proof):
+    """Encode a [u0, u1, t0, t1] proof of
+    :meth:`elgamal.ElgamalPublicKey.verifiability_proof`.
+
+    :rtype: bytes
+    """
+    assert len(proof) == 4
+    return b"".join(encode_int(x) for x in proof)
+
+
+def decode_proof(buf, offset=0):
+    """Decode a proof encoded by :func:`encode_proof`.
+
+    :returns: the proof and the offset of the next byte
+    :rtype: ([u0, u1, t0, t1], int)
+    """
+    proof = []
+    for _ in range(4):
+        x, offset = decode_int(buf, offset)
+        proof.append(x)
+    return proof, offset
+
+
+class CiphertextWriter:
+    """Write a stream of ciphertexts modulo p to a binary file object.
+
+    The stream starts with a header (magic, version, element width, p), then
+    contains fixed-width records.
+    """
+
+    def __init__(self, f, p):
+        self.f = f
+        self.p = p
+        self.width = element_width(p)
+        self.count = 0
+        f.write(STREAM_HEADER.pack(STREAM_MAGIC, VERSION, self.width))
+        f.write(encode_int(p))
+
+    def write(self, c):
+        assert c.p == self.p
+        self.f.write(encode_ciphertext(c))
+        self.count += 1
+
+    def write_many(self, cs):
+        data = b"".join(encode_ciphertext(c) for c in cs)
+        assert len(data) % (2 * self.width) == 0
+        self.f.write(data)
+        self.count += len(data) // (2 * self.width)
+
+
+class CiphertextReader:
+    """Iterate over the ciphertexts of a stream written by
+    :class:`CiphertextWriter`.
+
+    The file is read by chunks of chunk_size records, so the memory used does
+    not depend on the size of the file.
+    """
+
+    def __init__(self, f, chunk_size=4096):
+        self.f = f
+        self.chunk_size = chunk_size
+        header = f.read(STREAM_HEADER.size)
+        if len(header) != STREAM_HEADER.size:
+            raise ValueError("truncated ciphertext stream")
+        magic, version, width = STREAM_HEADER.unpack(header)
+        if magic != STREAM_MAGIC or version != VERSION:
+            raise ValueError("not a ciphertext stream")
+        int_header = f.read(INT_HEADER.size)
+        if len(int_header) != INT_HEADER.size:
+            raise ValueError("truncated ciphertext stream")
+        _, length = INT_HEADER.unpack(int_header)
+        self.p, _ = decode_int(int_header + f.read(length))
+        self.width = width
+        if element_width(self.p) != width:
+            raise ValueError("inconsistent element width")
+
+    def __iter__(self):
+        record = 2 * self.width
+        while True:
+            chunk = self.f.read(record * self.chunk_size)
+            if not chunk:
+                return
+            if len(chunk) % record != 0:
+                raise ValueError("truncated ciphertext stream")
+            for offset in range(0, len(chunk), record):
+                yield decode_ciphertext(chunk, self.p, offset)
+
+
+def test_wire():
+    import io
+    from elgamal import elgamal_param_gen
+
+    pk, sk = elgamal_param_gen()
+    pk2, offset = decode_public_key(encode_public_key(pk))
+    assert pk2.G == pk.G and pk2.y == pk.y and pk2.msg_bits == pk.msg_bits
+    for x in (0, 1, -1, 2 ** 70, -(2 ** 70)):
+        assert decode_int(encode_int(x)) == (x, len(encode_int(x)))
+    proof = [5, 2 ** 66, -(2 ** 65), 0]
+    assert decode_proof(encode_proof(proof))[0] == proof
+
+    ms = list(range(100))
+    f = io.BytesIO()
+    writer = CiphertextWriter(f, pk.G[1])
+    cs = pk.encrypt_many(ms)
+    writer.write(cs[0])
+    writer.write_many(cs[1:])
+    assert writer.count == len(ms)
+    f.seek(0)
+    reader = CiphertextReader(f, chunk_size=7)
+    assert sk.decrypt_many(list(reader)) == ms
+
+    # truncated headers are reported as ValueError, not struct.error
+    data = f.getvalue()
+    for n in (0, STREAM_HEADER.size - 1, STREAM_HEADER.size + 1, STREAM_HEADER.size + 8):
+        try:
+            CiphertextReader(io.BytesIO(data[:n]))
+        except ValueError:
+            pass
+        else:
+            assert False, "truncated header accepted"
+    for n in range(INT_HEADER.size):
+        try:
+            decode_int(encode_int(2 ** 70)[:n])
+        except ValueError:
+            pass
+        else:
+            assert False, "truncated integer accepted"
+    encoded = encode_public_key(pk)
+    for n in (0, 3, PK_HEADER.size, len(encoded) - 1):
+        try:
+            decode_public_key(encoded[:n])
+        except ValueError:
+            pass
+        else:
+            assert False, "truncated public key accepted"
+
+
+if __name__ == "__main__":
+    test_wire()
@@ -16,22 +16,24 @@ import Crypto.Util.number
 
 from aes import AES_key
 import OT
-from logic_circuit import Gate
+from logic_circuit import Gate, evaluate_gates
 
-def garble_circuit(circuit, myinputs):
+def garble_circuit(circuit, myinputs, ot_mode="elgamal"):
     """Garble a circuit
 
     :param circuit: circuit to garble
     :type circuit: logic_circuit.Circuit
     :param myinputs: already known inputs, to be hidden
     :type myinputs: dictionnary {gate_id: 0/1}
+    :param ot_mode: "elgamal" (OT.Sender, 20-bit keys) or "dh" (OT.DHSender,
+        full 128-bit keys)
     :return: Garbled circuit, ungarbling keys associated to myinputs and OT
         senders for other inputs.
     :rtype: (garbled_table, input_keys, ot_senders)
 
     - garbled_table: dictionnary {gate_id: 4*[AES_key]}
     - input_keys: dictionnary {input_gate_id: AES_key}
-    - ot_senders: dictionnary {input_gate_id: OT.Sender}
+    - ot_senders: dictionnary {input_gate_id: OT.Sender or OT.DHSender}
 
     @student: What are the key steps in this function that make it such that
     the inputs of Alice are not revealed to Bob ?
@@ -50,12 +52,15 @@ def garble_circuit(circuit, myinputs):
         assert circuit.g[g_id].kind == "INPUT"
         assert g_value in (0, 1)
 
+    # Keys must be short enough for the OTs to transfer them.
+    nbr_zero = OT.KEY_ZERO_BITS[ot_mode]
+
     # ---- Garbling keys generation ----
     for g_id in circuit.g:
         # For output gates, we encrypt the binary output instead of an AES key.
         if not g_id in circuit.output_gates:
-            k_0 = AES_key.gen_random()
-            k_1 = AES_key.gen_random()
+            k_0 = AES_key.gen_random(nbr_zero)
+            k_1 = AES_key.gen_random(nbr_zero)
             output_table[g_id] = (k_0, k_1)
 
     # ---- Garbled tables generation ----
@@ -91,11 +96,19 @@ def garble_circuit(circuit, myinputs):
     for g_id, gate in six.iteritems(circuit.g):
         if gate.kind == "INPUT" and g_id not in myinputs:
             k0, k1 = output_table[g_id]
-            ot_senders[g_id] = OT.Sender(k0, k1)
+            ot_senders[g_id] = OT.SENDERS[ot_mode](k0, k1)
     return (garbled_table, input_keys, ot_senders)
 
 
-def evaluate_garbled_circuit(circuit, myinputs, garbled_table, input_keys, ot_senders):
+def evaluate_garbled_circuit(
+    circuit,
+    myinputs,
+    garbled_table,
+    input_keys,
+    ot_senders,
+    ot_extension=None,
+    ot_pool=None,
+):
     """Evaluate a garbled circuit
 
     :param circuit: circuit to evaluate
@@ -108,6 +121,10 @@ def evaluate_garbled_circuit(circuit, myinputs, garbled_table, input_keys, ot_se
     :type input_keys: dictionnary {input_gate_id: AES_key}
     :param ot_senders: OT senders to recover missing input keys using myinputs
         values
+    :param ot_extension: whether to use OT extension for the OTs (see
+        OT.transfer_many)
+    :param ot_pool: OT.RandomOTPool of precomputed random OTs to use for the
+        OTs
     :return: State of the evaluated circuit
     :rtype: dictionnary {gate_id: gate_output_value}
 
@@ -124,44 +141,30 @@ def evaluate_garbled_circuit(circuit, myinputs, garbled_table, input_keys, ot_se
     # ---- make OTs, store resulting keys in state ----
     # <to be completed by students>
 
-    for i in myinputs:
-        b = myinputs[i]
-        Bob = OT.Receiver()
-
-        c = Bob.challenge(b)
-        pk = Bob.pk
-
-        e0, e1 = ot_senders[i].response(c, pk)
-        k = Bob.decrypt_response(e0, e1, b)
-
+    ids = list(myinputs)
+    keys = OT.transfer_many(
+        [ot_senders[i] for i in ids],
+        [myinputs[i] for i in ids],
+        ot_extension,
+        ot_pool,
+    )
+    for i, k in zip(ids, keys):
         state[i] = k
 
     # </to be completed by students>
 
-    # ---- Recursive ungarbling ----
-    def _evaluate_garbled_gate_rec(g_id):
+    # ---- Ungarbling, in topological order ----
+    def _evaluate_garbled_gate(g_id, gate, key0, key1):
         # <to be completed by students>
 
-        gate = circuit.g[g_id]
-
-        if gate.in0_id not in state:
-            _evaluate_garbled_gate_rec(gate.in0_id)
-
-        if gate.in1_id not in state:
-            _evaluate_garbled_gate_rec(gate.in1_id)
-
-        key0 = state[gate.in0_id]
-        key1 = state[gate.in1_id]
-
         for line in garbled_table[g_id]:
             decoded_line = _decode_decryption(key1.decrypt(key0.decrypt(line)))
             if decoded_line is not None:
-                state[g_id] = decoded_line
+                return decoded_line
 
         # </to be completed by students>
 
-    for g_id in circuit.output_gates:
-        _evaluate_garbled_gate_rec(g_id)
+    evaluate_gates(circuit, state, _evaluate_garbled_gate)
 
     return state
 
@@ -14,24 +14,58 @@ import six
 from Crypto.Random import random
 import Crypto.Util.number
 
-from aes import AES_key
+from aes import AES_key, FixedKeyHash
 import OT
-from logic_circuit import Gate
+from logic_circuit import Gate, evaluate_gates
 
-def garble_circuit(circuit, myinputs):
+# Garbling backends: "aes" encrypts each row with AES under the two input
+# keys (8 key schedules per gate), "fixed_key" masks the rows with the
+# fixed-key AES hash of aes.FixedKeyHash.
+BACKENDS = ("aes", "fixed_key")
+# Garbling schemes: "trial" tables have 4 shuffled 32-byte rows, the
+# evaluator trial-decrypts them until the marker is valid.
+# "point_and_permute" tables have 4 16-byte rows ordered by the select bits
+# (least significant bits) of the input keys: the evaluator decrypts one row.
+# "grr3" (garbled row reduction) derives the output key of the first row from
+# the hash, which is then not sent: 3 rows.
+# "half_gates" garbles an AND as two half gates: 2 rows.
+# With the last two, the output keys of the gates are derived while garbling,
+# AND(a, a), NAND(a, a) (...) are free, and the tables of output gates end
+# with a block holding the select bit of their 0-key, to decode the output.
+SCHEMES = ("trial", "point_and_permute", "grr3", "half_gates")
+ROW_REDUCED_SCHEMES = ("grr3", "half_gates")
+# NAND, OR, NOR are ANDs with inverted inputs and output (free inversions):
+# kind(x, y) == ((x ^ alpha) & (y ^ beta)) ^ gamma
+AND_FORMS = {
+    "AND": (0, 0, 0),
+    "NAND": (0, 0, 1),
+    "OR": (1, 1, 1),
+    "NOR": (1, 1, 0),
+}
+
+
+def garble_circuit(
+    circuit, myinputs, ot_mode="elgamal", backend="aes", scheme="trial"
+):
     """Garble a circuit
 
     :param circuit: circuit to garble
     :type circuit: logic_circuit.Circuit
     :param myinputs: already known inputs, to be hidden
     :type myinputs: dictionnary {gate_id: 0/1}
+    :param ot_mode: "elgamal" (OT.Sender, 20-bit keys) or "dh" (OT.DHSender,
+        full 128-bit keys)
+    :param backend: garbling backend, see BACKENDS. The evaluator must use
+        the same one.
+    :param scheme: garbling scheme, see SCHEMES. The evaluator must use the
+        same one.
     :return: Garbled circuit, ungarbling keys associated to myinputs and OT
         senders for other inputs.
     :rtype: (garbled_table, input_keys, ot_senders)
 
     - garbled_table: dictionnary {gate_id: 4*[AES_key]}
     - input_keys: dictionnary {input_gate_id: AES_key}
-    - ot_senders: dictionnary {input_gate_id: OT.Sender}
+    - ot_senders: dictionnary {input_gate_id: OT.Sender or OT.DHSender}
 
     @student: What are the key steps in this function that make it such that
     the inputs of Alice are not revealed to Bob ?
@@ -45,49 +79,66 @@ def garble_circuit(circuit, myinputs):
     # OT senders for inputs of the other guy => public
     ot_senders = {}
 
-    # global random R value for Free-Xor
-    R = AES_key.gen_random().as_int()
-
     # ---- Input validation ----
     for g_id, g_value in six.iteritems(myinputs):
         assert circuit.g[g_id].kind == "INPUT"
         assert g_value in (0, 1)
 
+    # Keys must be short enough for the OTs to transfer them.
+    nbr_zero = OT.KEY_ZERO_BITS[ot_mode]
+
+    # global random R value for Free-Xor
+    R = AES_key.gen_random(nbr_zero).as_int()
+    if scheme != "trial":
+        # k_0 and k_1 = k_0 ^ R have different select bits
+        R |= 1
+
     # ---- Garbling keys generation ----
     ordered_gates = circuit.ordered_gates()
     for g_id in ordered_gates:
+        if scheme in ROW_REDUCED_SCHEMES and circuit.g[g_id].kind != "INPUT":
+            # derived while garbling, see _garble_row_reduced
+            continue
         # For output gates, we encrypt the binary output instead of an AES key.
         if not g_id in circuit.output_gates:
             # FREEXOR GATE
             if circuit.g[g_id].kind == "XOR":
                 k_0 = AES_key.from_int(output_table[circuit.g[g_id].in0_id][0].as_int() ^ output_table[circuit.g[g_id].in1_id][0].as_int())
             else:
-                k_0 = AES_key.gen_random()
+                k_0 = AES_key.gen_random(nbr_zero)
             k_1 = AES_key.from_int(k_0.as_int() ^ R)
             output_table[g_id] = (k_0, k_1)
 
     # ---- Garbled tables generation ----
-    for g_id, gate in six.iteritems(circuit.g):
-        # We already retrieved the values for all the input gates.
-        if gate.kind != "INPUT" and (gate.kind != "XOR" or g_id in circuit.output_gates): # no need to garble xor gates
-            K_0 = output_table[gate.in0_id]  # K_0 = k_00, k_01
-            K_1 = output_table[gate.in1_id]  # K_1 = k_10, k_11
-            c_list = []
-            for i in range(2):
-                for j in range(2):
-                    # 'real' evaluation of the gate on i,j
-                    alpha = Gate.compute_gate(gate.kind, i, j)
-                    if g_id in circuit.output_gates:
-                        m = _encode_int(alpha)  # 0 or 1
-                    else:
-                        K = output_table[g_id]
-                        m = _encode_key(K[alpha])  # k_0 or k_1 (see above)
-                    c = K_1[j].encrypt(m)
-                    c_ij = K_0[i].encrypt(c)
-                    c_list.append(c_ij)
-            # @students: Why is it important to shuffle the list?
-            random.shuffle(c_list)
-            garbled_table[g_id] = c_list
+    assert backend in BACKENDS and scheme in SCHEMES
+    if scheme in ROW_REDUCED_SCHEMES:
+        garbled_table = _garble_row_reduced(circuit, output_table, R, scheme, backend)
+    elif scheme == "point_and_permute":
+        garbled_table = _garble_tables_point_and_permute(circuit, output_table, backend)
+    elif backend == "fixed_key":
+        garbled_table = _garble_tables_fixed_key(circuit, output_table)
+    else:
+        for g_id, gate in six.iteritems(circuit.g):
+            # We already retrieved the values for all the input gates.
+            if gate.kind != "INPUT" and (gate.kind != "XOR" or g_id in circuit.output_gates): # no need to garble xor gates
+                K_0 = output_table[gate.in0_id]  # K_0 = k_00, k_01
+                K_1 = output_table[gate.in1_id]  # K_1 = k_10, k_11
+                c_list = []
+                for i in range(2):
+                    for j in range(2):
+                        # 'real' evaluation of the gate on i,j
+                        alpha = Gate.compute_gate(gate.kind, i, j)
+                        if g_id in circuit.output_gates:
+                            m = _encode_int(alpha)  # 0 or 1
+                        else:
+                            K = output_table[g_id]
+                            m = _encode_key(K[alpha])  # k_0 or k_1 (see above)
+                        c = K_1[j].encrypt(m)
+                        c_ij = K_0[i].encrypt(c)
+                        c_list.append(c_ij)
+                # @students: Why is it important to shuffle the list?
+                random.shuffle(c_list)
+                garbled_table[g_id] = c_list
 
     # ---- Ungarbling keys generation for my inputs ----
     for g_id, input_val in six.iteritems(myinputs):
@@ -99,11 +150,21 @@ def garble_circuit(circuit, myinputs):
     for g_id, gate in six.iteritems(circuit.g):
         if gate.kind == "INPUT" and g_id not in myinputs:
             k0, k1 = output_table[g_id]
-            ot_senders[g_id] = OT.Sender(k0, k1)
+            ot_senders[g_id] = OT.SENDERS[ot_mode](k0, k1)
     return (garbled_table, input_keys, ot_senders)
 
 
-def evaluate_garbled_circuit(circuit, myinputs, garbled_table, input_keys, ot_senders):
+def evaluate_garbled_circuit(
+    circuit,
+    myinputs,
+    garbled_table,
+    input_keys,
+    ot_senders,
+    ot_extension=None,
+    ot_pool=None,
+    backend="aes",
+    scheme="trial",
+):
     """Evaluate a garbled circuit
 
     :param circuit: circuit to evaluate
@@ -116,6 +177,12 @@ def evaluate_garbled_circuit(circuit, myinputs, garbled_table, input_keys, ot_se
     :type input_keys: dictionnary {input_gate_id: AES_key}
     :param ot_senders: OT senders to recover missing input keys using myinputs
         values
+    :param ot_extension: whether to use OT extension for the OTs (see
+        OT.transfer_many)
+    :param ot_pool: OT.RandomOTPool of precomputed random OTs to use for the
+        OTs
+    :param backend: garbling backend used by the garbler
+    :param scheme: garbling scheme used by the garbler
     :return: State of the evaluated circuit
     :rtype: dictionnary {gate_id: gate_output_value}
 
@@ -132,51 +199,659 @@ def evaluate_garbled_circuit(circuit, myinputs, garbled_table, input_keys, ot_se
     # ---- make OTs, store resulting keys in state ----
     # <to be completed by students>
 
-    for i in myinputs:
-        b = myinputs[i]
-        Bob = OT.Receiver()
-
-        c = Bob.challenge(b)
-        pk = Bob.pk
-
-        e0, e1 = ot_senders[i].response(c, pk)
-        k = Bob.decrypt_response(e0, e1, b)
-
+    ids = list(myinputs)
+    keys = OT.transfer_many(
+        [ot_senders[i] for i in ids],
+        [myinputs[i] for i in ids],
+        ot_extension,
+        ot_pool,
+    )
+    for i, k in zip(ids, keys):
         state[i] = k
 
     # </to be completed by students>
 
-    # ---- Recursive ungarbling ----
-    def _evaluate_garbled_gate_rec(g_id):
-        # <to be completed by students>
-
-        gate = circuit.g[g_id]
-
-        if gate.in0_id not in state:
-            _evaluate_garbled_gate_rec(gate.in0_id)
+    # ---- Ungarbling, in topological order ----
+    assert backend in BACKENDS and scheme in SCHEMES
+    H = _hash_function(backend)
+    if backend == "fixed_key" or scheme in ROW_REDUCED_SCHEMES:
+        index = circuit.compile().index
 
-        if gate.in1_id not in state:
-            _evaluate_garbled_gate_rec(gate.in1_id)
+    if scheme in ROW_REDUCED_SCHEMES:
+        # layer by layer, with one call to H per layer (see _evaluate_layer)
+        labels = dict((g_id, k.as_int()) for g_id, k in six.iteritems(state))
+        for layer in circuit.layers():
+            state.update(
+                _evaluate_layer(circuit, layer, labels, garbled_table, scheme, H, index)
+            )
+        for g_id, label in six.iteritems(labels):
+            if g_id not in state:
+                state[g_id] = AES_key.from_int(label)
+        return state
 
-        key0 = state[gate.in0_id]
-        key1 = state[gate.in1_id]
+    def _evaluate_garbled_gate(g_id, gate, key0, key1):
+        # <to be completed by students>
 
         if gate.kind == "XOR" and g_id not in circuit.output_gates:
-            state[g_id] = AES_key.from_int(key0.as_int() ^ key1.as_int())
+            return AES_key.from_int(key0.as_int() ^ key1.as_int())
+        if scheme == "point_and_permute":
+            a, b = key0.as_int(), key1.as_int()
+            line = garbled_table[g_id][2 * (a & 1) + (b & 1)]
+            if backend == "fixed_key":
+                pad = _fixed_key_pads(H, index[g_id], [a], [b], 1)[0]
+                d = Crypto.Util.number.bytes_to_long(line) ^ pad
+            else:
+                d = Crypto.Util.number.bytes_to_long(key1.decrypt(key0.decrypt(line)))
+            return d if g_id in circuit.output_gates else AES_key.from_int(d)
+        if backend == "fixed_key":
+            pad = _fixed_key_pads(H, index[g_id], [key0.as_int()], [key1.as_int()])[0]
+            lines = (_xor_bytes(line, pad) for line in garbled_table[g_id])
         else:
-            for line in garbled_table[g_id]:
-                decoded_line = _decode_decryption(key1.decrypt(key0.decrypt(line)))
-                if decoded_line is not None:
-                    state[g_id] = decoded_line
+            lines = (key1.decrypt(key0.decrypt(line)) for line in garbled_table[g_id])
+        for line in lines:
+            decoded_line = _decode_decryption(line)
+            if decoded_line is not None:
+                return decoded_line
 
         # </to be completed by students>
 
-    for g_id in circuit.output_gates:
-        _evaluate_garbled_gate_rec(g_id)
+    evaluate_gates(circuit, state, _evaluate_garbled_gate)
 
     return state
 
 
+def _fixed_key_pads(H, t, keys0, keys1, blocks=2):
+    """Masks of the rows of gate number t, for every pair of input keys.
+
+    A row is blocks (1 or 2) blocks long: for keys a and b, the mask of
+    block i is the hash of both keys H(a, b, 4t + i). XOR-ing hashes of each
+    key, H(a, 4t + i) ^ H(b, 4t + 2 + i), would give masks that XOR to 0 over
+    the 4 rows, which then XOR to the free-XOR offset.
+
+    :type keys0: list of int
+    :type keys1: list of int
+    :return: masks, keys0 major
+    :rtype: list of int (128 * blocks bits)
+    """
+    return _masks(H.hash2_many(*_hash_inputs(t, keys0, keys1, blocks)), blocks)
+
+
+def _hash_inputs(t, keys0, keys1, blocks):
+    """Keys and tweaks to hash (with H.hash2_many) for the masks of gate
+    number t, keys0 major."""
+    pairs = [(a, b) for a in keys0 for b in keys1 for _ in range(blocks)]
+    tweaks = [4 * t + i for _ in keys0 for _ in keys1 for i in range(blocks)]
+    return [a for a, _ in pairs], [b for _, b in pairs], tweaks
+
+
+def _masks(h, blocks):
+    """Masks of blocks blocks from the hashes h of _hash_inputs."""
+    res = []
+    for n in range(0, len(h), blocks):
+        m = 0
+        for x in h[n : n + blocks]:
+            m = (m << 128) | x
+        res.append(m)
+    return res
+
+
+def _xor_bytes(b, x):
+    """b ^ x for a 32-byte string b and an integer x.
+
+    :rtype: bytes
+    """
+    return Crypto.Util.number.long_to_bytes(Crypto.Util.number.bytes_to_long(b) ^ x, 32)
+
+
+def _garbled_gates(circuit):
+    """Gates that need a garbled table: non-XOR gates and output gates.
+
+    :rtype: list of (gate_id, Gate)
+    """
+    return [
+        (g_id, gate)
+        for g_id, gate in six.iteritems(circuit.g)
+        if gate.kind != "INPUT"
+        and (gate.kind != "XOR" or g_id in circuit.output_gates)
+    ]
+
+
+def _all_fixed_key_masks(circuit, output_table, gates, blocks):
+    """Masks of the rows of all gates, with a single call to AES.
+
+    :return: for each gate, masks[2*i + j] for input keys k_0i and k_1j
+    :rtype: list of 4*[int]
+    """
+    index = circuit.compile().index
+    keys0 = []
+    keys1 = []
+    tweaks = []
+    for g_id, gate in gates:
+        k0 = [k.as_int() for k in output_table[gate.in0_id]]
+        k1 = [k.as_int() for k in output_table[gate.in1_id]]
+        ks0, ks1, ts = _hash_inputs(index[g_id], k0, k1, blocks)
+        keys0 += ks0
+        keys1 += ks1
+        tweaks += ts
+    masks = _masks(FixedKeyHash().hash2_many(keys0, keys1, tweaks), blocks)
+    return [masks[4 * g : 4 * (g + 1)] for g in range(len(gates))]
+
+
+def _garble_tables_fixed_key(circuit, output_table):
+    """Garbled tables of the "trial" scheme with the "fixed_key" backend.
+
+    :rtype: dictionnary {gate_id: 4*[bytes]}
+    """
+    gates = _garbled_gates(circuit)
+    masks = _all_fixed_key_masks(circuit, output_table, gates, 2)
+    garbled_table = {}
+    for (g_id, gate), gate_masks in zip(gates, masks):
+        c_list = []
+        for i in range(2):
+            for j in range(2):
+                alpha = Gate.compute_gate(gate.kind, i, j)
+                if g_id in circuit.output_gates:
+                    m = _encode_int(alpha)
+                else:
+                    m = _encode_key(output_table[g_id][alpha])
+                c_list.append(_xor_bytes(m, gate_masks[2 * i + j]))
+        random.shuffle(c_list)
+        garbled_table[g_id] = c_list
+    return garbled_table
+
+
+def _garble_tables_point_and_permute(circuit, output_table, backend):
+    """Garbled tables of the "point_and_permute" scheme.
+
+    Row 2 * (i ^ p_0) + (j ^ p_1) encrypts the output for inputs i, j, where
+    p_0 and p_1 are the select bits of the 0-keys of the inputs. The output
+    is the output key, or the output bit for output gates, as a 16-byte
+    block.
+
+    :rtype: dictionnary {gate_id: 4*[bytes]}
+    """
+    gates = _garbled_gates(circuit)
+    if backend == "fixed_key":
+        masks = _all_fixed_key_masks(circuit, output_table, gates, 1)
+    garbled_table = {}
+    for n, (g_id, gate) in enumerate(gates):
+        K_0 = output_table[gate.in0_id]
+        K_1 = output_table[gate.in1_id]
+        p_0 = K_0[0].as_int() & 1
+        p_1 = K_1[0].as_int() & 1
+        rows = [None] * 4
+        for i in range(2):
+            for j in range(2):
+                alpha = Gate.compute_gate(gate.kind, i, j)
+                if g_id in circuit.output_gates:
+                    m = int(alpha)
+                else:
+                    m = output_table[g_id][alpha].as_int()
+                if backend == "fixed_key":
+                    c = Crypto.Util.number.long_to_bytes(m ^ masks[n][2 * i + j], 16)
+                else:
+                    c = K_0[i].encrypt(K_1[j].encrypt(m))
+                rows[2 * (i ^ p_0) + (j ^ p_1)] = c
+        garbled_table[g_id] = rows
+    return garbled_table
+
+
+class _PerKeyHash:
+    """H(k, T) = AES_k(T) and H(a, b, T) = AES_b(AES_a(T)), one key schedule
+    per key (the "aes" backend)."""
+
+    def hash_many(self, keys, tweaks):
+        return [
+            Crypto.Util.number.bytes_to_long(AES_key.from_int(k).encrypt(t))
+            for k, t in zip(keys, tweaks)
+        ]
+
+    def hash2_many(self, keys0, keys1, tweaks):
+        return [
+            Crypto.Util.number.bytes_to_long(
+                AES_key.from_int(b).encrypt(AES_key.from_int(a).encrypt(t))
+            )
+            for a, b, t in zip(keys0, keys1, tweaks)
+        ]
+
+
+def _hash_function(backend):
+    return FixedKeyHash() if backend == "fixed_key" else _PerKeyHash()
+
+
+def _block(x):
+    return Crypto.Util.number.long_to_bytes(x, 16)
+
+
+def _garble_row_reduced(circuit, output_table, R, scheme, backend):
+    """Garbled tables of the "grr3" and "half_gates" schemes.
+
+    The gates are garbled layer by layer (see _garble_layer). output_table
+    is completed with the keys of the other gates.
+
+    :rtype: dictionnary {gate_id: list of 16-byte blocks}
+    """
+    H = _hash_function(backend)
+    index = circuit.compile().index
+    labels = dict((g_id, k[0].as_int()) for g_id, k in six.iteritems(output_table))
+    garbled_table = {}
+    for layer in circuit.layers():
+        garbled_table.update(_garble_layer(circuit, layer, labels, R, scheme, H, index))
+        for g_id in layer:
+            if g_id not in output_table and g_id not in circuit.output_gates:
+                output_table[g_id] = (
+                    AES_key.from_int(labels[g_id]),
+                    AES_key.from_int(labels[g_id] ^ R),
+                )
+    return garbled_table
+
+
+def _table_blocks(circuit, g_id, gate, scheme):
+    """Number of 16-byte blocks of the table of a gate with a row-reduced
+    scheme (0 if the gate has no table)."""
+    if gate.kind == "INPUT":
+        return 0
+    if gate.kind == "XOR" or gate.in0_id == gate.in1_id:
+        n = 0
+    else:
+        n = 2 if scheme == "half_gates" else 3
+    return n + 1 if g_id in circuit.output_gates else n
+
+
+def _garble_layer(circuit, layer, labels, R, scheme, H, index):
+    """Garble the gates of a layer with a row-reduced scheme.
+
+    The output keys depend on the hashes of the input keys, which come from
+    the previous layers: the hashes of the whole layer are computed with a
+    single call to H. A "grr3" row is masked with the hash of both its input
+    keys, H(a, b, T): with H(a, T) ^ H(b, T'), the masks of the 4 rows would
+    XOR to 0 and the XOR of the 3 rows sent would be R.
+
+    :param labels: 0-keys of the gates (as integers), completed with the
+        gates of layer
+    :return: tables of the gates of layer that have one, in layer order
+    :rtype: list of (gate_id, list of 16-byte blocks)
+    """
+    g = circuit.g
+    pending = []
+    keys = []
+    keys1 = []
+    tweaks = []
+    for g_id in layer:
+        gate = g[g_id]
+        if gate.kind == "INPUT":
+            continue
+        a0, b0 = labels[gate.in0_id], labels[gate.in1_id]
+        if gate.kind == "XOR":
+            labels[g_id] = a0 ^ b0
+        elif gate.in0_id == gate.in1_id:
+            # free: kind(a, a) == a ^ alpha ^ gamma, a for AND and OR,
+            # not a for NAND and NOR
+            alpha, _, gamma = AND_FORMS[gate.kind]
+            labels[g_id] = a0 ^ (R if alpha ^ gamma else 0)
+        else:
+            t = index[g_id]
+            pending.append((g_id, gate))
+            if scheme == "half_gates":
+                alpha, beta, _ = AND_FORMS[gate.kind]
+                a0 ^= alpha * R
+                b0 ^= beta * R
+                keys += [a0, a0 ^ R, b0, b0 ^ R]
+                tweaks += [4 * t, 4 * t, 4 * t + 1, 4 * t + 1]
+            else:
+                # H(a_i, b_j) for i, j in 00, 01, 10, 11
+                keys += [a0, a0, a0 ^ R, a0 ^ R]
+                keys1 += [b0, b0 ^ R, b0, b0 ^ R]
+                tweaks += [4 * t] * 4
+    if not keys:
+        h = []
+    elif scheme == "half_gates":
+        h = H.hash_many(keys, tweaks)
+    else:
+        h = H.hash2_many(keys, keys1, tweaks)
+    tables = {}
+    for n, (g_id, gate) in enumerate(pending):
+        a0, b0 = labels[gate.in0_id], labels[gate.in1_id]
+        if scheme == "half_gates":
+            alpha, beta, gamma = AND_FORMS[gate.kind]
+            a0 ^= alpha * R
+            b0 ^= beta * R
+            ha0, ha1, hb0, hb1 = h[4 * n : 4 * (n + 1)]
+            p_a, p_b = a0 & 1, b0 & 1
+            # generator half gate
+            t_g = ha0 ^ ha1 ^ (R if p_b else 0)
+            w_g = ha0 ^ (t_g if p_a else 0)
+            # evaluator half gate
+            t_e = hb0 ^ hb1 ^ a0
+            w_e = hb0 ^ ((t_e ^ a0) if p_b else 0)
+            labels[g_id] = w_g ^ w_e ^ (R if gamma else 0)
+            tables[g_id] = [_block(t_g), _block(t_e)]
+        else:
+            hab = h[4 * n : 4 * (n + 1)]
+            p_a, p_b = a0 & 1, b0 & 1
+            # the row of select bits (0, 0) encrypts to 0
+            alpha = Gate.compute_gate(gate.kind, p_a, p_b)
+            c0 = hab[2 * p_a + p_b] ^ (R if alpha else 0)
+            labels[g_id] = c0
+            rows = [None] * 3
+            for i in range(2):
+                for j in range(2):
+                    r = 2 * (i ^ p_a) + (j ^ p_b)
+                    if r == 0:
+                        continue
+                    alpha = Gate.compute_gate(gate.kind, i, j)
+                    rows[r - 1] = _block(hab[2 * i + j] ^ c0 ^ (R if alpha else 0))
+            tables[g_id] = rows
+    res = []
+    for g_id in layer:
+        if g_id in circuit.output_gates:
+            rows = tables.get(g_id, [])
+            rows.append(_block(labels[g_id] & 1))
+            res.append((g_id, rows))
+        elif g_id in tables:
+            res.append((g_id, tables[g_id]))
+    return res
+
+
+def _evaluate_layer(circuit, layer, labels, tables, scheme, H, index):
+    """Evaluate the gates of a layer garbled by _garble_layer, with a single
+    call to H.
+
+    :param labels: keys of the gates (as integers), completed with the gates
+        of layer
+    :param tables: tables of the gates of layer
+    :type tables: dictionnary {gate_id: list of 16-byte blocks}
+    :return: output bits of the output gates of layer
+    :rtype: dictionnary {gate_id: 0/1}
+    """
+    g = circuit.g
+    pending = []
+    keys = []
+    keys1 = []
+    tweaks = []
+    for g_id in layer:
+        gate = g[g_id]
+        if gate.kind == "INPUT":
+            continue
+        a, b = labels[gate.in0_id], labels[gate.in1_id]
+        if gate.kind == "XOR":
+            labels[g_id] = a ^ b
+        elif gate.in0_id == gate.in1_id:
+            labels[g_id] = a
+        else:
+            t = index[g_id]
+            pending.append((g_id, a, b))
+            if scheme == "half_gates":
+                keys += [a, b]
+                tweaks += [4 * t, 4 * t + 1]
+            else:
+                keys.append(a)
+                keys1.append(b)
+                tweaks.append(4 * t)
+    if not keys:
+        h = []
+    elif scheme == "half_gates":
+        h = H.hash_many(keys, tweaks)
+    else:
+        h = H.hash2_many(keys, keys1, tweaks)
+    for n, (g_id, a, b) in enumerate(pending):
+        rows = tables[g_id]
+        if scheme == "half_gates":
+            ha, hb = h[2 * n], h[2 * n + 1]
+            t_g = Crypto.Util.number.bytes_to_long(rows[0])
+            t_e = Crypto.Util.number.bytes_to_long(rows[1])
+            labels[g_id] = ha ^ (t_g if a & 1 else 0) ^ hb ^ ((t_e ^ a) if b & 1 else 0)
+        else:
+            r = 2 * (a & 1) + (b & 1)
+            labels[g_id] = h[n] ^ (Crypto.Util.number.bytes_to_long(rows[r - 1]) if r else 0)
+    return dict(
+        (g_id, (labels[g_id] & 1) ^ tables[g_id][-1][-1])
+        for g_id in layer
+        if g_id in circuit.output_gates
+    )
+
+
+def table_size(garbled_table):
+    """Size of the garbled tables in bytes (the communication of garbling).
+
+    :rtype: int
+    """
+    return sum(len(row) for rows in six.itervalues(garbled_table) for row in rows)
+
+
+# Circuit of the worker processes of garble_many and evaluate_many.
+_worker_circuit = None
+
+
+def _init_worker(circuit):
+    global _worker_circuit
+    _worker_circuit = circuit
+    # no-op if the cache was inherited from the parent (fork)
+    circuit.compile()
+
+
+def _in_worker(args):
+    fn, task = args
+    return fn(_worker_circuit, task)
+
+
+def _garble_session(circuit, args):
+    i, myinputs, ot_mode, backend, scheme = args
+    return i, garble_circuit(circuit, myinputs, ot_mode, backend, scheme)
+
+
+def _evaluate_session(circuit, args):
+    i, session, ot_extension, backend, scheme = args
+    myinputs, garbled_table, input_keys, ot_senders = session
+    return i, evaluate_garbled_circuit(
+        circuit,
+        myinputs,
+        garbled_table,
+        input_keys,
+        ot_senders,
+        ot_extension,
+        backend=backend,
+        scheme=scheme,
+    )
+
+
+def _map_sessions(circuit, fn, tasks, workers):
+    """Run fn(circuit, task) over tasks in workers processes, sharing
+    circuit, and yield the results as they are finished."""
+    circuit.compile()
+    if workers is None or workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield fn(circuit, task)
+        return
+    import multiprocessing
+
+    # The circuit is given to each worker once (inherited with its compiled
+    # form when the processes are forked), not with every session.
+    pool = multiprocessing.Pool(workers, _init_worker, (circuit,))
+    try:
+        for res in pool.imap_unordered(_in_worker, [(fn, task) for task in tasks]):
+            yield res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def garble_many(
+    circuit, inputs_list, workers=None, ot_mode="elgamal", backend="aes", scheme="trial"
+):
+    """Garble circuit for many independent sessions, see garble_circuit.
+
+    :param inputs_list: inputs of the garbler in each session
+    :type inputs_list: list of dictionnaries {gate_id: 0/1}
+    :param workers: if not None, number of processes to spread the sessions
+        over
+    :return: generator of the garbled sessions, as soon as they are finished
+        (hence not in order)
+    :rtype: generator of (session number, (garbled_table, input_keys,
+        ot_senders))
+    """
+    tasks = [(i, myinputs, ot_mode, backend, scheme) for i, myinputs in enumerate(inputs_list)]
+    return _map_sessions(circuit, _garble_session, tasks, workers)
+
+
+def evaluate_many(
+    circuit, sessions, workers=None, ot_extension=None, backend="aes", scheme="trial"
+):
+    """Evaluate many garbled sessions of circuit, see
+    evaluate_garbled_circuit.
+
+    :param sessions: evaluator inputs, garbled table, input keys and OT
+        senders of each session
+    :type sessions: list of (myinputs, garbled_table, input_keys, ot_senders)
+    :param workers: if not None, number of processes to spread the sessions
+        over
+    :return: generator of the states of the evaluated sessions, as soon as
+        they are finished
+    :rtype: generator of (session number, state)
+    """
+    tasks = [(i, session, ot_extension, backend, scheme) for i, session in enumerate(sessions)]
+    return _map_sessions(circuit, _evaluate_session, tasks, workers)
+
+
+def bench_schemes(bits=16, repeat=3):
+    """Compare the garbling schemes on the same circuits (bits-bit adder and
+    multiplier): size of the tables and garbling/evaluation speed (OTs
+    excluded).
+
+    "classic" is garbled_circuit (no free-XOR).
+    """
+    import time
+    import garbled_circuit
+    from circuit_builder import CircuitBuilder
+
+    configs = [("classic", None, "aes")]
+    configs += [("free-XOR", "trial", backend) for backend in BACKENDS]
+    configs += [(scheme, scheme, "fixed_key") for scheme in SCHEMES[1:]]
+    for op in ("add", "mul"):
+        b = CircuitBuilder()
+        x = b.input("x", bits)
+        y = b.input("y", bits)
+        b.output("r", getattr(b, op)(x, y))
+        circuit = b.circuit()
+        xv, yv = random.getrandbits(bits), random.getrandbits(bits)
+        inputs = b.input_values("x", xv)
+        inputs.update(b.input_values("y", yv))
+        expected = (xv + yv if op == "add" else xv * yv) % 2 ** bits
+        print("%d-bit %s, %d gates" % (bits, op, len(circuit.g)))
+        for name, scheme, backend in configs:
+            garble = evaluate = 0.0
+            for _ in range(repeat):
+                start = time.time()
+                if scheme is None:
+                    table, keys, _ = garbled_circuit.garble_circuit(
+                        circuit, inputs, "dh"
+                    )
+                else:
+                    table, keys, _ = garble_circuit(
+                        circuit, inputs, "dh", backend, scheme
+                    )
+                garble += time.time() - start
+                start = time.time()
+                if scheme is None:
+                    state = garbled_circuit.evaluate_garbled_circuit(
+                        circuit, {}, table, keys, {}
+                    )
+                else:
+                    state = evaluate_garbled_circuit(
+                        circuit, {}, table, keys, {}, backend=backend, scheme=scheme
+                    )
+                evaluate += time.time() - start
+                assert b.output_value(state, "r") == expected
+            n = len(circuit.g) * repeat
+            print(
+                "  %-17s %-9s %8d bytes  garble: %7.0f gates/s  evaluate: %7.0f gates/s"
+                % (name, backend, table_size(table), n / garble, n / evaluate)
+            )
+
+
+def bench_backends(bits=16, repeat=3):
+    """Garbling and evaluation speed of each backend and scheme, in
+    (non-free) gates per second, on a bits-bit multiplier (OTs excluded).
+    """
+    import time
+    from circuit_builder import CircuitBuilder
+
+    b = CircuitBuilder()
+    x = b.input("x", bits)
+    y = b.input("y", bits)
+    b.output("p", b.mul(x, y))
+    circuit = b.circuit()
+    xv, yv = random.getrandbits(bits), random.getrandbits(bits)
+    inputs = b.input_values("x", xv)
+    inputs.update(b.input_values("y", yv))
+    for scheme in SCHEMES:
+        for backend in BACKENDS:
+            garble = evaluate = 0.0
+            for _ in range(repeat):
+                start = time.time()
+                table, keys, senders = garble_circuit(
+                    circuit, inputs, "dh", backend, scheme
+                )
+                garble += time.time() - start
+                start = time.time()
+                state = evaluate_garbled_circuit(
+                    circuit, {}, table, keys, {}, backend=backend, scheme=scheme
+                )
+                evaluate += time.time() - start
+            n = len(table) * repeat
+            print(
+                "%-17s %-10s %6d gates  garble: %8.0f gates/s  evaluate: %8.0f gates/s"
+                % (scheme, backend, len(table), n / garble, n / evaluate)
+            )
+
+
+def bench_many(bits=16, sessions=32, scheme="half_gates"):
+    """Sessions per second of garble_many and evaluate_many on a bits-bit
+    multiplier, from 1 worker to all the cores (OTs with the "dh" mode
+    included).
+    """
+    import multiprocessing
+    import time
+    from circuit_builder import CircuitBuilder
+
+    b = CircuitBuilder()
+    x = b.input("x", bits)
+    y = b.input("y", bits)
+    b.output("p", b.mul(x, y))
+    circuit = b.circuit()
+    values = [(random.getrandbits(bits), random.getrandbits(bits)) for _ in range(sessions)]
+    cores = multiprocessing.cpu_count()
+    counts = sorted(set([1, cores] + [2 ** k for k in range(1, cores.bit_length()) if 2 ** k < cores]))
+    base = None
+    for workers in counts:
+        start = time.time()
+        garbled = [None] * sessions
+        for i, (table, keys, senders) in garble_many(
+            circuit,
+            [b.input_values("x", xv) for xv, _ in values],
+            workers,
+            "dh",
+            "fixed_key",
+            scheme,
+        ):
+            garbled[i] = (b.input_values("y", values[i][1]), table, keys, senders)
+        garble = time.time() - start
+        start = time.time()
+        for i, state in evaluate_many(
+            circuit, garbled, workers, backend="fixed_key", scheme=scheme
+        ):
+            xv, yv = values[i]
+            assert b.output_value(state, "p") == (xv * yv) % 2 ** bits
+        evaluate = time.time() - start
+        if base is None:
+            base = garble + evaluate
+        print(
+            "%2d workers  garble: %6.1f sessions/s  evaluate: %6.1f sessions/s  speedup: %.2f"
+            % (workers, sessions / garble, sessions / evaluate, base / (garble + evaluate))
+        )
+
+
 INT_MARKER = 15*b'\x00' + b'\x01'
 KEY_MARKER = 16*b'\x00'
 
@@ -206,3 +881,225 @@ def _decode_decryption(d):
         # @students: When is this branch taken ?
         return None
 
+
+
+def _garbled_outputs(circuit, alice, bob, ot_mode, backend, scheme, ot_extension=None):
+    """Outputs of circuit garbled with alice's inputs and evaluated with
+    bob's ones, which are transferred by OT."""
+    table, keys, senders = garble_circuit(circuit, alice, ot_mode, backend, scheme)
+    state = evaluate_garbled_circuit(
+        circuit, bob, table, keys, senders, ot_extension, backend=backend, scheme=scheme
+    )
+    return dict((o, state[o]) for o in circuit.output_gates)
+
+
+def _plain_outputs(circuit, alice, bob):
+    inputs = dict(alice)
+    inputs.update(bob)
+    state = circuit.evaluate(inputs).state
+    return dict((o, state[o]) for o in circuit.output_gates)
+
+
+def _word_circuits(bits):
+    """bits-bit adder and multiplier, with their inputs split between alice
+    (x) and bob (y)."""
+    from circuit_builder import CircuitBuilder
+
+    res = []
+    for op in ("add", "mul"):
+        b = CircuitBuilder()
+        x = b.input("x", bits)
+        y = b.input("y", bits)
+        b.output("r", getattr(b, op)(x, y))
+        xv, yv = random.getrandbits(bits), random.getrandbits(bits)
+        res.append((b.circuit(), b.input_values("x", xv), b.input_values("y", yv)))
+    return res
+
+
+def _random_circuit(n_inputs=6, n_gates=60):
+    """Random circuit with gates of every kind, some on the same wire twice
+    (e.g. NAND(a, a)), and an output gate of every kind. The inputs are
+    split between alice and bob.
+    """
+    from logic_circuit import Circuit, INPUT_GATE
+
+    g = dict((i, INPUT_GATE) for i in range(n_inputs))
+    for i in range(n_inputs, n_inputs + n_gates):
+        a = random.randrange(i)
+        b = a if random.randrange(5) == 0 else random.randrange(i)
+        g[i] = Gate(random.choice(Gate.KINDS[1:]), a, b)
+    outputs = set()
+    n = n_inputs + n_gates
+    for kind in Gate.KINDS[1:]:
+        for same in (False, True):
+            a = random.randrange(n_inputs, n)
+            g[("out", kind, same)] = Gate(kind, a, a if same else random.randrange(n))
+            outputs.add(("out", kind, same))
+    inputs = dict((i, random.getrandbits(1)) for i in range(n_inputs))
+    alice = dict((i, v) for i, v in six.iteritems(inputs) if i % 2)
+    bob = dict((i, v) for i, v in six.iteritems(inputs) if not i % 2)
+    return Circuit(g, outputs), alice, bob
+
+
+def _rows_leak_offset(table, R):
+    """Whether the XOR of some rows (2 or more) of a garbled table is the
+    free-XOR offset R (alone in a 16-byte row, or in either half of a 32-byte
+    one)."""
+    import itertools
+
+    rows = [Crypto.Util.number.bytes_to_long(row) for row in table]
+    for n in range(2, len(rows) + 1):
+        for subset in itertools.combinations(rows, n):
+            x = 0
+            for row in subset:
+                x ^= row
+            if x in (R, R << 128):
+                return True
+    return False
+
+
+def _check_rows_hide_offset(scheme, backend):
+    """No garbled table reveals R, on the circuits of the tests (all the
+    inputs are transferred by OT, R is read from the senders)."""
+    from prs import prs_circuit
+
+    circuits = [prs_circuit] + [c for c, _, _ in _word_circuits(4)]
+    circuits += [_random_circuit()[0] for _ in range(3)]
+    for circuit in circuits:
+        table, _, senders = garble_circuit(circuit, {}, "dh", backend, scheme)
+        sender = next(six.itervalues(senders))
+        R = sender.m_0.as_int() ^ sender.m_1.as_int()
+        for rows in six.itervalues(table):
+            assert not _rows_leak_offset(rows, R), (scheme, backend)
+
+
+def test_point_and_permute():
+    from prs import prs_circuit
+
+    for backend in BACKENDS:
+        for a in range(4):
+            for c in range(4):
+                alice = {"A": a & 1, "B": a >> 1}
+                bob = {"C": c & 1, "D": c >> 1}
+                assert _garbled_outputs(
+                    prs_circuit, alice, bob, "dh", backend, "point_and_permute"
+                ) == _plain_outputs(prs_circuit, alice, bob)
+        for _ in range(5):
+            circuit, alice, bob = _random_circuit()
+            assert _garbled_outputs(
+                circuit, alice, bob, "dh", backend, "point_and_permute"
+            ) == _plain_outputs(circuit, alice, bob)
+
+
+def test_garbling_schemes():
+    from prs import prs_circuit
+
+    prs_inputs = [
+        ({"A": a & 1, "B": a >> 1}, {"C": c & 1, "D": c >> 1})
+        for a in range(4)
+        for c in range(4)
+    ]
+    circuits = _word_circuits(8) + [_random_circuit() for _ in range(3)]
+    for scheme in SCHEMES:
+        for backend in BACKENDS:
+            for ot_mode in ("elgamal", "dh"):
+                for alice, bob in prs_inputs:
+                    assert _garbled_outputs(
+                        prs_circuit, alice, bob, ot_mode, backend, scheme
+                    ) == _plain_outputs(prs_circuit, alice, bob)
+                for circuit, alice, bob in circuits:
+                    assert _garbled_outputs(
+                        circuit, alice, bob, ot_mode, backend, scheme
+                    ) == _plain_outputs(circuit, alice, bob)
+
+
+def test_grr3_rows():
+    # A AND B -> AB; AB XOR C -> O: the 3 rows of AB must not XOR to R
+    from logic_circuit import Circuit, INPUT_GATE
+
+    circuit = Circuit(
+        {
+            "A": INPUT_GATE,
+            "B": INPUT_GATE,
+            "C": INPUT_GATE,
+            "AB": Gate("AND", "A", "B"),
+            "O": Gate("XOR", "AB", "C"),
+        },
+        set(["O"]),
+    )
+    for backend in BACKENDS:
+        for _ in range(10):
+            table, _, senders = garble_circuit(circuit, {}, "dh", backend, "grr3")
+            R = senders["A"].m_0.as_int() ^ senders["A"].m_1.as_int()
+            assert len(table["AB"]) == 3
+            assert not _rows_leak_offset(table["AB"], R)
+        _check_rows_hide_offset("grr3", backend)
+
+
+def test_rows_hide_offset():
+    # with any scheme and backend, no XOR of rows of a table gives R
+    for scheme in SCHEMES:
+        for backend in BACKENDS:
+            _check_rows_hide_offset(scheme, backend)
+
+
+def test_many():
+    from prs import prs_circuit
+
+    for circuit, scheme in ((prs_circuit, "trial"), (_word_circuits(8)[1][0], "half_gates")):
+        input_ids = [g_id for g_id in circuit.compile().ids if circuit.g[g_id].kind == "INPUT"]
+        alices = [
+            dict((g_id, random.getrandbits(1)) for g_id in input_ids[::2]) for _ in range(6)
+        ]
+        bobs = [
+            dict((g_id, random.getrandbits(1)) for g_id in input_ids[1::2]) for _ in range(6)
+        ]
+        sessions = [None] * len(alices)
+        for i, (table, keys, senders) in garble_many(
+            circuit, alices, 2, "dh", "fixed_key", scheme
+        ):
+            sessions[i] = (bobs[i], table, keys, senders)
+        seen = set()
+        for i, state in evaluate_many(
+            circuit, sessions, 2, backend="fixed_key", scheme=scheme
+        ):
+            expected = _plain_outputs(circuit, alices[i], bobs[i])
+            assert dict((o, state[o]) for o in circuit.output_gates) == expected
+            seen.add(i)
+        assert seen == set(range(len(alices)))
+    assert _worker_circuit is None
+
+
+def test_fixed_key_backend():
+    from prs import prs_circuit
+
+    # same results as the aes backend, with both OTs and OT extension
+    for circuit, alice, bob in _word_circuits(8):
+        expected = _plain_outputs(circuit, alice, bob)
+        for ot_mode in ("elgamal", "dh"):
+            for backend in BACKENDS:
+                assert _garbled_outputs(circuit, alice, bob, ot_mode, backend, "trial") == expected
+        assert (
+            _garbled_outputs(circuit, alice, bob, "dh", "fixed_key", "trial", True) == expected
+        )
+    for a in range(4):
+        for c in range(4):
+            alice = {"A": a & 1, "B": a >> 1}
+            bob = {"C": c & 1, "D": c >> 1}
+            assert _garbled_outputs(
+                prs_circuit, alice, bob, "dh", "fixed_key", "trial"
+            ) == _plain_outputs(prs_circuit, alice, bob)
+    # the rows of a table do not XOR to R
+    _check_rows_hide_offset("trial", "fixed_key")
+
+
+if __name__ == "__main__":
+    test_fixed_key_backend()
+    test_point_and_permute()
+    test_garbling_schemes()
+    test_grr3_rows()
+    test_rows_hide_offset()
+    test_many()
+    bench_backends()
+    bench_schemes()
+    bench_many()
@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+"""
+LELEC2770 : Privacy Enhancing Technologies
+
+Exercice Session : Secure 2-party computation
+
+Two-party garbled circuit protocol over the network
+
+The garbler and the evaluator run in separate processes and exchange frames
+over a TCP or Unix socket (asyncio streams). A frame is a 1-byte type, a
+4-byte big-endian length and the payload::
+
+    Garbler                                   Evaluator
+    HELLO (scheme, backend, OT, size)  ---->
+                                       <----  HELLO
+    INPUT_KEYS (keys of my inputs)     ---->
+                                       <----  OT_CHALLENGES (all of them)
+    OT_RESPONSES (all of them)         ---->
+    TABLES (streamed, ~TABLE_BATCH)    ---->
+                                       <----  OUTPUTS (one byte per output)
+
+Gates are numbered by their wire in circuit.compile(), which both parties
+compute from the same circuit. The tables are streamed as in garbled_stream,
+several layers per frame.
+
+Each party counts the time and bytes of every phase (see ProtocolStats).
+"""
+
+import asyncio
+import contextlib
+import struct
+import time
+
+import six
+from Crypto.Util.number import bytes_to_long, long_to_bytes
+
+from aes import AES_key
+import OT
+from elgamal import elgamal_group_gen
+from elgamal_wire import (
+    decode_ciphertext,
+    decode_public_key,
+    element_width,
+    encode_ciphertext,
+    encode_public_key,
+)
+from garbled_stream import StreamingEvaluator, StreamingGarbler
+
+FRAME_HEADER = struct.Struct(">BI")
+WIRE = struct.Struct(">I")
+HELLO, INPUT_KEYS, OT_CHALLENGES, OT_RESPONSES, TABLES, OUTPUTS = range(1, 7)
+FRAME_NAMES = {
+    HELLO: "HELLO",
+    INPUT_KEYS: "INPUT_KEYS",
+    OT_CHALLENGES: "OT_CHALLENGES",
+    OT_RESPONSES: "OT_RESPONSES",
+    TABLES: "TABLES",
+    OUTPUTS: "OUTPUTS",
+}
+# Garbled tables are sent in frames of about this many bytes.
+TABLE_BATCH = 1 << 16
+# Largest accepted frame.
+MAX_FRAME = 1 << 26
+KEY_BYTES = 16
+# Seconds a connecting party waits for the listening one.
+CONNECT_TIMEOUT = 10.0
+
+
+class ProtocolStats:
+    """Wall time and bytes sent and received in each phase of a party.
+
+    Attributes:
+    * phases: names of the phases, in order
+    * seconds, sent, received: dictionnaries {phase: value}
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.seconds = {}
+        self.sent = {}
+        self.received = {}
+
+    def add(self, phase, seconds, sent, received):
+        if phase not in self.seconds:
+            self.phases.append(phase)
+            self.seconds[phase] = self.sent[phase] = self.received[phase] = 0
+        self.seconds[phase] += seconds
+        self.sent[phase] += sent
+        self.received[phase] += received
+
+    def total(self):
+        """Total (seconds, bytes sent, bytes received)."""
+        return (
+            sum(six.itervalues(self.seconds)),
+            sum(six.itervalues(self.sent)),
+            sum(six.itervalues(self.received)),
+        )
+
+    def __str__(self):
+        lines = ["%-12s %10s %10s %10s" % ("phase", "ms", "sent", "received")]
+        for phase in self.phases + ["total"]:
+            if phase == "total":
+                seconds, sent, received = self.total()
+            else:
+                seconds = self.seconds[phase]
+                sent, received = self.sent[phase], self.received[phase]
+            lines.append("%-12s %10.1f %10d %10d" % (phase, 1000 * seconds, sent, received))
+        return "\n".join(lines)
+
+
+class _Connection:
+    """Framed connection over asyncio streams, counting bytes per phase."""
+
+    def __init__(self, reader, writer, stats):
+        self.reader = reader
+        self.writer = writer
+        self.stats = stats
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.buffer = b""
+
+    async def send(self, kind, payload):
+        self.writer.write(FRAME_HEADER.pack(kind, len(payload)))
+        self.writer.write(payload)
+        self.bytes_sent += FRAME_HEADER.size + len(payload)
+        await self.writer.drain()
+
+    async def recv(self, kind):
+        """Payload of the next frame, which must be of type kind.
+
+        :raises ValueError: if it is not
+        """
+        header = await self.reader.readexactly(FRAME_HEADER.size)
+        got, length = FRAME_HEADER.unpack(header)
+        if got != kind:
+            raise ValueError(
+                "expected a %s frame, got %s"
+                % (FRAME_NAMES[kind], FRAME_NAMES.get(got, "type %d" % got))
+            )
+        if length > MAX_FRAME:
+            raise ValueError("frame of %d bytes is too large" % length)
+        payload = await self.reader.readexactly(length)
+        self.bytes_received += FRAME_HEADER.size + length
+        return payload
+
+    async def recv_tables(self, n):
+        """Next n bytes of the TABLES frames."""
+        while len(self.buffer) < n:
+            self.buffer += await self.recv(TABLES)
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        sent, received = self.bytes_sent, self.bytes_received
+        yield
+        self.stats.add(
+            name,
+            time.perf_counter() - start,
+            self.bytes_sent - sent,
+            self.bytes_received - received,
+        )
+
+
+def _hello(circuit, ot_mode, backend, scheme):
+    return ("%s %s %s %d" % (scheme, backend, ot_mode, len(circuit.compile()))).encode(
+        "ascii"
+    )
+
+
+def _encode_keys(index, keys):
+    """(wire, key) records of {gate_id: AES_key}, by wire."""
+    return b"".join(
+        WIRE.pack(w) + k.as_bytes()
+        for w, k in sorted((index[g_id], k) for g_id, k in six.iteritems(keys))
+    )
+
+
+def _decode_keys(ids, payload, expected):
+    """Keys of an INPUT_KEYS payload.
+
+    :param expected: ids of the input gates whose keys must be sent
+    :raises ValueError: if the payload is malformed or does not hold exactly
+        the keys of expected
+    """
+    size = WIRE.size + KEY_BYTES
+    if len(payload) % size:
+        raise ValueError("malformed INPUT_KEYS frame")
+    keys = {}
+    for offset in range(0, len(payload), size):
+        (w,) = WIRE.unpack_from(payload, offset)
+        if w >= len(ids):
+            raise ValueError("malformed INPUT_KEYS frame")
+        keys[ids[w]] = AES_key.from_bytes(payload[offset + WIRE.size : offset + size])
+    if len(keys) * size != len(payload) or set(keys) != set(expected):
+        raise ValueError("malformed INPUT_KEYS frame")
+    return keys
+
+
+def _ot_challenges(ot_mode, choices):
+    """Receivers and OT_CHALLENGES payload for the given choices (list of
+    (wire, bit)), in order."""
+    if ot_mode == "dh":
+        receivers = [OT.DHReceiver() for _ in choices]
+        width = element_width(receivers[0].pk[1]) if receivers else 0
+        payload = b"".join(
+            WIRE.pack(w) + long_to_bytes(int(rec.challenge(b)), width)
+            for rec, (w, b) in zip(receivers, choices)
+        )
+    else:
+        # one group for all the OTs, with a fresh secret key for each one
+        G = elgamal_group_gen() if choices else None
+        receivers = [OT.Receiver(G) for _ in choices]
+        payload = b"".join(
+            WIRE.pack(w) + encode_public_key(rec.pk) + encode_ciphertext(rec.challenge(b))
+            for rec, (w, b) in zip(receivers, choices)
+        )
+    return receivers, payload
+
+
+def _ot_responses(ot_mode, ids, senders, payload):
+    """OT_RESPONSES payload answering the OT_CHALLENGES payload.
+
+    :param senders: dictionnary {gate_id: OT sender}
+    :raises ValueError: if the challenges are not one for each sender
+    """
+    res = []
+    seen = set()
+    offset = 0
+    try:
+        while offset < len(payload):
+            (w,) = WIRE.unpack_from(payload, offset)
+            offset += WIRE.size
+            g_id = ids[w]
+            if g_id in seen:
+                # a second OT for the same wire would transfer both keys
+                raise ValueError("duplicate OT challenge for input %r" % (g_id,))
+            sender = senders[g_id]
+            if ot_mode == "dh":
+                pk = OT._dh_group(None)
+                width = element_width(pk[1])
+                c = bytes_to_long(payload[offset : offset + width])
+                offset += width
+                (A, y_0), (_, y_1) = sender.response(c, pk)
+                res.append(long_to_bytes(int(A), width))
+                res.append(long_to_bytes(int(y_0), KEY_BYTES) + long_to_bytes(int(y_1), KEY_BYTES))
+            else:
+                pk, offset = decode_public_key(payload, offset)
+                c = decode_ciphertext(payload, pk.G[1], offset)
+                offset += 2 * element_width(pk.G[1])
+                e_0, e_1 = sender.response(c, pk)
+                res.append(encode_ciphertext(e_0) + encode_ciphertext(e_1))
+            seen.add(g_id)
+    except (IndexError, KeyError, struct.error):
+        raise ValueError("malformed OT_CHALLENGES frame")
+    if seen != set(senders):
+        raise ValueError("OT challenges do not match the inputs of the evaluator")
+    return b"".join(res)
+
+
+def _ot_finish(ot_mode, receivers, choices, payload):
+    """Keys transferred by the OT_RESPONSES payload.
+
+    :rtype: list of AES_key
+    """
+    keys = []
+    offset = 0
+    for rec, (_, b) in zip(receivers, choices):
+        if ot_mode == "dh":
+            width = element_width(rec.pk[1])
+            A = bytes_to_long(payload[offset : offset + width])
+            offset += width
+            y_0 = bytes_to_long(payload[offset : offset + KEY_BYTES])
+            y_1 = bytes_to_long(payload[offset + KEY_BYTES : offset + 2 * KEY_BYTES])
+            offset += 2 * KEY_BYTES
+            keys.append(rec.decrypt_response((A, y_0), (A, y_1), b))
+        else:
+            p = rec.pk.G[1]
+            e_0 = decode_ciphertext(payload, p, offset)
+            e_1 = decode_ciphertext(payload, p, offset + 2 * element_width(p))
+            offset += 4 * element_width(p)
+            keys.append(rec.decrypt_response(e_0, e_1, b))
+    if offset != len(payload):
+        raise ValueError("malformed OT_RESPONSES frame")
+    return keys
+
+
+async def garbler_session(
+    reader, writer, circuit, myinputs, ot_mode="dh", backend="fixed_key", scheme="half_gates"
+):
+    """Garbler side of the protocol on a connection.
+
+    :param myinputs: inputs of the garbler
+    :type myinputs: dictionnary {gate_id: 0/1}
+    :param ot_mode: "elgamal" or "dh", see OT.SENDERS
+    :param backend: see garbled_circuit_freexor.BACKENDS
+    :param scheme: "grr3" or "half_gates", see garbled_stream
+    :return: values of the output gates and statistics
+    :rtype: (dictionnary {gate_id: 0/1}, ProtocolStats)
+    """
+    stats = ProtocolStats()
+    conn = _Connection(reader, writer, stats)
+    compiled = circuit.compile()
+    with conn.phase("setup"):
+        garbler = StreamingGarbler(circuit, myinputs, ot_mode, backend, scheme)
+        hello = _hello(circuit, ot_mode, backend, scheme)
+        await conn.send(HELLO, hello)
+        if await conn.recv(HELLO) != hello:
+            raise ValueError("the evaluator uses other parameters or another circuit")
+    with conn.phase("input_keys"):
+        await conn.send(INPUT_KEYS, _encode_keys(compiled.index, garbler.input_keys))
+    with conn.phase("ot"):
+        payload = await conn.recv(OT_CHALLENGES)
+        await conn.send(
+            OT_RESPONSES, _ot_responses(ot_mode, compiled.ids, garbler.ot_senders, payload)
+        )
+    with conn.phase("tables"):
+        batch = []
+        size = 0
+        for data in garbler.layer_tables():
+            batch.append(data)
+            size += len(data)
+            if size >= TABLE_BATCH:
+                await conn.send(TABLES, b"".join(batch))
+                batch, size = [], 0
+        if batch:
+            await conn.send(TABLES, b"".join(batch))
+    with conn.phase("outputs"):
+        payload = await conn.recv(OUTPUTS)
+        outputs = sorted(compiled.outputs)
+        if len(payload) != len(outputs) or any(x > 1 for x in bytearray(payload)):
+            raise ValueError("malformed OUTPUTS frame")
+        res = dict((compiled.ids[w], x) for w, x in zip(outputs, bytearray(payload)))
+    return res, stats
+
+
+async def evaluator_session(
+    reader, writer, circuit, myinputs, ot_mode="dh", backend="fixed_key", scheme="half_gates"
+):
+    """Evaluator side of the protocol on a connection, see
+    :func:`garbler_session`.
+
+    :param myinputs: inputs of the evaluator (all the inputs that are not the
+        garbler's)
+    :rtype: (dictionnary {gate_id: 0/1}, ProtocolStats)
+    """
+    for g_id, g_value in six.iteritems(myinputs):
+        assert circuit.g[g_id].kind == "INPUT"
+        assert g_value in (0, 1)
+    stats = ProtocolStats()
+    conn = _Connection(reader, writer, stats)
+    compiled = circuit.compile()
+    with conn.phase("setup"):
+        hello = _hello(circuit, ot_mode, backend, scheme)
+        if await conn.recv(HELLO) != hello:
+            raise ValueError("the garbler uses other parameters or another circuit")
+        await conn.send(HELLO, hello)
+    with conn.phase("input_keys"):
+        garbler_inputs = [
+            g_id
+            for g_id in compiled.ids
+            if circuit.g[g_id].kind == "INPUT" and g_id not in myinputs
+        ]
+        keys = _decode_keys(compiled.ids, await conn.recv(INPUT_KEYS), garbler_inputs)
+    with conn.phase("ot"):
+        choices = sorted((compiled.index[g_id], b) for g_id, b in six.iteritems(myinputs))
+        receivers, payload = _ot_challenges(ot_mode, choices)
+        await conn.send(OT_CHALLENGES, payload)
+        transferred = _ot_finish(ot_mode, receivers, choices, await conn.recv(OT_RESPONSES))
+        for (w, _), k in zip(choices, transferred):
+            keys[compiled.ids[w]] = k
+    with conn.phase("tables"):
+        evaluator = StreamingEvaluator(circuit, {}, keys, {}, backend=backend, scheme=scheme)
+        for n, size in enumerate(evaluator.layer_sizes()):
+            data = await conn.recv_tables(size) if size else b""
+            evaluator.evaluate_layer(n, data)
+        if conn.buffer:
+            raise ValueError("unexpected garbled tables")
+    with conn.phase("outputs"):
+        outputs = sorted(compiled.outputs)
+        res = evaluator.outputs
+        await conn.send(OUTPUTS, bytes(bytearray(res[compiled.ids[w]] for w in outputs)))
+    return res, stats
+
+
+async def _connect(address, timeout):
+    """Connect to address, waiting for the other party to listen."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if isinstance(address, str):
+                return await asyncio.open_unix_connection(address)
+            return await asyncio.open_connection(*address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+async def _run_party(role, circuit, myinputs, address, listen, timeout, options):
+    session = garbler_session if role == "garbler" else evaluator_session
+    if not listen:
+        reader, writer = await _connect(address, timeout)
+        try:
+            return await session(reader, writer, circuit, myinputs, **options)
+        finally:
+            writer.close()
+    done = asyncio.get_running_loop().create_future()
+    server = None
+    started = False
+
+    async def handle(reader, writer):
+        # one session per listener: stop listening, drop the late connections
+        nonlocal started
+        if started:
+            writer.close()
+            return
+        started = True
+        server.close()
+        try:
+            done.set_result(await session(reader, writer, circuit, myinputs, **options))
+        except Exception as e:
+            done.set_exception(e)
+        finally:
+            writer.close()
+
+    if isinstance(address, str):
+        server = await asyncio.start_unix_server(handle, address)
+    else:
+        server = await asyncio.start_server(handle, *address)
+    try:
+        return await done
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def run_party(role, circuit, myinputs, address, listen=False, timeout=CONNECT_TIMEOUT, **options):
+    """Run one party of the protocol for a single session.
+
+    Either party can listen, the other one connects.
+
+    :param role: "garbler" or "evaluator"
+    :param address: (host, port) for TCP, or path of a Unix socket
+    :param listen: wait for the other party to connect instead of connecting
+    :param timeout: seconds to wait for the listening party when connecting
+    :param options: ot_mode, backend and scheme, see :func:`garbler_session`
+    :rtype: (dictionnary {gate_id: 0/1}, ProtocolStats)
+    """
+    assert role in ("garbler", "evaluator")
+    return asyncio.run(_run_party(role, circuit, myinputs, address, listen, timeout, options))
+
+
+def _party_process(results, *args, **kwargs):
+    results.put(run_party(*args, **kwargs))
+
+
+def test_garbled_net():
+    import multiprocessing
+    import os
+    import random
+    import socket
+    import tempfile
+
+    from circuit_builder import CircuitBuilder
+    from garbled_circuit_freexor import garble_circuit
+    from prs import prs_circuit
+
+    def run(circuit, alice, bob, address, **options):
+        # the garbler listens in another process
+        results = multiprocessing.Queue()
+        p = multiprocessing.Process(
+            target=_party_process,
+            args=(results, "garbler", circuit, alice, address, True),
+            kwargs=options,
+        )
+        p.start()
+        try:
+            res_b, stats_b = run_party("evaluator", circuit, bob, address, **options)
+            res_a, stats_a = results.get(timeout=60)
+        finally:
+            p.join()
+        state = circuit.evaluate(dict(alice, **bob)).state
+        assert res_a == res_b == dict((o, state[o]) for o in circuit.output_gates)
+        assert stats_a.total()[1] == stats_b.total()[2]
+        assert stats_a.total()[2] == stats_b.total()[1]
+        return stats_a, stats_b
+
+    # INPUT_KEYS must hold exactly the keys of the garbler's inputs
+    compiled = prs_circuit.compile()
+    key = AES_key.from_bytes(b"k" * KEY_BYTES)
+    garbler_inputs = ["A", "B"]
+    good = _encode_keys(compiled.index, {"A": key, "B": key})
+    assert set(_decode_keys(compiled.ids, good, garbler_inputs)) == set(garbler_inputs)
+    for payload in (
+        _encode_keys(compiled.index, {"A": key}),
+        _encode_keys(compiled.index, {"A": key, "B": key, "C": key}),
+        good[: WIRE.size + KEY_BYTES] * 2,
+        WIRE.pack(len(compiled.ids)) + key.as_bytes() + good[WIRE.size + KEY_BYTES :],
+    ):
+        try:
+            _decode_keys(compiled.ids, payload, garbler_inputs)
+        except ValueError:
+            pass
+        else:
+            assert False, "malformed INPUT_KEYS frame accepted"
+
+    # one OT challenge per input of the evaluator: with two for the same
+    # input (choices 0 and 1), the evaluator would get both keys
+    _, _, senders = garble_circuit(prs_circuit, {"A": 0, "B": 1}, "dh")
+    c, d = compiled.index["C"], compiled.index["D"]
+    _, payload = _ot_challenges("dh", [(c, 0), (d, 1)])
+    _ot_responses("dh", compiled.ids, senders, payload)
+    _, payload = _ot_challenges("dh", [(c, 0), (c, 1), (d, 1)])
+    try:
+        _ot_responses("dh", compiled.ids, senders, payload)
+    except ValueError:
+        pass
+    else:
+        assert False, "duplicate OT challenge accepted"
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for ot_mode, scheme in (("dh", "half_gates"), ("elgamal", "grr3")):
+            a, c = random.randrange(4), random.randrange(4)
+            run(
+                prs_circuit,
+                {"A": a & 1, "B": a >> 1},
+                {"C": c & 1, "D": c >> 1},
+                os.path.join(tmp, "prs-%s" % ot_mode),
+                ot_mode=ot_mode,
+                scheme=scheme,
+            )
+    finally:
+        for name in os.listdir(tmp):
+            os.unlink(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+    # 64-bit multiplier over TCP loopback, several TABLES frames
+    builder = CircuitBuilder()
+    x = builder.input("x", 64)
+    y = builder.input("y", 64)
+    builder.output("z", builder.mul(x, y))
+    circuit = builder.circuit()
+    vx, vy = random.getrandbits(64), random.getrandbits(64)
+    alice = builder.input_values("x", vx)
+    bob = builder.input_values("y", vy)
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    stats_a, stats_b = run(circuit, alice, bob, ("127.0.0.1", port))
+    assert stats_a.sent["tables"] > TABLE_BATCH
+    print("garbler")
+    print(stats_a)
+    print("evaluator")
+    print(stats_b)
+
+
+if __name__ == "__main__":
+    test_garbled_net()
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+"""
+LELEC2770 : Privacy Enhancing Technologies
+
+Exercice Session : Secure 2-party computation
+
+Streaming garbled circuits
+
+The garbler sends the garbled tables layer by layer (see Circuit.layers) on a
+channel while it garbles, and the evaluator consumes them as they arrive:
+neither party holds the whole garbled circuit, and the keys of a gate are
+dropped after the last layer that uses them. Memory is thus bounded by the
+number of live wires instead of the size of the circuit.
+
+Only the row-reduced schemes of garbled_circuit_freexor ("grr3" and
+"half_gates") are streamed: the size of their tables only depends on the
+gate, hence the evaluator knows how many bytes to read for each layer.
+"""
+
+import socket
+import threading
+
+import six
+from six.moves import queue
+
+from aes import AES_key
+import OT
+from garbled_circuit_freexor import (
+    ROW_REDUCED_SCHEMES,
+    _evaluate_layer,
+    _garble_layer,
+    _hash_function,
+    _table_blocks,
+)
+
+BLOCK_BYTES = 16
+
+
+class QueueChannel:
+    """In-memory channel between two threads.
+
+    send blocks when maxsize messages are waiting: the garbler cannot run
+    ahead of the evaluator.
+
+    :param incoming: queue of the received messages
+    :param outgoing: queue of the sent messages
+    """
+
+    def __init__(self, incoming, outgoing):
+        self.incoming = incoming
+        self.outgoing = outgoing
+        self.buffer = b""
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @classmethod
+    def pair(cls, maxsize=16):
+        """Two connected channels."""
+        a, b = queue.Queue(maxsize), queue.Queue(maxsize)
+        return cls(a, b), cls(b, a)
+
+    def send(self, data):
+        self.outgoing.put(data)
+        self.bytes_sent += len(data)
+
+    def recv(self, n):
+        """Receive exactly n bytes."""
+        while len(self.buffer) < n:
+            self.buffer += self.incoming.get()
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        self.bytes_received += n
+        return data
+
+    def close(self):
+        pass
+
+
+class StreamChannel:
+    """Channel over binary file objects: pipes (os.fdopen) or sockets.
+
+    :param reader: file object to read from
+    :param writer: file object to write to
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @classmethod
+    def from_socket(cls, sock):
+        """Channel over a connected socket."""
+        return cls(sock.makefile("rb"), sock.makefile("wb"))
+
+    def send(self, data):
+        self.writer.write(data)
+        self.writer.flush()
+        self.bytes_sent += len(data)
+
+    def recv(self, n):
+        """Receive exactly n bytes.
+
+        :raises EOFError: if the other side closed the channel
+        """
+        data = self.reader.read(n)
+        if len(data) != n:
+            raise EOFError("channel closed after %d of %d bytes" % (len(data), n))
+        self.bytes_received += n
+        return data
+
+    def close(self):
+        self.writer.close()
+        self.reader.close()
+
+
+def stream_layers(circuit):
+    """Layers of the gates the outputs depend on, and the gates whose keys
+    can be dropped after each layer.
+
+    :rtype: (list of lists of gate ids, list of lists of gate ids)
+    """
+    cone = set(circuit.output_cone())
+    layers = [[g_id for g_id in layer if g_id in cone] for layer in circuit.layers()]
+    g = circuit.g
+    last_use = {}
+    for n, layer in enumerate(layers):
+        for g_id in layer:
+            last_use[g_id] = n
+            gate = g[g_id]
+            if gate.kind != "INPUT":
+                last_use[gate.in0_id] = n
+                last_use[gate.in1_id] = n
+    drop = [[] for _ in layers]
+    for g_id, n in six.iteritems(last_use):
+        drop[n].append(g_id)
+    return layers, drop
+
+
+class StreamingGarbler:
+    """Garbler side of a streamed garbled circuit.
+
+    The keys of the input gates are generated at creation: input_keys and
+    ot_senders are sent to the evaluator (as for
+    garbled_circuit_freexor.garble_circuit) before the tables are streamed
+    by run.
+
+    :param circuit: circuit to garble
+    :type circuit: logic_circuit.Circuit
+    :param myinputs: already known inputs, to be hidden
+    :type myinputs: dictionnary {gate_id: 0/1}
+    :param ot_mode: "elgamal" or "dh", see OT.SENDERS
+    :param backend: garbling backend, see garbled_circuit_freexor.BACKENDS
+    :param scheme: "grr3" or "half_gates"
+    """
+
+    def __init__(
+        self, circuit, myinputs, ot_mode="elgamal", backend="fixed_key", scheme="half_gates"
+    ):
+        assert scheme in ROW_REDUCED_SCHEMES
+        for g_id, g_value in six.iteritems(myinputs):
+            assert circuit.g[g_id].kind == "INPUT"
+            assert g_value in (0, 1)
+        self.circuit = circuit
+        self.backend = backend
+        self.scheme = scheme
+        nbr_zero = OT.KEY_ZERO_BITS[ot_mode]
+        # k_0 and k_1 = k_0 ^ R have different select bits
+        self.R = AES_key.gen_random(nbr_zero).as_int() | 1
+        self.input_labels = {}
+        self.input_keys = {}
+        self.ot_senders = {}
+        for g_id, gate in six.iteritems(circuit.g):
+            if gate.kind == "INPUT":
+                k_0 = AES_key.gen_random(nbr_zero)
+                k_1 = AES_key.from_int(k_0.as_int() ^ self.R)
+                self.input_labels[g_id] = k_0.as_int()
+                if g_id in myinputs:
+                    self.input_keys[g_id] = (k_0, k_1)[myinputs[g_id]]
+                else:
+                    self.ot_senders[g_id] = OT.SENDERS[ot_mode](k_0, k_1)
+        # largest number of keys held at once
+        self.peak_live = 0
+
+    def layer_tables(self):
+        """Garble the circuit layer by layer.
+
+        :return: generator of the tables of each layer that has some, as
+            bytes
+        """
+        circuit = self.circuit
+        H = _hash_function(self.backend)
+        index = circuit.compile().index
+        layers, drop = stream_layers(circuit)
+        labels = dict(self.input_labels)
+        for layer, dead in zip(layers, drop):
+            tables = _garble_layer(circuit, layer, labels, self.R, self.scheme, H, index)
+            self.peak_live = max(self.peak_live, len(labels))
+            for g_id in dead:
+                labels.pop(g_id, None)
+            if tables:
+                yield b"".join(b for _, rows in tables for b in rows)
+
+    def run(self, channel):
+        """Garble the circuit and send its tables on channel, one message
+        per layer.
+
+        :return: number of bytes sent
+        """
+        sent = 0
+        for data in self.layer_tables():
+            channel.send(data)
+            sent += len(data)
+        return sent
+
+
+class StreamingEvaluator:
+    """Evaluator side of a streamed garbled circuit.
+
+    :param circuit: circuit to evaluate
+    :type circuit: logic_circuit.Circuit
+    :param myinputs: known inputs, to be kept hidden
+    :type myinputs: dictionnary {gate_id: 0/1}
+    :param input_keys: ungarbling keys already known (all of them, with empty
+        myinputs and ot_senders, if the OTs were run separately)
+    :type input_keys: dictionnary {input_gate_id: AES_key}
+    :param ot_senders: OT senders to recover missing input keys using myinputs
+        values
+    :param ot_extension: see OT.transfer_many
+    :param ot_pool: see OT.transfer_many
+    :param backend: garbling backend used by the garbler
+    :param scheme: garbling scheme used by the garbler
+    """
+
+    def __init__(
+        self,
+        circuit,
+        myinputs,
+        input_keys,
+        ot_senders,
+        ot_extension=None,
+        ot_pool=None,
+        backend="fixed_key",
+        scheme="half_gates",
+    ):
+        assert scheme in ROW_REDUCED_SCHEMES
+        for g_id, g_value in six.iteritems(myinputs):
+            assert circuit.g[g_id].kind == "INPUT"
+            assert g_value in (0, 1)
+        assert set(ot_senders) == set(myinputs)
+        self.circuit = circuit
+        self.backend = backend
+        self.scheme = scheme
+        self.input_labels = dict(
+            (g_id, k.as_int()) for g_id, k in six.iteritems(input_keys)
+        )
+        ids = list(myinputs)
+        if ids:
+            keys = OT.transfer_many(
+                [ot_senders[i] for i in ids],
+                [myinputs[i] for i in ids],
+                ot_extension,
+                ot_pool,
+            )
+            for i, k in zip(ids, keys):
+                self.input_labels[i] = k.as_int()
+        self._H = _hash_function(backend)
+        self._index = circuit.compile().index
+        self._layers, self._drop = stream_layers(circuit)
+        self._labels = dict(self.input_labels)
+        # values of the output gates evaluated so far
+        self.outputs = {}
+        # largest number of keys held at once
+        self.peak_live = 0
+
+    def layer_sizes(self):
+        """Number of bytes of the tables of each layer.
+
+        :rtype: list of int
+        """
+        circuit = self.circuit
+        g = circuit.g
+        return [
+            BLOCK_BYTES * sum(_table_blocks(circuit, g_id, g[g_id], self.scheme) for g_id in layer)
+            for layer in self._layers
+        ]
+
+    def evaluate_layer(self, n, data):
+        """Evaluate layer n, the layers being evaluated in order.
+
+        :param data: tables of the layer (layer_sizes()[n] bytes)
+        """
+        circuit = self.circuit
+        g = circuit.g
+        layer = self._layers[n]
+        tables = {}
+        offset = 0
+        for g_id in layer:
+            k = _table_blocks(circuit, g_id, g[g_id], self.scheme)
+            if k:
+                tables[g_id] = [
+                    data[offset + BLOCK_BYTES * i : offset + BLOCK_BYTES * (i + 1)]
+                    for i in range(k)
+                ]
+                offset += BLOCK_BYTES * k
+        assert offset == len(data)
+        labels = self._labels
+        self.outputs.update(
+            _evaluate_layer(circuit, layer, labels, tables, self.scheme, self._H, self._index)
+        )
+        self.peak_live = max(self.peak_live, len(labels))
+        for g_id in self._drop[n]:
+            labels.pop(g_id, None)
+
+    def run(self, channel):
+        """Receive the tables from channel and evaluate the circuit.
+
+        :return: values of the output gates
+        :rtype: dictionnary {gate_id: 0/1}
+        """
+        for n, size in enumerate(self.layer_sizes()):
+            self.evaluate_layer(n, channel.recv(size) if size else b"")
+        return self.outputs
+
+
+def run_streamed(garbler, evaluator, channels):
+    """Run garbler in a thread and evaluator in the current one.
+
+    :param channels: (garbler channel, evaluator channel)
+    :return: values of the output gates
+    """
+    errors = []
+
+    def garble():
+        try:
+            garbler.run(channels[0])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            channels[0].close()
+
+    thread = threading.Thread(target=garble)
+    thread.start()
+    try:
+        outputs = evaluator.run(channels[1])
+    finally:
+        thread.join()
+        channels[1].close()
+    if errors:
+        raise errors[0]
+    return outputs
+
+
+def test_streamed():
+    import random
+
+    from logic_circuit import Gate, Circuit, INPUT_GATE
+    from prs import prs_circuit
+
+    for scheme in ROW_REDUCED_SCHEMES:
+        for a in range(4):
+            for c in range(4):
+                alice = {"A": a & 1, "B": a >> 1}
+                bob = {"C": c & 1, "D": c >> 1}
+                garbler = StreamingGarbler(prs_circuit, alice, scheme=scheme)
+                evaluator = StreamingEvaluator(
+                    prs_circuit, bob, garbler.input_keys, garbler.ot_senders, scheme=scheme
+                )
+                outputs = run_streamed(garbler, evaluator, QueueChannel.pair())
+                state = prs_circuit.evaluate(dict(alice, **bob)).state
+                assert outputs == {"E": state["E"], "F": state["F"]}
+
+    # deep and narrow circuit: a 4-wire register updated 2000 times
+    g = dict((i, INPUT_GATE) for i in range(8))
+    wires = list(range(4))
+    n = 8
+    for step in range(2000):
+        new = []
+        for i in range(4):
+            kind = random.choice(Gate.KINDS[1:])
+            g[n] = Gate(kind, wires[i], (wires[(i + 1) % 4] if step % 2 else 4 + i))
+            new.append(n)
+            n += 1
+        wires = new
+    outputs = set(wires)
+    circ = Circuit(g, outputs)
+    inputs = dict((i, random.getrandbits(1)) for i in range(8))
+    alice = dict((i, inputs[i]) for i in range(4))
+    bob = dict((i, inputs[i]) for i in range(4, 8))
+    state = circ.evaluate(inputs).state
+    sock0, sock1 = socket.socketpair()
+    channels = (StreamChannel.from_socket(sock0), StreamChannel.from_socket(sock1))
+    garbler = StreamingGarbler(circ, alice, ot_mode="dh")
+    evaluator = StreamingEvaluator(
+        circ, bob, garbler.input_keys, garbler.ot_senders, ot_extension=True
+    )
+    assert run_streamed(garbler, evaluator, channels) == dict(
+        (o, state[o]) for o in outputs
+    )
+    sock0.close()
+    sock1.close()
+    assert channels[0].bytes_sent == channels[1].bytes_received > 0
+    # the keys of 2 layers and of the inputs at most
+    assert garbler.peak_live <= 16 and evaluator.peak_live <= 16
+
+
+if __name__ == "__main__":
+    test_streamed()
@@ -10,6 +10,8 @@ Exercice Session : Secure 2-party computation
 Logic Circuit
 """
 
+from array import array
+
 import six
 
 
@@ -25,6 +27,8 @@ class Gate:
 
     KINDS = ("INPUT", "AND", "NAND", "OR", "NOR", "XOR")
 
+    __slots__ = ("kind", "in0_id", "in1_id")
+
     def __init__(self, kind, in0_id, in1_id):
         assert kind in self.KINDS
         assert kind != "INPUT" or (in0_id is None and in1_id is None)
@@ -56,18 +60,149 @@ class Gate:
 INPUT_GATE = Gate("INPUT", None, None)
 
 
+# Integer code of each gate kind in a CompiledCircuit.
+KIND_CODES = dict((kind, code) for code, kind in enumerate(Gate.KINDS))
+
+# Truth table of each gate kind (by code): TRUTH_TABLES[code][2*in0 + in1]
+TRUTH_TABLES = tuple(
+    None
+    if kind == "INPUT"
+    else tuple(int(Gate.compute_gate(kind, i, j)) for i in (0, 1) for j in (0, 1))
+    for kind in Gate.KINDS
+)
+
+
+# Bit-sliced version of each gate kind (by code): SLICED_OPS[code](a, b, mask)
+# computes the gate on every bit of the words a and b at once.
+SLICED_OPS = (
+    None,
+    lambda a, b, mask: a & b,
+    lambda a, b, mask: mask ^ (a & b),
+    lambda a, b, mask: a | b,
+    lambda a, b, mask: mask ^ (a | b),
+    lambda a, b, mask: a ^ b,
+)
+
+
+def _invalidating(method):
+    """Wrap a mutating method of a container of a Circuit so that it
+    invalidates the circuit caches."""
+
+    def wrapper(self, *args, **kwargs):
+        res = method(self, *args, **kwargs)
+        self._circuit._invalidate()
+        return res
+
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+class _GateDict(dict):
+    """Gates of a Circuit: invalidates the circuit caches on mutation."""
+
+    def __init__(self, circuit, g):
+        dict.__init__(self, g)
+        self._circuit = circuit
+
+    def __reduce__(self):
+        # Detached from the circuit once copied
+        return (dict, (dict(self),))
+
+    __setitem__ = _invalidating(dict.__setitem__)
+    __delitem__ = _invalidating(dict.__delitem__)
+    clear = _invalidating(dict.clear)
+    pop = _invalidating(dict.pop)
+    popitem = _invalidating(dict.popitem)
+    setdefault = _invalidating(dict.setdefault)
+    update = _invalidating(dict.update)
+
+
+class _GateSet(set):
+    """Output gates of a Circuit: invalidates the circuit caches on
+    mutation."""
+
+    def __init__(self, circuit, ids):
+        set.__init__(self, ids)
+        self._circuit = circuit
+
+    def __reduce__(self):
+        # Detached from the circuit once copied
+        return (set, (set(self),))
+
+    add = _invalidating(set.add)
+    clear = _invalidating(set.clear)
+    discard = _invalidating(set.discard)
+    pop = _invalidating(set.pop)
+    remove = _invalidating(set.remove)
+    update = _invalidating(set.update)
+    difference_update = _invalidating(set.difference_update)
+    intersection_update = _invalidating(set.intersection_update)
+    symmetric_difference_update = _invalidating(set.symmetric_difference_update)
+    __ior__ = _invalidating(set.__ior__)
+    __iand__ = _invalidating(set.__iand__)
+    __isub__ = _invalidating(set.__isub__)
+    __ixor__ = _invalidating(set.__ixor__)
+
+
 class Circuit:
     """Logic circuit
 
+    Derived representations (e.g. the compiled circuit) are cached, and the
+    caches are invalidated when g or output_gates are mutated (gates
+    themselves must not be mutated).
+
     :param g: representation of the circuit
     :param output_gates: ids of output gates
+    :param order: topological order of the gates (input gates first), if it
+        is already known. It is not checked.
     :type g: dictionnary {gate_id, Gate}
     :type output_gates: set of ids
     """
 
-    def __init__(self, g, output_gates):
+    def __init__(self, g, output_gates, order=None):
+        self._cache = {}
         self.g = g
         self.output_gates = output_gates
+        if order is not None:
+            self._cache["order"] = order
+
+    @property
+    def g(self):
+        return self._g
+
+    @g.setter
+    def g(self, g):
+        self._g = _GateDict(self, g)
+        self._invalidate()
+
+    @property
+    def output_gates(self):
+        return self._output_gates
+
+    @output_gates.setter
+    def output_gates(self, output_gates):
+        self._output_gates = _GateSet(self, output_gates)
+        self._invalidate()
+
+    def _invalidate(self):
+        self._cache.clear()
+
+    def __getstate__(self):
+        return {"g": dict(self.g), "output_gates": set(self.output_gates)}
+
+    def __setstate__(self, state):
+        self.__init__(state["g"], state["output_gates"])
+
+    def compile(self):
+        """Compiled (array-based) representation of the circuit, cached.
+
+        :rtype: CompiledCircuit
+        """
+        compiled = self._cache.get("compiled")
+        if compiled is None:
+            compiled = CompiledCircuit(self)
+            self._cache["compiled"] = compiled
+        return compiled
 
     def evaluate(self, input_vals):
         """Evaluate logic circuit
@@ -84,20 +219,303 @@ class Circuit:
             assert self.g[g_id].kind == "INPUT"
         return CircuitEvaluation(self, input_vals)
 
-    # ADDED FOR FREEXOR
+    def evaluate_sliced(self, input_words, n):
+        """Bit-sliced evaluation of n input assignments at once
+
+        Bit j of each word is the value of the wire in the j-th assignment.
+
+        :param input_words: values at the input of the circuit
+        :type input_words: dictionnary {input_gate_id: int of n bits}
+        :return: value at the output of every output gate
+        :rtype: dictionnary {output_gate_id: int of n bits}
+        """
+        for g_id, gate in six.iteritems(self.g):
+            assert gate.kind != "INPUT" or g_id in input_words
+        compiled = self.compile()
+        words = [0] * len(compiled)
+        for g_id, w in six.iteritems(input_words):
+            words[compiled.index[g_id]] = w
+        words = compiled.evaluate_sliced(words, n)
+        return dict((compiled.ids[i], words[i]) for i in compiled.outputs)
+
+    def evaluate_batch(self, input_vals_list):
+        """Evaluate the circuit on many input assignments, using
+        evaluate_sliced.
+
+        :param input_vals_list: list of {input_gate_id: 0/1}
+        :return: value at the output of every output gate, bit j being the
+            output for input_vals_list[j]
+        :rtype: dictionnary {output_gate_id: int}
+        """
+        words = dict(
+            (g_id, 0) for g_id, gate in six.iteritems(self.g) if gate.kind == "INPUT"
+        )
+        for j, input_vals in enumerate(input_vals_list):
+            for g_id, v in six.iteritems(input_vals):
+                if v:
+                    words[g_id] |= 1 << j
+        return self.evaluate_sliced(words, len(input_vals_list))
+
+    def truth_table(self, input_ids=None):
+        """Evaluate the circuit on all the 2**k assignments of its k inputs.
+
+        In assignment j, input input_ids[i] is (j >> i) & 1.
+
+        :param input_ids: order of the inputs, defaults to sorted ids
+        :return: input_ids and the output words (of 2**k bits)
+        :rtype: (list, dictionnary {output_gate_id: int})
+        """
+        if input_ids is None:
+            input_ids = sorted(
+                g_id for g_id, gate in six.iteritems(self.g) if gate.kind == "INPUT"
+            )
+        k = len(input_ids)
+        n = 2 ** k
+        words = {}
+        for i, g_id in enumerate(input_ids):
+            # 2**i zeros then 2**i ones, repeated
+            half = 2 ** i
+            block = ((1 << half) - 1) << half
+            words[g_id] = block * (((1 << n) - 1) // ((1 << (2 * half)) - 1))
+        return input_ids, self.evaluate_sliced(words, n)
+
     def ordered_gates(self):
-        all_keys = self.g.keys()
-        ordered = [i for i in all_keys if self.g[i].kind == "INPUT"]
+        """Gate ids in topological order (Kahn's algorithm, O(V+E)), input
+        gates first. Cached.
+
+        :raises CircuitCycleError: if the circuit contains a cycle
+        :rtype: list of gate ids
+        """
+        order = self._cache.get("order")
+        if order is None:
+            order = self._topological_order()
+            self._cache["order"] = order
+        return list(order)
+
+    def _topological_order(self):
+        g = self.g
+        indegree = {}
+        fanout = dict((g_id, []) for g_id in g)
+        for g_id, gate in six.iteritems(g):
+            if gate.kind == "INPUT":
+                indegree[g_id] = 0
+                continue
+            indegree[g_id] = 2
+            for in_id in (gate.in0_id, gate.in1_id):
+                if in_id not in g:
+                    raise ValueError(
+                        "gate %r has an unknown input %r" % (g_id, in_id)
+                    )
+                fanout[in_id].append(g_id)
+        order = [g_id for g_id, d in six.iteritems(indegree) if d == 0]
+        i = 0
+        while i < len(order):
+            for out_id in fanout[order[i]]:
+                indegree[out_id] -= 1
+                if indegree[out_id] == 0:
+                    order.append(out_id)
+            i += 1
+        if len(order) != len(g):
+            raise CircuitCycleError(self._find_cycle(indegree))
+        return order
+
+    def _find_cycle(self, indegree):
+        """Find a cycle among the gates that have unresolved inputs."""
+        g = self.g
+        # Every gate left has at least an input left: walk back through them.
+        g_id = next(k for k, d in six.iteritems(indegree) if d > 0)
+        path = []
+        seen = {}
+        while g_id not in seen:
+            seen[g_id] = len(path)
+            path.append(g_id)
+            gate = g[g_id]
+            g_id = gate.in0_id if indegree[gate.in0_id] > 0 else gate.in1_id
+        cycle = path[seen[g_id] :]
+        cycle.reverse()
+        return cycle
+
+    def levels(self):
+        """Depth of each gate: 0 for input gates, 1 + the maximum depth of
+        its inputs for the other gates. Cached.
+
+        :rtype: dictionnary {gate_id: depth}
+        """
+        levels = self._cache.get("levels")
+        if levels is None:
+            levels = {}
+            for g_id in self.ordered_gates():
+                gate = self.g[g_id]
+                if gate.kind == "INPUT":
+                    levels[g_id] = 0
+                else:
+                    levels[g_id] = 1 + max(levels[gate.in0_id], levels[gate.in1_id])
+            self._cache["levels"] = levels
+        return dict(levels)
+
+    def output_cone(self):
+        """Gates the outputs depend on, in topological order. Cached.
+
+        :rtype: list of gate ids
+        """
+        cone = self._cache.get("cone")
+        if cone is None:
+            compiled = self.compile()
+            needed = [False] * len(compiled)
+            for w in compiled.outputs:
+                needed[w] = True
+            in0 = compiled.in0
+            in1 = compiled.in1
+            # Inputs of a gate come before it: one backward pass suffices.
+            for w in range(len(compiled) - 1, -1, -1):
+                if needed[w] and in0[w] >= 0:
+                    needed[in0[w]] = True
+                    needed[in1[w]] = True
+            cone = [g_id for g_id, n in zip(compiled.ids, needed) if n]
+            self._cache["cone"] = cone
+        return list(cone)
+
+    def layers(self):
+        """Gates grouped by depth: the gates of a layer only depend on gates
+        of the previous layers, hence can be processed together.
+
+        :rtype: list of lists of gate ids
+        """
+        layers = []
+        for g_id, level in six.iteritems(self.levels()):
+            while len(layers) <= level:
+                layers.append([])
+            layers[level].append(g_id)
+        return layers
+
+
+class CircuitCycleError(ValueError):
+    """The gates of a circuit contain a cycle.
+
+    :param cycle: ids of the gates of the cycle, each one being an input of
+        the next one (and the last one an input of the first one)
+    """
+
+    def __init__(self, cycle):
+        ValueError.__init__(
+            self, "circuit contains a cycle: %s" % " -> ".join(repr(i) for i in cycle)
+        )
+        self.cycle = cycle
+
+
+class CompiledCircuit:
+    """Array-based representation of a Circuit
+
+    Gates are numbered in topological order (wires 0 to n-1, inputs first).
+    Gate kinds (KIND_CODES) and input wires are stored in arrays, -1 being
+    used for the inputs of input gates.
+
+    Attributes:
+    * ids: gate id of each wire
+    * index: wire of each gate id
+    * kinds, in0, in1: arrays of the kinds and input wires of the gates
+    * inputs: wires of the input gates
+    * outputs: wires of the output gates
+
+    :type circuit: Circuit
+    """
 
-        all_keys = [x for x in all_keys if x not in ordered]
+    __slots__ = ("ids", "index", "kinds", "in0", "in1", "inputs", "outputs")
+
+    def __init__(self, circuit):
+        g = circuit.g
+        self.ids = circuit.ordered_gates()
+        self.index = dict((g_id, i) for i, g_id in enumerate(self.ids))
+        self.kinds = array("B")
+        self.in0 = array("l")
+        self.in1 = array("l")
+        for g_id in self.ids:
+            gate = g[g_id]
+            self.kinds.append(KIND_CODES[gate.kind])
+            if gate.kind == "INPUT":
+                self.in0.append(-1)
+                self.in1.append(-1)
+            else:
+                self.in0.append(self.index[gate.in0_id])
+                self.in1.append(self.index[gate.in1_id])
+        input_code = KIND_CODES["INPUT"]
+        self.inputs = array("l", (i for i, k in enumerate(self.kinds) if k == input_code))
+        self.outputs = array("l", sorted(self.index[g_id] for g_id in circuit.output_gates))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def evaluate_wires(self, values):
+        """Evaluate the circuit on a list of wire values.
+
+        :param values: list of length len(self), whose entries for the input
+            wires are set (0/1), the other ones are overwritten
+        :return: values
+        """
+        kinds = self.kinds
+        in0 = self.in0
+        in1 = self.in1
+        for i in range(len(kinds)):
+            tt = TRUTH_TABLES[kinds[i]]
+            if tt is not None:
+                values[i] = tt[2 * values[in0[i]] + values[in1[i]]]
+        return values
+
+    def evaluate_sliced(self, words, n):
+        """Bit-sliced evaluation of the circuit on a list of wire words.
+
+        :param words: list of length len(self), whose entries for the input
+            wires are set (ints of n bits), the other ones are overwritten
+        :return: words
+        """
+        mask = (1 << n) - 1
+        kinds = self.kinds
+        in0 = self.in0
+        in1 = self.in1
+        for i in range(len(kinds)):
+            op = SLICED_OPS[kinds[i]]
+            if op is not None:
+                words[i] = op(words[in0[i]], words[in1[i]], mask)
+        return words
 
-        while all_keys != []:
-            for key in all_keys:
-                if self.g[key].in0_id in ordered and self.g[key].in1_id in ordered:
-                    ordered.append(key)
-                    all_keys.remove(key)
+    def evaluate(self, input_vals):
+        """Evaluate the circuit.
 
-        return ordered
+        :param input_vals: values at the input of the circuit
+        :type input_vals: dictionnary {input_gate_id: 0/1}
+        :return: value at the output of every gate
+        :rtype: dictionnary {gate_id: 0/1}
+        """
+        values = [0] * len(self.ids)
+        for g_id, v in six.iteritems(input_vals):
+            values[self.index[g_id]] = int(v)
+        return dict(zip(self.ids, self.evaluate_wires(values)))
+
+
+def evaluate_gates(circuit, state, evaluate_gate):
+    """Iterative evaluation engine
+
+    Evaluate, in topological order, the gates the outputs of circuit depend
+    on and which are not in state yet. No recursion is involved, hence the
+    depth of the circuit is not limited.
+
+    :param state: values of the gates already known (at least the inputs),
+        updated in place
+    :type state: dictionnary {gate_id: value}
+    :param evaluate_gate: function (g_id, gate, in0_value, in1_value) ->
+        value at the output of the gate
+    :return: state
+    """
+    g = circuit.g
+    for g_id in circuit.output_cone():
+        if g_id not in state:
+            gate = g[g_id]
+            state[g_id] = evaluate_gate(g_id, gate, state[gate.in0_id], state[gate.in1_id])
+    return state
+
+
+def _evaluate_plain_gate(g_id, gate, in0, in1):
+    return TRUTH_TABLES[KIND_CODES[gate.kind]][2 * in0 + in1]
 
 
 class CircuitEvaluation:
@@ -111,21 +529,7 @@ class CircuitEvaluation:
     def __init__(self, circuit, input_vals):
         self.state = input_vals.copy()
         self.circuit = circuit
-        for g_id in self.circuit.output_gates:
-            self._recursive_evaluate(g_id)
-
-    def _recursive_evaluate(self, g_id):
-        if g_id in self.state:
-            return self.state[g_id]
-        else:
-            in0_id = self.circuit.g[g_id].in0_id
-            in1_id = self.circuit.g[g_id].in1_id
-            kind = self.circuit.g[g_id].kind
-            in1 = self._recursive_evaluate(in0_id)
-            in2 = self._recursive_evaluate(in1_id)
-            res = Gate.compute_gate(kind, in1, in2)
-            self.state[g_id] = res
-            return res
+        evaluate_gates(circuit, self.state, _evaluate_plain_gate)
 
 
 def test_circuit():
@@ -145,5 +549,123 @@ def test_circuit():
     # print('Output of test circuit is', circ_eval.state[4])
 
 
+def test_compiled_circuit():
+    circ = Circuit(
+        {
+            "a": INPUT_GATE,
+            "b": INPUT_GATE,
+            "c": INPUT_GATE,
+            "ab": Gate("NAND", "a", "b"),
+            "out": Gate("XOR", "c", "ab"),
+        },
+        {"out"},
+    )
+    compiled = circ.compile()
+    assert circ.compile() is compiled
+    assert list(compiled.kinds[:3]) == [0, 0, 0] and len(compiled) == 5
+    for a in (0, 1):
+        for b in (0, 1):
+            for c in (0, 1):
+                inputs = {"a": a, "b": b, "c": c}
+                ref = circ.evaluate(inputs).state
+                assert compiled.evaluate(inputs)["out"] == ref["out"]
+    circ.g["out2"] = Gate("OR", "a", "out")
+    circ.output_gates.add("out2")
+    assert circ.compile() is not compiled and len(circ.compile()) == 6
+
+
+def test_sliced():
+    import random
+
+    g = {}
+    for i in range(6):
+        g[i] = INPUT_GATE
+    for i in range(6, 60):
+        g[i] = Gate(
+            random.choice(Gate.KINDS[1:]), random.randrange(i), random.randrange(i)
+        )
+    circ = Circuit(g, {59, 40, 30})
+    input_ids, table = circ.truth_table()
+    batch = []
+    for j in range(2 ** 6):
+        inputs = dict((g_id, (j >> i) & 1) for i, g_id in enumerate(input_ids))
+        batch.append(inputs)
+        ref = circ.evaluate(inputs).state
+        for out in circ.output_gates:
+            assert (table[out] >> j) & 1 == ref[out]
+    assert circ.evaluate_batch(batch) == table
+
+
+def test_ordered_gates():
+    circ = Circuit(
+        {
+            4: Gate("XOR", 2, 3),
+            3: Gate("AND", 0, 1),
+            0: INPUT_GATE,
+            1: INPUT_GATE,
+            2: INPUT_GATE,
+        },
+        {4},
+    )
+    assert circ.ordered_gates() == [0, 1, 2, 3, 4]
+    assert circ.levels() == {0: 0, 1: 0, 2: 0, 3: 1, 4: 2}
+    assert circ.layers() == [[0, 1, 2], [3], [4]]
+    circ.g[3] = Gate("AND", 0, 5)
+    circ.g[5] = Gate("OR", 4, 1)
+    try:
+        circ.ordered_gates()
+        assert False
+    except CircuitCycleError as e:
+        assert sorted(e.cycle) == [3, 4, 5]
+    # chain deeper than the recursion limit
+    n = 10000
+    g = {0: INPUT_GATE, 1: INPUT_GATE}
+    for i in range(2, n):
+        g[i] = Gate("XOR", i - 1, i - 2)
+    assert Circuit(g, {n - 1}).ordered_gates() == list(range(n))
+
+
+def test_deep_circuit():
+    # 32-bit ripple-carry adder chained 500 times: deeper than the recursion
+    # limit.
+    n = 32
+    g = {}
+    for i in range(n):
+        g["a%d" % i] = INPUT_GATE
+        g["b%d" % i] = INPUT_GATE
+    acc = ["a%d" % i for i in range(n)]
+    for k in range(500):
+        carry = None
+        res = []
+        for i in range(n):
+            x, y = acc[i], "b%d" % i
+            s = "s%d_%d" % (k, i)
+            g[s + "x"] = Gate("XOR", x, y)
+            if carry is None:
+                res.append(s + "x")
+                g[s + "c"] = Gate("AND", x, y)
+            else:
+                g[s] = Gate("XOR", s + "x", carry)
+                res.append(s)
+                g[s + "a"] = Gate("AND", x, y)
+                g[s + "b"] = Gate("AND", s + "x", carry)
+                g[s + "c"] = Gate("OR", s + "a", s + "b")
+            carry = s + "c"
+        acc = res
+    circ = Circuit(g, set(acc))
+    a, b = 123456789, 987654
+    inputs = {}
+    for i in range(n):
+        inputs["a%d" % i] = (a >> i) & 1
+        inputs["b%d" % i] = (b >> i) & 1
+    state = circ.evaluate(inputs).state
+    res = sum(state[w] << i for i, w in enumerate(acc))
+    assert res == (a + 500 * b) % 2 ** n
+
+
 if __name__ == "__main__":
     test_circuit()
+    test_compiled_circuit()
+    test_sliced()
+    test_ordered_gates()
+    test_deep_circuit()
@@ -10,6 +10,8 @@ Exercice Session : Secure 2-party computation
 Paper - Rock - Scissors
 """
 
+import argparse
+
 import six
 from six.moves import input
 from Crypto.Random import random
@@ -106,6 +108,48 @@ def run_garbled_prs():
             circuit_state['F'])
 
 
+def run_network_prs(party, address, listen=False, **options):
+    """Play as Alice (garbler) or Bob (evaluator) against the other party
+    running in another process, see garbled_net.run_party.
+
+    :param party: "alice" or "bob"
+    :param address: (host, port) or path of a Unix socket
+    """
+    # py3-only (asyncio), not needed by the rest of the module
+    from garbled_net import run_party
+
+    if party == "alice":
+        myinputs = {"A": random.getrandbits(1), "B": random.getrandbits(1)}
+        role = "garbler"
+    else:
+        choice = None
+        while choice not in ["PAPER", "ROCK", "SCISSORS", "LOSE", "P", "R", "S", "L"]:
+            choice = input("Bob'choice is PAPER (P), ROCK (R), SCISSORS (S) or LOSE (L) : ")
+        C, D = choice_to_bin(choice)
+        myinputs = {"C": C, "D": D}
+        role = "evaluator"
+    outputs, stats = run_party(role, prs_circuit, myinputs, address, listen, **options)
+    print(prs_result(outputs["E"], outputs["F"]))
+    print(stats)
+
+
 if __name__ == "__main__":
-    #test_prs_circuit()
-    run_garbled_prs()
+    parser = argparse.ArgumentParser(description="Paper - Rock - Scissors")
+    parser.add_argument(
+        "party",
+        nargs="?",
+        choices=("alice", "bob"),
+        help="play one party over the network (default: both, in this process)",
+    )
+    parser.add_argument("--listen", action="store_true", help="wait for the other party")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7770)
+    parser.add_argument("--unix", metavar="PATH", help="Unix socket instead of TCP")
+    parser.add_argument("--ot", default="dh", choices=("dh", "elgamal"))
+    args = parser.parse_args()
+    if args.party is None:
+        #test_prs_circuit()
+        run_garbled_prs()
+    else:
+        address = args.unix if args.unix else (args.host, args.port)
+        run_network_prs(args.party, address, args.listen, ot_mode=args.ot)